@@ -0,0 +1,143 @@
+import os
+from datetime import timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==========================================
+# BACKFILL NHIỀU NGÀY = 1 JOB CHA + NHIỀU JOB CON (MỖI JOB CON 1 CỬA SỔ THỜI GIAN)
+# Trước đây khoảng dài gửi AppMetrica thành 1 request export: chờ 202 rất lâu, về 1 file khổng lồ hoặc lỗi hẳn.
+# - create_manual_job chia khoảng > BACKFILL_WINDOW_HOURS thành các cửa sổ liên tiếp, mỗi cửa sổ 1 job con 'pending'.
+# - Job cha (window_total = số cửa sổ) không bao giờ được worker nhận; chỉ gom trạng thái / tổng event của các con.
+# - Các worker nhận job con song song như job thường, trong giới hạn slot theo token (MAX_JOBS_PER_TOKEN, api/job_queue.py).
+# - Ghi dữ liệu là UPSERT theo (app_id, uuid) -> cửa sổ chạy lại / trùng mốc biên không nhân bản event.
+# - Retry job cha / job con không tạo job mới: các cửa sổ cần chạy lại quay về 'pending' ngay trên dòng cũ (retry_children).
+# ==========================================
+
+BACKFILL_WINDOW_HOURS = float(os.getenv("BACKFILL_WINDOW_HOURS", "24"))
+
+# Trạng thái đã kết thúc của 1 job con
+FINAL_STATUSES = ('Success', 'Failed', 'Cancelled')
+
+def plan_windows(dt_start, dt_end, window_hours=BACKFILL_WINDOW_HOURS):
+    """[(since, until), ...] liên tiếp phủ kín [dt_start, dt_end]; khoảng ngắn hơn 1 cửa sổ -> 1 phần tử"""
+    step = timedelta(hours=window_hours)
+    if window_hours <= 0 or dt_end - dt_start <= step:
+        return [(dt_start, dt_end)]
+    windows = []
+    since = dt_start
+    while since < dt_end:
+        until = min(since + step, dt_end)
+        windows.append((since, until))
+        since = until
+    return windows
+
+def create_backfill_jobs(cur, app_id, windows, dt_scheduled=None):
+    """
+    Tạo job cha + các job con (chưa commit). Trả về (parent_id, [child_id, ...]).
+    Job con mang scheduled_at của job cha -> job hẹn giờ thì cả loạt cùng chờ đến hạn.
+    """
+    total = len(windows)
+    cur.execute("""
+        INSERT INTO job_history
+        (app_id, date_since, date_until, status, retry_count, created_at, scheduled_at, logs, run_type, total_events, window_total)
+        VALUES (%s, %s, %s, 'pending', 0, NOW(), %s, %s, 'manual', 0, %s)
+        RETURNING id
+    """, (app_id, windows[0][0], windows[-1][1], dt_scheduled,
+          f"Manual Backfill Scheduled by User ({total} windows x {BACKFILL_WINDOW_HOURS:g}h)", total))
+    parent_id = cur.fetchone()[0]
+
+    child_ids = []
+    for idx, (since, until) in enumerate(windows, start=1):
+        cur.execute("""
+            INSERT INTO job_history
+            (app_id, date_since, date_until, status, retry_count, created_at, scheduled_at, logs, run_type, parent_job_id, window_index)
+            VALUES (%s, %s, %s, 'pending', 0, NOW(), %s, %s, 'manual', %s, %s)
+            RETURNING id
+        """, (app_id, since, until, dt_scheduled, f"Backfill window {idx}/{total} of Job #{parent_id}", parent_id, idx))
+        child_ids.append(cur.fetchone()[0])
+    return parent_id, child_ids
+
+def mark_parent_started(cur, parent_id):
+    """Job con đầu tiên bắt đầu chạy -> job cha chuyển Processing"""
+    cur.execute("""
+        UPDATE job_history SET status = 'Processing', start_time = COALESCE(start_time, NOW())
+        WHERE id = %s AND status = 'pending'
+    """, (parent_id,))
+
+def cancel_children(cur, parent_id):
+    """STOP job cha: job con chưa chạy / đang chạy đều chuyển Cancelled (worker đang chạy tự dừng qua JobStopSignal)"""
+    cur.execute("""
+        UPDATE job_history SET status = 'Cancelled', end_time = NOW()
+        WHERE parent_job_id = %s AND status IN ('pending', 'Running', 'Processing')
+        RETURNING id
+    """, (parent_id,))
+    return [row[0] for row in cur.fetchall()]
+
+def retry_children(cur, parent_id, child_id=None):
+    """
+    Retry backfill (chưa commit): job con Failed / Cancelled của job cha (hoặc đúng 1 job con child_id, kể cả đã Success)
+    quay lại 'pending' giữ nguyên cửa sổ & parent_job_id, job cha mở lại 'pending' -> worker chạy lại các cửa sổ đó,
+    cửa sổ cuối cùng xong sẽ chốt lại job cha qua rollup_parent. Trả về [(child_id, trạng thái cũ), ...]
+    """
+    statuses = list(FINAL_STATUSES) if child_id else ['Failed', 'Cancelled']
+    cur.execute("""
+        SELECT id, status FROM job_history
+        WHERE parent_job_id = %s AND status = ANY(%s) AND (%s::int IS NULL OR id = %s)
+        ORDER BY window_index
+        FOR UPDATE
+    """, (parent_id, statuses, child_id, child_id))
+    reset = [(row[0], row[1]) for row in cur.fetchall()]
+    if not reset: return []
+
+    cur.execute("""
+        UPDATE job_history SET status = 'pending', start_time = NULL, end_time = NULL, total_events = 0,
+               success_count = NULL, retry_count = 0, rate_limit_hits = 0, scheduled_at = NULL
+        WHERE id = ANY(%s)
+    """, ([cid for cid, _ in reset],))
+    cur.execute("""
+        UPDATE job_history SET status = 'pending', end_time = NULL, success_count = NULL
+        WHERE id = %s
+    """, (parent_id,))
+    return reset
+
+def rollup_parent(cur, parent_id):
+    """
+    Gom các job con vào job cha: total_events = tổng các con; khi mọi con đã kết thúc thì chốt trạng thái
+    (tất cả Success -> Success, có con bị hủy -> Cancelled, còn lại -> Failed).
+    Khóa dòng job cha trước -> 2 job con xong cùng lúc không ghi đè nhau.
+    Trả về trạng thái cuối của job cha (None nếu còn con chưa xong).
+    """
+    cur.execute("SELECT status FROM job_history WHERE id = %s FOR UPDATE", (parent_id,))
+    row = cur.fetchone()
+    if not row: return None
+    parent_status = row[0]
+
+    cur.execute("""
+        SELECT COUNT(*),
+               COUNT(*) FILTER (WHERE status = ANY(%s)),
+               COUNT(*) FILTER (WHERE status = 'Success'),
+               COUNT(*) FILTER (WHERE status = 'Cancelled'),
+               COALESCE(SUM(total_events), 0)
+        FROM job_history WHERE parent_job_id = %s
+    """, (list(FINAL_STATUSES), parent_id))
+    total, done, success, cancelled, events = cur.fetchone()
+
+    if total == 0 or done < total:
+        cur.execute("UPDATE job_history SET total_events = %s WHERE id = %s", (events, parent_id))
+        return None
+
+    if parent_status == 'Cancelled' or cancelled: final = 'Cancelled'
+    elif success == total: final = 'Success'
+    else: final = 'Failed'
+    cur.execute("""
+        UPDATE job_history SET status = %s, total_events = %s, success_count = %s,
+               end_time = COALESCE(end_time, NOW())
+        WHERE id = %s
+    """, (final, events, events if final == 'Success' else None, parent_id))
+    return final
+
+def progress_pct(windows_done, window_total):
+    if not window_total: return None
+    return round(100.0 * (windows_done or 0) / window_total, 1)
@@ -0,0 +1,146 @@
+import io
+import re
+import uuid
+from datetime import datetime
+
+from api.event_fields import TYPED_COLUMNS, extract_event_fields_from_json
+from api.partitions import is_partitioned, ensure_event_partitions
+from api.etl_processor import mark_etl_rescan
+
+# Thứ tự cột gốc của 1 dòng event (các luồng ETL cũ chỉ truyền 8 cột này)
+BASE_COLUMNS = ("app_id", "event_name", "event_json", "count", "created_at", "job_id", "uuid", "raw_timestamp")
+
+# Thứ tự đầy đủ (khớp với build_event_row trong api/index.py): cột gốc + cột kiểu trích xuất sẵn
+EVENT_COLUMNS = BASE_COLUMNS + TYPED_COLUMNS
+
+STAGING_TABLE = "event_logs_staging"
+
+# Escape \u0000 trong chuỗi JSON (không tính "\\u0000" = dấu \ thật + chữ u0000). Cột JSONB không nhận NUL.
+JSON_NUL_ESCAPE = re.compile(r'(?<!\\)((?:\\\\)*)\\u0000')
+
+# Key chống trùng của event_logs
+EVENT_CONFLICT_KEY = "app_id, event_name, raw_timestamp, uuid"
+
+# Bảng đã phân vùng (api/partitions.py): unique index bắt buộc chứa cột phân vùng created_at.
+# Luồng worker (build_event_row / event_time trong api/index.py) lấy created_at từ event_timestamp, thiếu thì từ
+# event_receive_timestamp của chính event, event không có mốc nào bị loại -> cùng 1 event luôn ra cùng created_at.
+# Key chỉ tương đương key cũ khi event_timestamp hợp lệ: event thiếu event_timestamp (raw_timestamp = '') được
+# phân biệt thêm theo event_receive_timestamp.
+PARTITIONED_CONFLICT_KEY = EVENT_CONFLICT_KEY + ", created_at"
+
+# Dấu vân tay nội dung event: md5 của event_json dạng JSONB (đã chuẩn hóa thứ tự key / khoảng trắng) -> uuid 16 byte
+FINGERPRINT_SQL = "md5(event_json::text)::uuid"
+
+# MERGE 1 lệnh từ staging -> event_logs (thay cho executemany từng dòng)
+# - DISTINCT ON: trong cùng 1 lô nếu trùng key thì giữ dòng đến sau cùng (giống executemany tuần tự).
+#   Dòng thiếu uuid/raw_timestamp (NULL) không bao giờ trùng nhau -> tách riêng bằng seq.
+# - Khi trùng với dữ liệu đã có: giữ nguyên chiến thuật AUDIT (cất JSON cũ + Job cũ).
+# - Trùng key mà nội dung không đổi (cửa sổ chồng 5 phút, Retry chạy lại cả cửa sổ) -> bỏ qua, không ghi lại dòng
+#   (không sinh WAL / dòng chết, event_json_old giữ bản thay đổi thật gần nhất).
+#   Dòng cũ chưa có event_fingerprint thì tính tại chỗ (api/scripts/backfill_event_columns.py điền sẵn cho dữ liệu cũ).
+MERGE_SQL_TEMPLATE = """
+    INSERT INTO event_logs ({columns}, event_fingerprint)
+    SELECT {columns}, {fingerprint}
+    FROM (
+        SELECT DISTINCT ON ({conflict_key}, CASE WHEN uuid IS NULL OR raw_timestamp IS NULL THEN seq END)
+            {columns}
+        FROM {staging}
+        WHERE batch_id = %s
+        ORDER BY {conflict_key}, CASE WHEN uuid IS NULL OR raw_timestamp IS NULL THEN seq END, seq DESC
+    ) s
+    ON CONFLICT ({conflict_key})
+    DO UPDATE SET
+        -- [BACKUP DỮ LIỆU CŨ]
+        event_json_old = event_logs.event_json,
+        job_id_old = event_logs.job_id,
+
+        -- [GHI DỮ LIỆU MỚI]
+        event_json = EXCLUDED.event_json,
+        job_id = EXCLUDED.job_id,
+        created_at = EXCLUDED.created_at,
+        count = event_logs.count,
+
+        -- [CỘT KIỂU: luôn khớp với JSON mới]
+        level_num = EXCLUDED.level_num,
+        user_uid = EXCLUDED.user_uid,
+        app_version_name = EXCLUDED.app_version_name,
+        country_iso_code = EXCLUDED.country_iso_code,
+        coin_cost = EXCLUDED.coin_cost,
+        timeplay = EXCLUDED.timeplay,
+        booster_counts = EXCLUDED.booster_counts,
+        event_fingerprint = EXCLUDED.event_fingerprint
+    WHERE COALESCE(event_logs.event_fingerprint, md5(event_logs.event_json::text)::uuid)
+          IS DISTINCT FROM EXCLUDED.event_fingerprint
+"""
+
+MERGE_SQL = MERGE_SQL_TEMPLATE.format(columns=", ".join(EVENT_COLUMNS), conflict_key=EVENT_CONFLICT_KEY,
+                                      staging=STAGING_TABLE, fingerprint=FINGERPRINT_SQL)
+MERGE_SQL_PARTITIONED = MERGE_SQL_TEMPLATE.format(columns=", ".join(EVENT_COLUMNS), conflict_key=PARTITIONED_CONFLICT_KEY,
+                                                  staging=STAGING_TABLE, fingerprint=FINGERPRINT_SQL)
+
+def _copy_value(val):
+    """Escape 1 giá trị theo định dạng TEXT của COPY"""
+    if val is None:
+        return "\\N"
+    if isinstance(val, datetime):
+        val = val.isoformat(sep=' ')
+    else:
+        val = str(val)
+    return (val.replace("\\", "\\\\")
+               .replace("\t", "\\t")
+               .replace("\n", "\\n")
+               .replace("\r", "\\r"))
+
+def bulk_upsert_events(conn, rows):
+    """
+    Ghi 1 lô event vào event_logs bằng COPY + 1 câu INSERT ... SELECT ... ON CONFLICT.
+    rows: list tuple theo thứ tự EVENT_COLUMNS.
+          Dòng chỉ có 8 cột gốc (BASE_COLUMNS) sẽ được tự trích xuất cột kiểu từ event_json.
+    Không tự commit: caller commit để lô ghi vào là nguyên tử.
+    Trả về số dòng event_logs bị insert/update (dòng trùng nội dung không tính).
+    """
+    if not rows:
+        return 0
+
+    batch_id = uuid.uuid4().hex
+    buf = io.StringIO()
+    months_by_app = {}
+    for seq, row in enumerate(rows):
+        if len(row) == len(BASE_COLUMNS):
+            row = tuple(row) + extract_event_fields_from_json(row[1], row[2])
+        if isinstance(row[2], str) and "\\u0000" in row[2]:
+            # Bỏ ký tự NUL thay vì để cả lô COPY lỗi
+            row = (row[0], row[1], JSON_NUL_ESCAPE.sub(r"\1", row[2])) + tuple(row[3:])
+        months_by_app.setdefault(row[0], set()).add(row[4])
+        buf.write(batch_id)
+        buf.write("\t")
+        buf.write(str(seq))
+        for val in row:
+            buf.write("\t")
+            buf.write(_copy_value(val))
+        buf.write("\n")
+    buf.seek(0)
+
+    cur = conn.cursor()
+    try:
+        partitioned = is_partitioned(cur)
+        if partitioned:
+            # Tạo sẵn phân vùng tháng còn thiếu (transaction riêng, không giữ khóa DDL trong lô ghi)
+            for app_id, stamps in months_by_app.items():
+                if app_id is not None: ensure_event_partitions(app_id, stamps)
+
+        cur.copy_expert(
+            f"COPY {STAGING_TABLE} (batch_id, seq, {', '.join(EVENT_COLUMNS)}) FROM STDIN",
+            buf
+        )
+        cur.execute(MERGE_SQL_PARTITIONED if partitioned else MERGE_SQL, (batch_id,))
+        affected = cur.rowcount
+        if affected:
+            # ETL tăng dần (api/etl_processor.py) quét lại từ event sớm nhất của lô, kể cả khi cũ hơn watermark
+            for app_id, stamps in months_by_app.items():
+                mark_etl_rescan(cur, app_id, min((s for s in stamps if s is not None), default=None))
+        # Dọn lô vừa merge (cùng transaction -> worker khác không bao giờ thấy)
+        cur.execute(f"DELETE FROM {STAGING_TABLE} WHERE batch_id = %s", (batch_id,))
+        return affected
+    finally:
+        cur.close()
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- CẤU HÌNH POOL (Lấy từ .env) ---
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))                      # Chờ mượn connection tối đa (giây)
+DB_POOL_HEALTHCHECK_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "30")) # Connection nằm im lâu hơn -> ping lại trước khi dùng
+
+
+class PoolTimeout(Exception):
+    """Hết connection trong pool và chờ quá DB_POOL_TIMEOUT"""
+
+
+class PooledConnection:
+    """
+    Vỏ bọc connection mượn từ pool.
+    Code cũ vẫn gọi conn.close() như bình thường -> thực chất là TRẢ connection về pool.
+    """
+    def __init__(self, owner, raw):
+        self._owner = owner
+        self._raw = raw
+
+    @property
+    def closed(self):
+        return self._raw is None or self._raw.closed
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._owner.release(raw)
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get('_raw')
+        if raw is None:
+            raise AttributeError(f"Connection đã trả về pool (truy cập '{name}')")
+        return getattr(raw, name)
+
+    def __del__(self):
+        # Lưới an toàn: quên close() thì khi bị thu gom vẫn trả về pool
+        try: self.close()
+        except Exception: pass
+
+
+class DBPool:
+    """ThreadedConnectionPool + giới hạn chờ (timeout), health check và thống kê sử dụng"""
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_seconds, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_seconds = healthcheck_seconds
+        self.pid = os.getpid()
+
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {} # id(raw) -> thời điểm trả về pool
+
+        self._stats = {
+            "checkouts": 0, "in_use": 0, "peak_in_use": 0,
+            "waits": 0, "wait_seconds_total": 0.0, "timeouts": 0,
+            "health_check_failures": 0, "discarded": 0,
+        }
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        t0 = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock: self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=timeout):
+                with self._lock: self._stats["timeouts"] += 1
+                raise PoolTimeout(f"DB pool cạn ({self.maxconn} connections) sau {timeout}s")
+        waited = time.monotonic() - t0
+
+        try:
+            raw = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds_total"] += waited
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+        return PooledConnection(self, raw)
+
+    def _checkout_healthy(self):
+        # Thử tối đa maxconn lần: connection chết thì bỏ và lấy cái khác
+        for _ in range(self.maxconn + 1):
+            raw = self._pool.getconn()
+            idle_for = time.monotonic() - self._last_used.pop(id(raw), time.monotonic())
+            if not raw.closed and (idle_for < self.healthcheck_seconds or self._ping(raw)):
+                return raw
+            with self._lock:
+                self._stats["health_check_failures"] += 1
+                self._stats["discarded"] += 1
+            self._pool.putconn(raw, close=True)
+        raise PoolTimeout("Không lấy được connection khỏe mạnh từ DB pool")
+
+    @staticmethod
+    def _ping(raw):
+        try:
+            cur = raw.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            raw.rollback()
+            return True
+        except Exception:
+            return False
+
+    def release(self, raw):
+        discard = raw.closed
+        if not discard:
+            try:
+                # Reset transaction dang dở để người mượn sau không bị kẹt
+                raw.rollback()
+                if raw.autocommit: raw.autocommit = False
+            except Exception:
+                discard = True
+        try:
+            if not discard:
+                self._last_used[id(raw)] = time.monotonic()
+            else:
+                with self._lock: self._stats["discarded"] += 1
+            self._pool.putconn(raw, close=discard)
+        finally:
+            with self._lock: self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data.update({
+            "min_size": self.minconn,
+            "max_size": self.maxconn,
+            "idle": len(self._pool._pool),
+            "open": len(self._pool._pool) + len(self._pool._used),
+            "utilization_pct": round(data["in_use"] * 100.0 / self.maxconn, 1) if self.maxconn else 0,
+            "wait_seconds_total": round(data["wait_seconds_total"], 3),
+        })
+        return data
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+def connection_kwargs():
+    """Tham số kết nối DB lấy từ .env (dùng chung cho pool và connection riêng)"""
+    return dict(
+        host=os.getenv('DB_HOST'),
+        database=os.getenv('DB_NAME'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASS') or os.getenv('DB_PASSWORD'),
+        port=os.getenv('DB_PORT')
+    )
+
+def connect_direct(**extra):
+    """
+    Connection riêng KHÔNG qua pool - chỉ dùng cho kết nối sống lâu (VD: LISTEN chờ job),
+    tránh chiếm 1 slot của pool mãi mãi.
+    """
+    kwargs = connection_kwargs()
+    kwargs.update(extra)
+    return psycopg2.connect(**kwargs)
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """Pool dùng chung cho cả process (tự tạo lại nếu process bị fork)"""
+    global _POOL
+    if _POOL is not None and _POOL.pid == os.getpid():
+        return _POOL
+    with _POOL_LOCK:
+        if _POOL is None or _POOL.pid != os.getpid():
+            _POOL = DBPool(
+                DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_SECONDS,
+                **connection_kwargs()
+            )
+    return _POOL
+
+def get_pooled_connection(timeout=None):
+    """Mượn 1 connection; gọi conn.close() để trả lại"""
+    return get_pool().getconn(timeout)
+
+def pool_stats():
+    if _POOL is None or _POOL.pid != os.getpid():
+        return {"max_size": DB_POOL_MAX, "open": 0, "in_use": 0, "idle": 0, "checkouts": 0}
+    return _POOL.stats()
@@ -0,0 +1,34 @@
+import os
+import itertools
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==========================================
+# ĐỌC KẾT QUẢ LỚN BẰNG SERVER-SIDE CURSOR
+# cur.fetchall() + RealDictCursor kéo toàn bộ kết quả về RAM, mỗi dòng 1 dict.
+# stream_rows() dùng named cursor: Postgres giữ kết quả, client lấy từng lô ANALYTICS_FETCH_SIZE dòng (tuple)
+# -> bộ nhớ mỗi request chỉ phụ thuộc kích thước lô, không phụ thuộc khoảng ngày.
+# ==========================================
+
+ANALYTICS_FETCH_SIZE = int(os.getenv("ANALYTICS_FETCH_SIZE", "5000"))
+
+# Tên cursor phải khác nhau trong cùng 1 transaction
+_CURSOR_SEQ = itertools.count(1)
+
+def stream_rows(conn, sql, params=None, name="stream", itersize=ANALYTICS_FETCH_SIZE):
+    """
+    Generator trả từng dòng (tuple, đúng thứ tự cột trong SELECT) của câu query.
+    Cursor được đóng khi duyệt xong hoặc khi generator bị bỏ dở / lỗi.
+    conn không được ở chế độ autocommit (named cursor cần transaction).
+    """
+    cur = conn.cursor(name=f"{name}_{next(_CURSOR_SEQ)}")
+    cur.itersize = itersize
+    try:
+        cur.execute(sql, params)
+        for row in cur:
+            yield row
+    finally:
+        try: cur.close()
+        except Exception: pass
@@ -1,45 +1,199 @@
 import json
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import os
 
-# Copy cấu hình DB từ main.py sang (hoặc import từ config nếu có)
-DB_HOST = os.getenv("DB_HOST")
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASS = os.getenv("DB_PASS")
-DB_PORT = os.getenv("DB_PORT")
+from api.db_pool import get_pooled_connection
+from api.event_json import flatten_event
 
 def get_db_connection():
+    # Dùng chung pool với API/Worker (api/db_pool.py) thay vì tự mở connection riêng
     try:
-        if not all([DB_HOST, DB_NAME, DB_USER, DB_PASS, DB_PORT]):
-            raise ValueError("Database environment variables (DB_HOST, DB_NAME, DB_USER, DB_PASS, DB_PORT) are required")
-        
-        conn = psycopg2.connect(
-            host=DB_HOST, 
-            database=DB_NAME, 
-            user=DB_USER, 
-            password=DB_PASS,
-            port=DB_PORT
-        )
-        return conn
+        return get_pooled_connection()
     except Exception as e:
         print(f"❌ ETL DB Connection Error: {e}")
         return None
 
-def run_etl_pipeline(app_id):
+# Số dòng mỗi lần kéo từ server-side cursor / số session mỗi lệnh ghi
+ETL_FETCH_SIZE = 5000
+ETL_WRITE_BATCH = 1000
+
+# Session không thấy Win/Fail: tìm booster trong 10 phút kể từ lúc Start
+DROP_BOOSTER_WINDOW = timedelta(minutes=10)
+
+# --- CHẾ ĐỘ TĂNG DẦN (WATERMARK) ---
+# Mỗi lần chạy chỉ quét event mới từ mốc đã xử lý (etl_watermarks), lùi thêm ETL_LOOKBACK_MINUTES cho event về muộn.
+# Session còn mở (DROP) trong ETL_OPEN_SESSION_HOURS gần nhất được quét lại để Win/Fail đến sau vẫn đóng được.
+# Watermark là thời gian event, không phải thứ tự ghi: mọi lô ghi vào event_logs (bulk_loader) gọi mark_etl_rescan
+# với thời gian event sớm nhất của lô -> lần chạy sau quét lại từ đó (backfill / Retry / event về trễ hơn lookback).
+ETL_PIPELINE_NAME = 'level_sessions'
+ETL_LOOKBACK_MINUTES = int(os.getenv("ETL_LOOKBACK_MINUTES", "120"))
+ETL_OPEN_SESSION_HOURS = int(os.getenv("ETL_OPEN_SESSION_HOURS", "24"))
+
+# Dòng event_logs chưa qua backfill cột kiểu (event_fingerprint chỉ NULL ở dữ liệu cũ chưa chạy
+# api/scripts/backfill_event_columns.py): user_uid còn NULL -> ghép session sẽ ra Guest_<id> sai
+UNBACKFILLED_SQL = """
+    SELECT COUNT(*) AS n FROM (
+        SELECT 1 FROM event_logs
+        WHERE app_id = %(app_id)s AND event_name = ANY(%(names)s) AND event_fingerprint IS NULL {since_clause}
+        LIMIT 1000
+    ) t
+"""
+
+# Đọc 1 lượt toàn bộ event liên quan, sắp theo (user, thời gian).
+# Cùng thời điểm thì Win/Fail đứng trước Start (Win/Fail phải xảy ra SAU Start mới được tính là kết thúc).
+# Chỉ dòng Start mới cần event_json (lấy tên level). {since_clause}: rỗng (full) hoặc lọc từ mốc quét.
+EVENTS_SQL = """
+    SELECT id, event_name, created_at, user_uid,
+           CASE WHEN event_name = %(evt_start)s THEN event_json END AS event_json
+    FROM event_logs
+    WHERE app_id = %(app_id)s AND event_name = ANY(%(names)s) {since_clause}
+    ORDER BY user_uid NULLS FIRST, created_at, (event_name = %(evt_start)s), id
+"""
+
+# Mốc quét khi chạy tăng dần: lùi từ watermark (hoặc rescan_from nếu sớm hơn), và lùi tiếp tới Start sớm nhất
+# của session còn mở
+SCAN_FROM_SQL = """
+    WITH m AS (SELECT LEAST(%(watermark)s::timestamp, %(rescan_from)s::timestamp) AS mark)
+    SELECT LEAST(
+        m.mark - %(lookback)s * interval '1 minute',
+        (SELECT MIN(start_time) FROM level_analytics
+         WHERE app_id = %(app_id)s AND status = 'DROP'
+           AND start_time >= m.mark - %(open_hours)s * interval '1 hour')
+    ) AS scan_from
+    FROM m
+"""
+
+# Đánh dấu cần quét lại (chưa có watermark thì tạo dòng trống -> lần chạy đầu vẫn là full)
+MARK_RESCAN_SQL = """
+    INSERT INTO etl_watermarks (app_id, pipeline, rescan_from, rescan_seq, updated_at)
+    VALUES (%s, %s, %s, 1, NOW())
+    ON CONFLICT (app_id, pipeline) DO UPDATE SET
+        rescan_from = LEAST(etl_watermarks.rescan_from, EXCLUDED.rescan_from),
+        rescan_seq = etl_watermarks.rescan_seq + 1
+"""
+
+SAVE_WATERMARK_SQL = """
+    INSERT INTO etl_watermarks (app_id, pipeline, watermark, config_key, updated_at)
+    VALUES (%s, %s, %s, %s, NOW())
+    ON CONFLICT (app_id, pipeline) DO UPDATE SET
+        watermark = GREATEST(COALESCE(EXCLUDED.watermark, etl_watermarks.watermark), etl_watermarks.watermark),
+        config_key = EXCLUDED.config_key,
+        rescan_from = CASE WHEN etl_watermarks.rescan_seq = %s THEN NULL ELSE etl_watermarks.rescan_from END,
+        updated_at = NOW()
+"""
+
+UPSERT_SESSIONS_SQL = """
+    INSERT INTO level_analytics
+    (app_id, session_id, user_id, level_name, status, duration, start_time, boosters_used, total_cost, created_at)
+    VALUES %s
+    ON CONFLICT (app_id, session_id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        level_name = EXCLUDED.level_name,
+        status = EXCLUDED.status,
+        duration = EXCLUDED.duration,
+        start_time = EXCLUDED.start_time,
+        boosters_used = EXCLUDED.boosters_used,
+        total_cost = EXCLUDED.total_cost
+"""
+
+def mark_etl_rescan(cur, app_id, since):
+    """
+    Gọi trong transaction ghi event (caller commit): event từ thời điểm since của app vừa được ghi / sửa
+    -> lần ETL tăng dần tiếp theo quét lại từ đó dù since cũ hơn watermark.
+    """
+    if app_id is None or since is None: return
+    cur.execute(MARK_RESCAN_SQL, (app_id, ETL_PIPELINE_NAME, since))
+
+def parse_start_level(raw_json):
+    """Tên level của 1 event Start (JSON có thể lồng 'event_json' dạng chuỗi)"""
+    params = flatten_event(raw_json)
+
+    # Log của game dùng key 'dayChallenge'
+    level_val = params.get('dayChallenge') or params.get('level_id') or params.get('level')
+    return f"Day_{level_val}" if level_val else "Unknown_Level"
+
+def iter_user_groups(rows):
+    """Gom các dòng liên tiếp cùng user_uid (rows đã sắp theo user) -> (user_uid, [rows])"""
+    current, group = None, []
+    for row in rows:
+        if group and row['user_uid'] != current:
+            yield current, group
+            group = []
+        current = row['user_uid']
+        group.append(row)
+    if group:
+        yield current, group
+
+def sessionize_user(app_id, user_uid, rows, evt_start, evt_win, evt_fail, price_map):
+    """
+    Ghép lượt chơi của 1 user: mỗi Start kết thúc ở Win/Fail ĐẦU TIÊN sau nó (không thấy -> DROP),
+    booster mua trong khoảng [Start, Kết thúc] được đếm & tính tiền theo price_map.
+    Trả về list tuple theo thứ tự cột của UPSERT_SESSIONS_SQL.
+    """
+    starts = [r for r in rows if r['event_name'] == evt_start]
+    ends = [r for r in rows if r['event_name'] in (evt_win, evt_fail)] if user_uid is not None else []
+    boosts = [r for r in rows if r['event_name'] in price_map] if user_uid is not None else []
+    end_times = [r['created_at'] for r in ends]
+    boost_times = [r['created_at'] for r in boosts]
+
+    sessions = []
+    for start_row in starts:
+        try:
+            level_id = parse_start_level(start_row['event_json'])
+        except Exception as e:
+            print(f"⚠️ Lỗi parse JSON dòng {start_row['id']}: {e}")
+            continue
+
+        # Log thiếu user -> User ID giả theo ID log
+        user_id = user_uid if user_uid is not None else f"Guest_{start_row['id']}"
+        session_id = f"{user_id}_{start_row['id']}"
+        started = start_row['created_at']
+
+        status = 'DROP'
+        duration = 0
+        end_time = started + DROP_BOOSTER_WINDOW
+        i = bisect_right(end_times, started)
+        if i < len(ends):
+            status = 'WIN' if ends[i]['event_name'] == evt_win else 'FAIL'
+            end_time = ends[i]['created_at']
+            duration = int((end_time - started).total_seconds())
+
+        current_boosters = {}
+        total_cost = 0
+        for b in boosts[bisect_left(boost_times, started):bisect_right(boost_times, end_time)]:
+            b_name = b['event_name']
+            current_boosters[b_name] = current_boosters.get(b_name, 0) + 1
+            total_cost += price_map.get(b_name, 0)
+
+        sessions.append((app_id, session_id, str(user_id), level_id, status, duration, started,
+                         json.dumps(current_boosters), total_cost))
+    return sessions
+
+def write_sessions(cur, sessions):
+    if not sessions: return
+    execute_values(cur, UPSERT_SESSIONS_SQL, sessions,
+                   template="(%s, %s, %s, %s, %s, %s, %s, %s::jsonb, %s, NOW())", page_size=ETL_WRITE_BATCH)
+
+def run_etl_pipeline(app_id, full=False):
     """
     Hàm này sẽ:
     1. Đọc cấu hình Game (Start/Win/Fail event)
     2. Đọc bảng giá Booster
-    3. Quét Log thô -> Gom nhóm thành Level Session
-    4. Tính toán tiền & item -> Ghi vào bảng level_analytics
+    3. Quét Log thô 1 lượt (sắp theo user, thời gian) -> Gom nhóm thành Level Session
+    4. Tính toán tiền & item -> Ghi theo lô vào bảng level_analytics (upsert theo (app_id, session_id))
+    5. Lưu watermark (cùng transaction với bước 4 -> chỉ tiến lên khi ghi thành công)
+
+    full=True: quét lại từ đầu (rebuild). Mặc định chỉ quét phần mới kể từ watermark;
+    chưa có watermark hoặc cấu hình Start/Win/Fail/giá booster đã đổi thì tự chạy full.
     """
     print(f"🚀 [ETL] Bắt đầu xử lý dữ liệu cho App ID: {app_id}")
     conn = get_db_connection()
     if not conn: return False
     
+    cur = None
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
@@ -59,126 +213,64 @@ def run_etl_pipeline(app_id):
         boosters = cur.fetchall()
         # Biến đổi thành Dict để tra cứu cho nhanh: {'buy_hammer': 500, ...}
         price_map = {b['booster_event_name']: b['cost'] for b in boosters}
+        config_key = json.dumps([evt_start, evt_win, evt_fail, sorted(price_map.items())])
+
+        # Mốc quét (None = full). rescan_seq đọc TRƯỚC khi quét: lô ghi xen vào lúc đang chạy sẽ giữ lại rescan_from
+        scan_from = None
+        cur.execute("SELECT watermark, config_key, rescan_from, rescan_seq FROM etl_watermarks WHERE app_id = %s AND pipeline = %s",
+                    (app_id, ETL_PIPELINE_NAME))
+        mark = cur.fetchone()
+        rescan_seq = mark['rescan_seq'] if mark else 0
+        conn.commit() # Snapshot của lệnh quét phải mới hơn lần đọc rescan_seq
+        if not full:
+            if mark and mark['watermark'] and mark['config_key'] == config_key:
+                cur.execute(SCAN_FROM_SQL, {"app_id": app_id, "watermark": mark['watermark'], "rescan_from": mark['rescan_from'],
+                                            "lookback": ETL_LOOKBACK_MINUTES, "open_hours": ETL_OPEN_SESSION_HOURS})
+                scan_from = cur.fetchone()['scan_from']
+                if mark['rescan_from'] and mark['rescan_from'] < mark['watermark']:
+                    print(f"↩️ [ETL] Có event cũ hơn watermark được ghi thêm (từ {mark['rescan_from']}) -> quét lại từ đó.")
+            elif mark and mark['watermark']:
+                print("⚠️ [ETL] Cấu hình Start/Win/Fail hoặc giá booster đã đổi -> chạy lại toàn bộ.")
         
-        # 3. Lấy tất cả sự kiện START (Trong thực tế nên lọc những cái chưa xử lý)
-        # Sắp xếp theo User và Thời gian để dễ xử lý
-        print("⏳ [ETL] Đang quét log Start...")
-        cur.execute("""
-            SELECT id, event_json, created_at 
-            FROM event_logs 
-            WHERE app_id = %s AND event_name = %s 
-            ORDER BY created_at ASC
-        """, (app_id, evt_start))
-        start_logs = cur.fetchall()
-        
+        # 3. Quét 1 lượt Start / Win / Fail / Booster bằng server-side cursor (không kéo hết về RAM),
+        # user nào xong thì ghép session của user đó ngay
+        if scan_from:
+            print(f"⏳ [ETL] Đang quét log mới từ {scan_from} (1 lượt theo user)...")
+        else:
+            print("⏳ [ETL] Đang quét toàn bộ log (1 lượt theo user)...")
+        names = list({evt_start, evt_win, evt_fail} | set(price_map.keys()))
+        since_clause = "AND created_at >= %(since)s" if scan_from else ""
+        cur.execute(UNBACKFILLED_SQL.format(since_clause=since_clause), {"app_id": app_id, "names": names, "since": scan_from})
+        unbackfilled = cur.fetchone()['n']
+        if unbackfilled:
+            print(f"⚠️ [ETL] Còn {unbackfilled}{'+' if unbackfilled >= 1000 else ''} dòng log cũ chưa có user_uid "
+                  f"-> chạy trước: python api/scripts/backfill_event_columns.py --app-id {app_id} --only-missing")
+            return False
+        stream = conn.cursor(name=f"etl_sessions_{app_id}", cursor_factory=RealDictCursor)
+        stream.itersize = ETL_FETCH_SIZE
+        stream.execute(
+            EVENTS_SQL.format(since_clause=since_clause),
+            {"app_id": app_id, "names": names, "evt_start": evt_start, "since": scan_from}
+        )
+
         processed_count = 0
-        
-        for start_row in start_logs:
-            # Parse JSON lấy UserID, LevelID
-            try:
-                raw_json = start_row['event_json']
-                params = {}
-
-                # 1. Xử lý (JSON lồng nhau) để lấy dữ liệu
-                if isinstance(raw_json, dict):
-                    # Nếu là Dict, kiểm tra xem có key 'event_json' dạng string bên trong không
-                    if 'event_json' in raw_json and isinstance(raw_json['event_json'], str):
-                         params = json.loads(raw_json['event_json'])
-                    else:
-                         params = raw_json
-                else:
-                    # Nếu là String, parse ra Dict rồi lại kiểm tra lồng nhau
-                    temp = json.loads(raw_json)
-                    if 'event_json' in temp and isinstance(temp['event_json'], str):
-                        params = json.loads(temp['event_json'])
-                    else:
-                        params = temp
-
-                # 2. Map dữ liệu (Sửa để khớp với log của bạn)
-                # Tạo User ID giả: GUEST + ID log (Vì log thiếu user_id)
-                user_id = params.get('uid') or params.get('user_id') or f"Guest_{start_row['id']}"
-
-                # Lấy Level: Log của bạn dùng key 'dayChallenge'
-                level_val = params.get('dayChallenge') or params.get('level_id') or params.get('level')
-                # Đặt tên biến là level_id để khớp với câu lệnh INSERT ở dưới cùng
-                level_id = f"Day_{level_val}" if level_val else "Unknown_Level"
-
-                # Tạo Session ID duy nhất
-                session_id = f"{user_id}_{start_row['id']}"
-                
-            except Exception as e:
-                print(f"⚠️ Lỗi parse JSON dòng {start_row['id']}: {e}")
-                continue
-
-            # 4. Tìm sự kiện KẾT THÚC (Win/Fail) gần nhất của user này
-            cur.execute("""
-                SELECT event_name, created_at 
-                FROM event_logs 
-                WHERE app_id = %s 
-                  AND event_name IN (%s, %s)
-                  AND created_at > %s 
-                  AND (event_json::jsonb->>'user_id' = %s OR event_json::jsonb->>'user' = %s)
-                ORDER BY created_at ASC 
-                LIMIT 1
-            """, (app_id, evt_win, evt_fail, start_row['created_at'], str(user_id), str(user_id)))
-            
-            end_row = cur.fetchone()
-            
-            # Mặc định (nếu không thấy kết thúc -> User thoát ngang xương)
-            status = 'DROP'
-            duration = 0
-            end_time = start_row['created_at'] + timedelta(minutes=10) # Giới hạn tìm booster 10p
-            
-            if end_row:
-                status = 'WIN' if end_row['event_name'] == evt_win else 'FAIL'
-                end_time = end_row['created_at']
-                # Tính duration (giây)
-                diff = end_time - start_row['created_at']
-                duration = int(diff.total_seconds())
-
-            # 5. Quét Booster đã mua trong khoảng thời gian chơi (Start -> End)
-            # Chỉ tìm những event có trong bảng giá (price_map)
-            if price_map:
-                placeholders = ', '.join(['%s'] * len(price_map))
-                query_booster = f"""
-                    SELECT event_name 
-                    FROM event_logs 
-                    WHERE app_id = %s 
-                      AND event_name IN ({placeholders})
-                      AND created_at >= %s AND created_at <= %s
-                      AND (event_json::jsonb->>'user_id' = %s OR event_json::jsonb->>'user' = %s)
-                """
-                params = [app_id] + list(price_map.keys()) + [start_row['created_at'], end_time, str(user_id), str(user_id)]
-                
-                cur.execute(query_booster, tuple(params))
-                booster_logs = cur.fetchall()
-            else:
-                booster_logs = []
-
-            # Tổng hợp tiền & số lượng booster
-            current_boosters = {}
-            total_cost = 0
-            
-            for b in booster_logs:
-                b_name = b['event_name']
-                current_boosters[b_name] = current_boosters.get(b_name, 0) + 1
-                total_cost += price_map.get(b_name, 0) # Cộng dồn tiền
-
-            # 6. GHI VÀO DB (Upsert - Nếu trùng session_id thì update)
-            # Lưu boosters_used dưới dạng chuỗi JSON
-            boosters_json = json.dumps(current_boosters)
-            
-            cur.execute("""
-                INSERT INTO level_analytics 
-                (app_id, session_id, user_id, level_name, status, duration, start_time, boosters_used, total_cost, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
-                ON CONFLICT (id) DO NOTHING 
-            """, (app_id, session_id, str(user_id), str(level_id), status, duration, start_row['created_at'], boosters_json, total_cost))
-            
-            # Lưu ý: Ở trên mình dùng "ON CONFLICT (id) DO NOTHING" vì id tự tăng. 
-            # Để tránh duplicate dữ liệu chính xác, ta nên check trước:
-            
-            processed_count += 1
+        max_seen = None
+        pending = []
+        for user_uid, rows in iter_user_groups(stream):
+            last = max(r['created_at'] for r in rows)
+            if max_seen is None or last > max_seen: max_seen = last
+            pending.extend(sessionize_user(app_id, user_uid, rows, evt_start, evt_win, evt_fail, price_map))
+            if len(pending) >= ETL_WRITE_BATCH:
+                write_sessions(cur, pending)
+                processed_count += len(pending)
+                pending = []
+        stream.close()
+
+        write_sessions(cur, pending)
+        processed_count += len(pending)
+
+        # 5. Watermark = thời điểm event mới nhất đã xử lý (không bao giờ lùi), xóa rescan_from đã quét xong
+        cur.execute(SAVE_WATERMARK_SQL, (app_id, ETL_PIPELINE_NAME, max_seen, config_key, rescan_seq))
             
         conn.commit()
         print(f"✅ [ETL] Hoàn tất! Đã tổng hợp {processed_count} lượt chơi.")
@@ -189,5 +281,5 @@ def run_etl_pipeline(app_id):
         conn.rollback()
         return False
     finally:
-        cur.close()
-        conn.close()
\ No newline at end of file
+        if cur is not None: cur.close()
+        conn.close()
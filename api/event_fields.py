@@ -0,0 +1,120 @@
+import json
+import re
+
+from api.event_json import flatten_event, dumps
+
+# ==========================================
+# TRÍCH XUẤT CỘT KIỂU (TYPED COLUMNS) CHO event_logs NGAY LÚC INGEST
+# Thay vì mỗi API tự flatten event_json + regex trên từng dòng lúc query.
+# ==========================================
+
+# Thứ tự cột bổ sung (khớp với bulk_loader.EVENT_COLUMNS)
+TYPED_COLUMNS = ("level_num", "user_uid", "app_version_name", "country_iso_code", "coin_cost", "timeplay", "booster_counts")
+
+# Level: lấy key đầu tiên có giá trị số theo thứ tự ưu tiên (logic Data Check),
+# sau đó mới dò dayChallenge và cuối cùng là Regex trên JSON thô (logic V116 Dashboard)
+LEVEL_KEYS = ['level_display', 'levelID', 'missionID', 'level', 'dayChallenge']
+LEVEL_REGEX = re.compile(r'(?:levelID|level_display|missionID)[^0-9]{1,10}(\d+)')
+
+# uid / user: key cũ mà ETL level session (api/etl_processor.py) từng đọc trực tiếp từ JSON -> giữ để không mất user
+USER_KEYS = ['uuid', 'userID', 'user_id', 'device_id', 'uid', 'user']
+COIN_KEYS = ['coin_spent', 'cost', 'priceSpendLevel', 'coinCost', 'coin_cost']
+TIMEPLAY_KEYS = ['timeplay', 'timePlay', 'duration']
+
+# Giới hạn của cột INTEGER trong Postgres (chặn rác tràn số)
+_INT_MAX = 2147483647
+
+def _clean_money(val):
+    """Giống clean_money của Dashboard: bỏ ký tự tiền tệ, '1.2.3' coi như rác"""
+    if not val: return 0.0
+    s_val = str(val)
+    if s_val.count('.') > 1: return 0.0
+    try:
+        s = re.sub(r'[^\d.,-]', '', s_val)
+        return float(s) if s else 0.0
+    except: return 0.0
+
+def extract_level_num(data, raw_text=None):
+    for k in LEVEL_KEYS:
+        val = data.get(k)
+        if val is not None and str(val).isdigit():
+            num = int(val)
+            return num if num <= _INT_MAX else None
+    if raw_text:
+        match = LEVEL_REGEX.search(raw_text)
+        if match:
+            num = int(match.group(1))
+            return num if num <= _INT_MAX else None
+    return None
+
+def extract_user_uid(data):
+    for k in USER_KEYS:
+        val = data.get(k)
+        if val: return str(val)
+    return None
+
+def extract_coin_cost(event_name, data):
+    raw_coin = None
+    for k in COIN_KEYS:
+        if data.get(k):
+            raw_coin = data.get(k)
+            break
+    # Event priceSpendLevel đôi khi không có key chuẩn -> lấy giá trị số hợp lý đầu tiên
+    if not raw_coin and str(event_name or '').lower() == 'pricespendlevel':
+        for v in data.values():
+            v_c = _clean_money(v)
+            if 0 < v_c < 100000: raw_coin = v_c; break
+    if not raw_coin:
+        return None
+    try:
+        coin = int(_clean_money(raw_coin))
+        return coin if abs(coin) <= _INT_MAX else None
+    except: return None
+
+def extract_timeplay(data):
+    for k in TIMEPLAY_KEYS:
+        val = data.get(k)
+        if val:
+            try: return float(val)
+            except: return None
+    return None
+
+def extract_booster_counts(data):
+    """Giữ nguyên tên key gốc (booster_Hammer, revive_boosterClear...) để mỗi báo cáo tự map tên"""
+    counts = {}
+    for k, v in data.items():
+        if ('booster' in k or 'revive' in k) and not isinstance(v, (dict, list)):
+            s_val = str(v)
+            if s_val.lstrip('-').isdigit():
+                num = int(s_val)
+                if abs(num) <= _INT_MAX: counts[k] = num
+    return counts or None
+
+def extract_event_fields(event_name, data, raw_text=None):
+    """
+    Trả về tuple theo thứ tự TYPED_COLUMNS từ dict event đã flatten.
+    raw_text: chuỗi JSON thô (dùng cho Regex fallback tìm level).
+    """
+    if not isinstance(data, dict):
+        data = {}
+    boosters = extract_booster_counts(data)
+    version = data.get('app_version_name')
+    geo = data.get('country_iso_code')
+    return (
+        extract_level_num(data, raw_text),
+        extract_user_uid(data),
+        str(version) if version else None,
+        str(geo) if geo else None,
+        extract_coin_cost(event_name, data),
+        extract_timeplay(data),
+        json.dumps(boosters) if boosters else None,
+    )
+
+def extract_event_fields_from_json(event_name, event_json):
+    """Giống extract_event_fields nhưng nhận chuỗi event_json đã lưu trong DB (tự parse & gộp lớp lồng)"""
+    raw_text = event_json if isinstance(event_json, str) else None
+    data = flatten_event(event_json)
+    if raw_text is None:
+        try: raw_text = dumps(event_json)
+        except: raw_text = None
+    return extract_event_fields(event_name, data, raw_text)
@@ -0,0 +1,131 @@
+import json
+
+try:
+    import orjson # Tùy chọn: parse/dump nhanh hơn json chuẩn 3-5 lần
+except ImportError:
+    orjson = None
+
+# ==========================================
+# BỘ GIẢI / LÀM PHẲNG event_json DÙNG CHUNG (INGEST + CÁC API ĐỌC)
+# Thay cho 4 hàm cũ universal_flatten / smart_parse_json / recursive_json_unpack / strict_flatten_event
+# và các đoạn json.loads tự chế trong từng endpoint.
+# - loads/dumps: dùng orjson nếu có, không có thì về json chuẩn.
+# - Chuỗi bị encode nhiều lớp ("\"{...}\"") được giải liên tiếp trong 1 lượt, mỗi lớp parse đúng 1 lần.
+# - Cách gộp các key lồng nhau (event_json / params / data / attributes) do FlattenPolicy quyết định.
+# ==========================================
+
+NESTED_KEYS = ('event_json', 'params', 'data', 'attributes')
+
+# Số lớp encode tối đa còn cố giải (chặn chuỗi lỗi lặp vô hạn)
+MAX_ENCODE_DEPTH = 4
+
+_BACKEND = 'orjson' if orjson is not None else 'json'
+
+def set_json_backend(name):
+    """'orjson' | 'json' (benchmark / debug). Trả về backend đang dùng."""
+    global _BACKEND
+    _BACKEND = 'orjson' if name == 'orjson' and orjson is not None else 'json'
+    return _BACKEND
+
+def get_json_backend():
+    return _BACKEND
+
+def loads(text):
+    if _BACKEND == 'orjson':
+        try: return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson chặt hơn json chuẩn (NaN, số nguyên > 64 bit...) -> thử lại bằng json chuẩn
+            return json.loads(text)
+    return json.loads(text)
+
+def dumps(value):
+    """Chuỗi JSON giữ nguyên Unicode (tương đương json.dumps(..., ensure_ascii=False))"""
+    if _BACKEND == 'orjson':
+        try: return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError: pass # Kiểu orjson không hỗ trợ -> json chuẩn
+    return json.dumps(value, ensure_ascii=False)
+
+
+class FlattenPolicy:
+    """
+    Cách làm phẳng 1 event:
+    - nested_keys: các key có thể chứa JSON lồng (chuỗi hoặc dict) cần gộp ra ngoài
+    - drop_nested: gộp xong thì xóa key vỏ
+    - deep: giải mọi chuỗi trông giống JSON ở mọi tầng (dict / list)
+    - strict: key lồng chứa chuỗi '{...' hỏng -> raise ValueError thay vì bỏ qua
+    """
+
+    def __init__(self, nested_keys=NESTED_KEYS, drop_nested=False, deep=False, strict=False):
+        self.nested_keys = tuple(nested_keys)
+        self.drop_nested = drop_nested
+        self.deep = deep
+        self.strict = strict
+
+# Các API đọc: gộp lớp lồng, giữ key vỏ, dữ liệu hỏng thì bỏ qua
+READ_POLICY = FlattenPolicy()
+# Ingest: giải sâu, gộp + xóa vỏ, JSON lồng hỏng thì báo lỗi (caller giữ event gốc)
+INGEST_POLICY = FlattenPolicy(drop_nested=True, deep=True, strict=True)
+# Chỉ parse thành dict, không gộp gì (Export giữ nguyên cấu trúc)
+RAW_POLICY = FlattenPolicy(nested_keys=())
+
+def decode_json(value, strict=False):
+    """
+    Giải 1 chuỗi JSON, kể cả khi bị encode nhiều lớp. Giá trị không phải chuỗi JSON trả về nguyên trạng.
+    strict: chuỗi '{...' không parse được -> raise ValueError.
+    """
+    for _ in range(MAX_ENCODE_DEPTH):
+        if not isinstance(value, str):
+            return value
+        stripped = value.strip()
+        if not stripped or stripped[0] not in '{["':
+            return value
+        try:
+            value = loads(stripped)
+        except ValueError:
+            if strict and stripped[0] == '{': raise
+            return value
+    return value
+
+def unpack_deep(value):
+    """Giải đệ quy mọi chuỗi dạng {...} / [...] trong dict / list; chuỗi hỏng giữ nguyên"""
+    if isinstance(value, dict):
+        return {k: unpack_deep(v) if isinstance(v, (str, dict, list)) else v for k, v in value.items()}
+    if isinstance(value, str):
+        stripped = value.strip()
+        if stripped and ((stripped[0] == '{' and stripped[-1] == '}') or (stripped[0] == '[' and stripped[-1] == ']')):
+            try: return unpack_deep(loads(stripped))
+            except ValueError: return value
+        return value
+    if isinstance(value, list):
+        return [unpack_deep(item) for item in value]
+    return value
+
+def flatten_event(raw, policy=READ_POLICY):
+    """
+    event_json (chuỗi / bytes / dict) -> dict phẳng theo policy. Không parse được -> {}.
+    Không sửa dict đầu vào.
+    """
+    if not raw: return {}
+    if isinstance(raw, (bytes, bytearray, memoryview)):
+        raw = bytes(raw).decode('utf-8', errors='replace')
+    if isinstance(raw, str):
+        try: data = decode_json(raw)
+        except ValueError: return {}
+    else:
+        data = raw
+    if not isinstance(data, dict): return {}
+
+    data = unpack_deep(data) if policy.deep else dict(data)
+
+    for key in policy.nested_keys:
+        if key not in data: continue
+        inner = data[key]
+        if isinstance(inner, str):
+            try: inner = decode_json(inner, strict=policy.strict)
+            except ValueError as e:
+                raise ValueError(f"❌ STRICT MERGE FAIL: Key '{key}' contains invalid JSON. Error: {e}")
+        if isinstance(inner, dict):
+            # Dữ liệu lớp trong đè lên lớp ngoài nếu trùng tên
+            data.update(inner)
+            if policy.drop_nested: data.pop(key, None)
+    return data
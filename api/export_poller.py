@@ -0,0 +1,184 @@
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==========================================
+# BỘ CHỜ EXPORT APPMETRICA (HTTP 202) BẰNG ASYNCIO
+# Trước đây mỗi export đang chuẩn bị (202) giữ nguyên 1 worker thread trong stop_event.wait(180) tới 18 lần (~54 phút)
+# -> 3 app chậm là chặn hết ingest của các app khác.
+# Giờ: worker gửi request đầu tiên, gặp 202 thì gửi job sang ExportPoller rồi nhả slot đi làm job khác.
+# - Mỗi export chờ = 1 coroutine (rẻ), tự hẹn giờ hỏi lại (next poll) -> 1 process theo dõi được hàng trăm export.
+# - Request hỏi lại chạy trong pool nhỏ EXPORT_PROBE_WORKERS (requests là thư viện blocking).
+# - Chỉ export đã có hàng (không còn 202) mới được giao cho pool tải & parse EXPORT_DOWNLOAD_WORKERS.
+# - Trước mỗi lượt hỏi lại, export lấy lại slot job (toàn hệ thống / app / token, api/job_queue.py) như lúc worker nhận job;
+#   còn 202 thì nhả slot, có hàng thì giữ slot tới khi ghi DB xong -> MAX_RUNNING_JOBS / MAX_JOBS_PER_APP vẫn chặn ingest.
+# ==========================================
+
+EXPORT_POLLER_ENABLED = os.getenv("EXPORT_POLLER_ENABLED", "1") == "1"
+EXPORT_POLL_INTERVAL = float(os.getenv("EXPORT_POLL_INTERVAL", "180"))
+EXPORT_POLL_MAX_ATTEMPTS = int(os.getenv("EXPORT_POLL_MAX_ATTEMPTS", "18"))
+EXPORT_PROBE_WORKERS = int(os.getenv("EXPORT_PROBE_WORKERS", "8"))
+EXPORT_DOWNLOAD_WORKERS = int(os.getenv("EXPORT_DOWNLOAD_WORKERS", "3"))
+# Export đang chờ kiểm tra lệnh STOP mỗi bao nhiêu giây (trong lúc chờ tới lượt hỏi lại)
+EXPORT_CANCEL_CHECK_SECONDS = float(os.getenv("EXPORT_CANCEL_CHECK_SECONDS", "15"))
+
+
+class ParkedExport:
+    """
+    1 export đang chờ AppMetrica chuẩn bị dữ liệu. Các hàm callback đều là hàm blocking (chạy trong thread pool):
+    - probe(): gửi lại request export, trả về response (stream)
+    - on_response(response, attempt): xử lý response (202 -> ghi log chờ; 200 -> tải & ghi DB; lỗi -> Failed)
+    - on_error(exc, attempt): request lỗi mạng (sẽ hỏi lại ở lượt sau)
+    - on_timeout(): hết max_attempts lượt vẫn 202
+    - on_cancel(): job bị STOP trong lúc chờ
+    - on_finish(): dọn dẹp sau cùng (luôn được gọi đúng 1 lần)
+    - is_cancelled(): đã có lệnh STOP chưa
+    - acquire_slots(): lấy slot job trước lượt hỏi lại, False nếu chưa có chỗ (không truyền = không cần slot)
+    - release_slots(): nhả slot đã lấy
+    """
+
+    def __init__(self, key, probe, on_response, on_error, on_timeout, on_cancel, on_finish, is_cancelled,
+                 attempt=1, max_attempts=EXPORT_POLL_MAX_ATTEMPTS, interval=EXPORT_POLL_INTERVAL,
+                 acquire_slots=None, release_slots=None):
+        self.key = key
+        self.probe = probe
+        self.on_response = on_response
+        self.on_error = on_error
+        self.on_timeout = on_timeout
+        self.on_cancel = on_cancel
+        self.on_finish = on_finish
+        self.is_cancelled = is_cancelled
+        self.attempt = attempt
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self.acquire_slots = acquire_slots
+        self.release_slots = release_slots
+
+
+class ExportPoller:
+    """Event loop asyncio chạy trên 1 thread nền của process; park() gọi được từ bất kỳ thread nào"""
+
+    def __init__(self, probe_workers=EXPORT_PROBE_WORKERS, download_workers=EXPORT_DOWNLOAD_WORKERS,
+                 cancel_check_seconds=EXPORT_CANCEL_CHECK_SECONDS):
+        self.probe_pool = ThreadPoolExecutor(max_workers=probe_workers, thread_name_prefix="export-probe")
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="export-download")
+        self.cancel_check_seconds = cancel_check_seconds
+        self.loop = asyncio.new_event_loop()
+        self.pending = {}
+        self.downloading = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run_loop, name="export-poller", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def park(self, export):
+        """Giao 1 export đang 202 cho poller (lượt hỏi lại đầu tiên sau export.interval giây)"""
+        with self._lock:
+            self.pending[export.key] = export
+        asyncio.run_coroutine_threadsafe(self._watch(export), self.loop)
+
+    def stats(self):
+        with self._lock:
+            return {"waiting": len(self.pending) - self.downloading, "downloading": self.downloading}
+
+    async def _call(self, pool, fn, *args):
+        return await self.loop.run_in_executor(pool, fn, *args)
+
+    async def _sleep_or_cancel(self, export, seconds):
+        """Ngủ tới lượt hỏi lại; True nếu job bị STOP trong lúc ngủ"""
+        deadline = self.loop.time() + seconds
+        while True:
+            if await self._call(self.probe_pool, export.is_cancelled):
+                return True
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(remaining, self.cancel_check_seconds))
+
+    async def _wait_slots(self, export):
+        """Chờ tới khi lấy được slot job (thử lại mỗi cancel_check_seconds); False nếu job bị STOP trong lúc chờ"""
+        if export.acquire_slots is None: return True
+        while not await self._call(self.probe_pool, export.acquire_slots):
+            if await self._sleep_or_cancel(export, self.cancel_check_seconds):
+                return False
+        return True
+
+    async def _release_slots(self, export):
+        if export.release_slots is not None:
+            await self._call(self.probe_pool, export.release_slots)
+
+    async def _watch(self, export):
+        holding = False
+        try:
+            while True:
+                if await self._sleep_or_cancel(export, export.interval):
+                    await self._call(self.probe_pool, export.on_cancel)
+                    return
+                if export.attempt >= export.max_attempts:
+                    await self._call(self.probe_pool, export.on_timeout)
+                    return
+                # Lượt hỏi lại có thể trả hàng ngay -> phải có slot trước khi gửi request
+                if not await self._wait_slots(export):
+                    await self._call(self.probe_pool, export.on_cancel)
+                    return
+                holding = True
+                export.attempt += 1
+                try:
+                    response = await self._call(self.probe_pool, export.probe)
+                except Exception as e:
+                    holding = False
+                    await self._release_slots(export)
+                    await self._call(self.probe_pool, export.on_error, e, export.attempt)
+                    continue
+
+                if response.status_code == 202:
+                    holding = False
+                    await self._release_slots(export)
+                    try: await self._call(self.probe_pool, export.on_response, response, export.attempt)
+                    finally: response.close()
+                    continue
+
+                # Có hàng (hoặc lỗi hẳn): nhường pool tải & parse, coroutine chỉ chờ kết quả
+                with self._lock:
+                    self.downloading += 1
+                try:
+                    await self._call(self.download_pool, export.on_response, response, export.attempt)
+                finally:
+                    response.close()
+                    with self._lock:
+                        self.downloading -= 1
+                return
+        except Exception as e:
+            print(f"❌ Export Poller Error [{export.key}]: {e}")
+        finally:
+            with self._lock:
+                self.pending.pop(export.key, None)
+            try: await self._call(self.probe_pool, export.on_finish)
+            except Exception as e: print(f"⚠️ Export Poller Finish Error [{export.key}]: {e}")
+            # Như worker: nhả slot sau khi job đã chốt xong (kể cả gom job cha backfill)
+            if holding:
+                try: await self._release_slots(export)
+                except Exception as e: print(f"⚠️ Export Poller Slot Error [{export.key}]: {e}")
+
+
+_POLLER = None
+_POLLER_LOCK = threading.Lock()
+
+def get_export_poller():
+    """Poller dùng chung của process (tạo lần đầu khi có export cần chờ)"""
+    global _POLLER
+    with _POLLER_LOCK:
+        if _POLLER is None:
+            _POLLER = ExportPoller()
+        return _POLLER
+
+def export_poller_stats():
+    return _POLLER.stats() if _POLLER is not None else {"waiting": 0, "downloading": 0}
@@ -0,0 +1,115 @@
+import os
+import gzip
+import time
+import tempfile
+import threading
+
+from dotenv import load_dotenv
+
+from api.event_json import loads, dumps
+
+load_dotenv()
+
+# ==========================================
+# SPOOL EXPORT APPMETRICA RA ĐĨA (NDJSON NÉN GZIP) ĐỂ CHẠY LẠI KHÔNG PHẢI TẢI LẠI
+# Trước đây download 600s hoặc INSERT Postgres lỗi giữa chừng -> Retry phải xin lại cả cửa sổ từ AppMetrica.
+# - Có hàng (200): tải hết vào <EXPORT_SPOOL_DIR>/job_<id>.ndjson.gz (ghi ra .part, xong mới đổi tên -> file hoàn chỉnh)
+#   rồi mới đọc lại từ file để ghi DB.
+# - Mỗi lô ghi DB cập nhật job_history.spool_committed trong CÙNG transaction -> mốc đã commit luôn khớp dữ liệu.
+# - Retry (run_type = 'retry') của job Failed nhận lại file spool của job cũ và chạy tiếp từ mốc đó, không gọi AppMetrica.
+# - Job Success xóa spool ngay (Retry job Success phải xin dữ liệu mới); xóa lịch sử / purge / xóa app cũng xóa spool.
+# - File còn sót quá EXPORT_SPOOL_RETENTION_HOURS giờ (và .part bỏ dở) bị dọn.
+# ==========================================
+
+EXPORT_SPOOL_ENABLED = os.getenv("EXPORT_SPOOL_ENABLED", "1") == "1"
+EXPORT_SPOOL_DIR = os.getenv("EXPORT_SPOOL_DIR") or os.path.join(tempfile.gettempdir(), "appmetrica_spool")
+EXPORT_SPOOL_RETENTION_HOURS = float(os.getenv("EXPORT_SPOOL_RETENTION_HOURS", "72"))
+
+# Nén nhẹ: đủ giảm ~10 lần dung lượng JSON mà không làm chậm download
+SPOOL_GZIP_LEVEL = 3
+# Dọn file hết hạn tối đa 1 lần / bấy nhiêu giây
+PURGE_INTERVAL_SECONDS = 3600
+
+_last_purge = 0
+_purge_lock = threading.Lock()
+
+def spool_path(job_id):
+    return os.path.join(EXPORT_SPOOL_DIR, f"job_{job_id}.ndjson.gz")
+
+def has_spool(job_id):
+    return os.path.exists(spool_path(job_id))
+
+def write_spool(job_id, events, stop_event=None):
+    """
+    Ghi toàn bộ events (iterator dict) vào spool của job. Trả về số event, hoặc None nếu bị STOP giữa chừng
+    (file dở bị xóa). Lỗi giữa chừng cũng xóa file dở rồi raise.
+    """
+    purge_expired_spools()
+    os.makedirs(EXPORT_SPOOL_DIR, exist_ok=True)
+    path = spool_path(job_id)
+    part = path + ".part"
+    count = 0
+    try:
+        with gzip.open(part, 'wb', compresslevel=SPOOL_GZIP_LEVEL) as f:
+            for event in events:
+                if stop_event is not None and count % 1000 == 0 and stop_event.is_set():
+                    break
+                f.write(dumps(event).encode('utf-8'))
+                f.write(b"\n")
+                count += 1
+            else:
+                f.close()
+                os.replace(part, path)
+                return count
+    except BaseException:
+        _remove(part)
+        raise
+    _remove(part)
+    return None
+
+def iter_spool(job_id):
+    """Đọc lại từng event (dict) trong spool của job"""
+    with gzip.open(spool_path(job_id), 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+def adopt_spool(old_job_id, new_job_id):
+    """Job retry nhận file spool của job cũ (đổi tên theo id mới). True nếu có file để nhận"""
+    src = spool_path(old_job_id)
+    if not os.path.exists(src): return False
+    try:
+        os.replace(src, spool_path(new_job_id))
+        return True
+    except OSError as e:
+        print(f"⚠️ Spool Adopt Error: {e}")
+        return False
+
+def remove_spool(job_id):
+    _remove(spool_path(job_id))
+
+def purge_expired_spools(retention_hours=EXPORT_SPOOL_RETENTION_HOURS, force=False):
+    """Xóa spool / .part cũ hơn retention_hours. Trả về số file đã xóa"""
+    global _last_purge
+    now = time.time()
+    with _purge_lock:
+        if not force and now - _last_purge < PURGE_INTERVAL_SECONDS: return 0
+        _last_purge = now
+    if not os.path.isdir(EXPORT_SPOOL_DIR): return 0
+    removed = 0
+    cutoff = now - retention_hours * 3600
+    for name in os.listdir(EXPORT_SPOOL_DIR):
+        if not name.startswith("job_"): continue
+        path = os.path.join(EXPORT_SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    if removed: print(f"🧹 Spool: đã xóa {removed} file quá {retention_hours:g}h")
+    return removed
+
+def _remove(path):
+    try: os.remove(path)
+    except OSError: pass
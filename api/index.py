@@ -3,11 +3,30 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from api.etl_processor import run_etl_pipeline
+from api.stream_parser import iter_export_events, iter_batches
+from api.bulk_loader import bulk_upsert_events
+from api.event_fields import extract_event_fields
+from api.event_json import flatten_event, dumps as dumps_json, INGEST_POLICY, RAW_POLICY
+from api.level_rollup import START_EVENTS, WIN_EVENTS, touched_cells, range_touched_cells, refresh_level_daily_stats
+from api.user_bitmap import decode_bitmap, bitmap_count, iter_bitmap_indexes
+from api.schema import ensure_schema
+from api.partitions import drop_app_partition
+from api.vn_time import created_at_filter
+from api.keyset import keyset_query_parts, keyset_page, CursorError
+from api.response_cache import cached_response, bump_app_data_version
+from api.db_pool import get_pooled_connection, pool_stats
+from api.db_stream import stream_rows
+from api.job_log import append_job_log, flush_job_logs, fetch_job_logs
+from api.backfill import plan_windows, create_backfill_jobs, mark_parent_started, cancel_children, retry_children, rollup_parent, progress_pct
+from api.export_poller import ParkedExport, get_export_poller, export_poller_stats, EXPORT_POLLER_ENABLED, EXPORT_POLL_INTERVAL, EXPORT_POLL_MAX_ATTEMPTS
+from api.token_budget import record_rate_limit, record_token_success, RATE_LIMIT_MAX_RESCHEDULES
+from api.export_spool import write_spool, iter_spool, has_spool, adopt_spool, remove_spool, spool_path, EXPORT_SPOOL_ENABLED
+from api.job_queue import claim_next_job, notify_job_created, JobListener, JobSlots, JobStopSignal, WORKER_IDLE_SECONDS
 from flask import Flask, jsonify, request, send_file
 from flask_cors import CORS
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import json
 from datetime import datetime, timedelta, timezone
 import time
@@ -52,6 +71,9 @@ DB_PASS = os.getenv("DB_PASS")
 if not DB_PASS:
     print("⚠️  CẢNH BÁO: Chưa tìm thấy DB_PASS trong file .env")
 
+# Số event mỗi lô khi stream file export vào DB (giữ RAM ổn định với job lớn)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "5000"))
+
 # --- QUẢN LÝ TRẠNG THÁI ĐA LUỒNG (PARALLEL MODE) ---
 # Thay vì khóa cả hệ thống, chỉ khóa từng App ID đang chạy
 RUNNING_APPS = set()
@@ -95,118 +117,6 @@ def parse_date_param(date_str):
         # Nếu đã là YYYY-MM-DD thì giữ nguyên
         return str(date_str)
 
-# --- [NEW] HÀM GIẢI PHÓNG DỮ LIỆU (FLATTEN & MERGE) ---
-def strict_flatten_event(data):
-    """
-    1. Tìm các key chứa JSON string (như 'event_json', 'params').
-    2. Parse chúng ra.
-    3. Gộp (Merge) vào object cha.
-    4. Xóa key gốc.
-    5. Nếu lỗi -> Ném Exception để Fail Job.
-    """
-    # Danh sách các key thường chứa dữ liệu lồng nhau
-    nested_keys_to_explode = ['event_json', 'params', 'data', 'attributes']
-    
-    # Copy để tránh ảnh hưởng biến gốc khi đang loop
-    result = data.copy() if isinstance(data, dict) else {}
-    
-    for key in nested_keys_to_explode:
-        if key in result:
-            raw_value = result[key]
-            
-            # Chỉ xử lý nếu nó là String (cần parse) hoặc Dict (cần gộp)
-            inner_data = None
-            
-            if isinstance(raw_value, str):
-                # Thử Parse Strict
-                if raw_value.strip().startswith('{'):
-                    try:
-                        inner_data = json.loads(raw_value)
-                    except Exception as e:
-                        raise ValueError(f"❌ STRICT MERGE FAIL: Key '{key}' contains invalid JSON. Error: {e}")
-            elif isinstance(raw_value, dict):
-                inner_data = raw_value
-            
-            # Nếu đã lấy được ruột, tiến hành Gộp và Xóa vỏ
-            if isinstance(inner_data, dict):
-                # 1. Gộp vào cha (Update) - Dữ liệu con sẽ đè lên cha nếu trùng tên (thường là mới hơn)
-                result.update(inner_data)
-                # 2. Xóa key lồng nhau đi (theo yêu cầu sếp)
-                del result[key]
-            
-            # Nếu là string nhưng không phải JSON object (vd: "some text"), giữ nguyên hoặc xử lý tùy ý
-            # Ở đây ta giữ nguyên nếu không parse được thành dict
-
-    return result
-
-# --- [UPDATED HELPER] GIẢI NÉN JSON TẦNG SÂU (SAFE MODE) ---
-def recursive_json_unpack(data):
-    """
-    Hàm đệ quy thông minh:
-    - Cố gắng biến String JSON -> Object/List.
-    - NẾU LỖI: Trả về nguyên gốc (String) thay vì làm sập Job.
-    """
-    # 1. Nếu là String: Thử giải nén, nếu thất bại thì thôi
-    if isinstance(data, str):
-        stripped = data.strip()
-        # Chỉ thử parse nếu trông nó giống JSON
-        if (stripped.startswith('{') and stripped.endswith('}')) or \
-           (stripped.startswith('[') and stripped.endswith(']')):
-            try:
-                parsed = json.loads(stripped)
-                # Đệ quy tiếp vào bên trong (đề phòng lồng nhiều lớp)
-                return recursive_json_unpack(parsed)
-            except:
-                # 🛑 QUAN TRỌNG: Nếu lỗi parse, TRẢ VỀ NGUYÊN GỐC (không raise lỗi)
-                return data
-        return data
-
-    # 2. Nếu là Dict: Quét từng key
-    if isinstance(data, dict):
-        return {k: recursive_json_unpack(v) for k, v in data.items()}
-
-    # 3. Nếu là List: Quét từng phần tử
-    if isinstance(data, list):
-        return [recursive_json_unpack(item) for item in data]
-
-    # Các kiểu khác (int, float, None...) giữ nguyên
-    return data
-
-def universal_flatten(raw_input):
-    """
-    Hàm V95: Khoan sâu vào mọi ngóc ngách của JSON (Hỗ trợ n lớp lồng nhau).
-    Trả về: Một dictionary phẳng chứa tất cả thông tin.
-    """
-    if not raw_input: return {}
-    
-    data = {}
-    # Lớp 1: Parse từ DB (thường là string hoặc dict)
-    try:
-        if isinstance(raw_input, str):
-            data = json.loads(raw_input)
-        elif isinstance(raw_input, dict):
-            data = raw_input.copy()
-    except: return {}
-
-    # Lớp 2: Kiểm tra các key chứa JSON lồng nhau thường gặp
-    # Game 2 thường nhét dữ liệu vào key 'event_json' hoặc 'params'
-    nested_keys = ['event_json', 'params', 'data', 'attributes']
-    
-    for key in nested_keys:
-        if key in data and isinstance(data[key], str):
-            try:
-                inner = json.loads(data[key])
-                if isinstance(inner, dict):
-                    data.update(inner) # Gộp dữ liệu con ra ngoài
-            except: pass
-            
-    # Lớp 3: Xử lý Double Encode (Trường hợp chuỗi bị mã hóa 2 lần)
-    if isinstance(data, str): 
-        try: data = json.loads(data)
-        except: pass
-        
-    return data if isinstance(data, dict) else {}
-
 def get_app_config(cur, app_id):
     """
     Hàm lấy cấu hình động từ Database.
@@ -250,43 +160,13 @@ def get_app_config(cur, app_id):
         }
     }
 
-def smart_parse_json(raw_input):
+def get_db():
     """
-    Hàm thông minh để xử lý trường hợp JSON bị lồng 2 lớp.
-    Ví dụ: "{\"event_json\": \"{\\\"levelID\\\": 1...}\"}"
+    Mượn connection từ pool dùng chung của process (api/db_pool.py).
+    conn.close() sẽ trả connection về pool thay vì đóng hẳn -> không tốn handshake TLS/auth mỗi request.
     """
-    if not raw_input: 
-        return {}
-    
-    try:
-        # Lớp 1: Nếu là string thì parse ra dict, nếu là dict rồi thì giữ nguyên
-        parsed_data = json.loads(raw_input) if isinstance(raw_input, str) else raw_input
-        
-        # Lớp 2: Kiểm tra xem bên trong có key 'event_json' chứa string JSON nữa không (Lỗi double encode)
-        if isinstance(parsed_data, dict) and 'event_json' in parsed_data:
-            inner_value = parsed_data['event_json']
-            if isinstance(inner_value, str):
-                try:
-                    inner_json = json.loads(inner_value)
-                    # Gộp dữ liệu bên trong ra ngoài (Flatten)
-                    parsed_data.update(inner_json)
-                except:
-                    pass # Nếu không parse được lớp trong thì thôi
-                    
-        return parsed_data
-    except Exception:
-        return {}
-
-def get_db():
     try:
-        conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASS') or os.getenv('DB_PASSWORD'),
-            port=os.getenv('DB_PORT')
-        )
-        return conn
+        return get_pooled_connection()
     except Exception as e:
         print(f"❌ DB Connection Error: {e}")
         return None
@@ -315,6 +195,7 @@ def create_etl_job(app_id, run_type, scheduled_time, date_since, date_until):
             INSERT INTO job_history (app_id, run_type, scheduled_time, status, created_at, date_since, date_until)
             VALUES (%s, %s, %s, 'pending', NOW(), %s, %s) RETURNING id
         """, (app_id, run_type, scheduled_time, date_since, date_until))
+        notify_job_created(cur, cur.fetchone()[0]) # Đánh thức worker đang rảnh
         
         conn.commit()
         print(f"🎫 {run_type.capitalize()}: Đã tạo vé Job cho App {app_id} (Window: {date_since} -> {date_until})")
@@ -343,43 +224,38 @@ def update_job_status(job_id, status, message=None, inc_retry=False):
 # ==========================================
 # --- HÀM PHỤ TRỢ: GHI LOG VÀO DB ---
 def append_log_to_db(hist_id, new_log_line):
-    """Nối thêm log vào dòng lịch sử đang chạy"""   
-    if not hist_id: return
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        # Dùng toán tử || để nối chuỗi trong PostgreSQL
-        timestamp = datetime.now().strftime('%H:%M:%S')
-        log_entry = f"\n[{timestamp}] {new_log_line}"
-        
-        cur.execute("""
-            UPDATE job_history 
-            SET logs = COALESCE(logs, '') || %s, updated_at = NOW()
-            WHERE id = %s
-        """, (log_entry, hist_id))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"❌ Error appending log: {e}")
-
-def transform_events_to_level_analytics(app_id, events):
     """
-    [UPDATED] Transform missionStart / missionComplete / missionFail
-    Sử dụng smart_parse_json để xử lý lỗi lồng JSON.
+    Nối thêm log vào job đang chạy.
+    Dòng log được đệm trong RAM rồi ghi theo lô vào bảng job_log_lines (api/job_log.py),
+    không còn UPDATE job_history.logs mỗi dòng.
     """
-    if not events:
-        return
+    if not hist_id: return
+    append_job_log(hist_id, new_log_line)
 
-    conn = get_db()
-    cur = conn.cursor()
+# Event kết thúc lượt chơi -> trạng thái session
+SESSION_END_STATUS = {"missionComplete": "WIN", "missionFail": "FAIL"}
 
-    # 1. Gom event theo (user_id, level_id)
-    sessions = {}
+def session_booster_cost(raw_json):
+    """Tổng số booster / revive dùng trong 1 event kết thúc (quét key 1 lần)"""
+    total = 0
+    for k, v in raw_json.items():
+        if k.startswith(("booster_", "revive_")):
+            try: total += int(v)
+            except: pass
+    return total
+
+def collect_level_sessions(app_id, events, sessions=None):
+    """
+    Gom missionStart / missionComplete / missionFail theo (user_id, level_id).
+    Có thể gọi nhiều lần cho từng lô event (streaming) với cùng 1 dict sessions.
+    """
+    if sessions is None:
+        sessions = {}
 
     for e in events:
         try:
             event_name = e.get("event_name")
-            raw_json = smart_parse_json(e.get("event_json"))
+            raw_json = flatten_event(e.get("event_json"))
             level_id = (raw_json.get("levelID") or 
                         raw_json.get("missionID") or 
                         raw_json.get("level_display") or 
@@ -413,54 +289,101 @@ def transform_events_to_level_analytics(app_id, events):
             if event_name == "missionStart":
                 s["start_time"] = ts
 
-            elif event_name == "missionComplete":
-                s["end_time"] = ts
-                s["status"] = "WIN"
-                for k, v in raw_json.items():
-                    if k.startswith("booster_") or k.startswith("revive_"):
-                        try: s["total_cost"] += int(v)
-                        except: pass
-
-            elif event_name == "missionFail":
+            elif event_name in SESSION_END_STATUS:
                 s["end_time"] = ts
-                s["status"] = "FAIL"
-                for k, v in raw_json.items():
-                    if k.startswith("booster_") or k.startswith("revive_"):
-                        try: s["total_cost"] += int(v)
-                        except: pass
+                s["status"] = SESSION_END_STATUS[event_name]
+                s["total_cost"] += session_booster_cost(raw_json)
 
         except Exception as ex:
             print(f"Transform error skipping row: {ex}")
 
-    # 2. Insert vào level_analytics
+    return sessions
+
+# Upsert theo (app_id, session_id): chạy lại cùng khoảng dữ liệu không nhân bản dòng.
+# Session bị cắt giữa 2 job (Start ở job trước, Win/Fail ở job sau) được ghép lại:
+# dòng mới chỉ có Start (DROP) không đè kết quả đã có, Start đã lưu được giữ nếu dòng mới thiếu.
+UPSERT_LEVEL_SESSIONS_SQL = """
+    INSERT INTO level_analytics
+    (app_id, session_id, user_id, level_name, status, duration, start_time, total_cost, created_at)
+    VALUES %s
+    ON CONFLICT (app_id, session_id) DO UPDATE SET
+        status = CASE WHEN EXCLUDED.status = 'DROP' THEN level_analytics.status ELSE EXCLUDED.status END,
+        total_cost = CASE WHEN EXCLUDED.status = 'DROP' THEN level_analytics.total_cost ELSE EXCLUDED.total_cost END,
+        duration = CASE WHEN EXCLUDED.duration > 0 THEN EXCLUDED.duration ELSE level_analytics.duration END,
+        start_time = COALESCE(EXCLUDED.start_time, level_analytics.start_time)
+"""
+
+def save_level_sessions(sessions):
+    """Ghi các session đã gom vào bảng level_analytics (1 lệnh upsert cho mỗi 1000 session)"""
+    if not sessions:
+        return
+
+    rows = []
     for s in sessions.values():
         start_time = s["start_time"]
         end_time = s["end_time"]
         duration = 0
         if start_time and end_time:
             duration = int((end_time - start_time).total_seconds())
+        rows.append((
+            s["app_id"],
+            f"{s['user_id']}_{s['level_id']}",
+            s["user_id"],
+            f"Level {s['level_id']}", # Format tên Level đẹp hơn
+            s["status"],
+            duration,
+            start_time,
+            s["total_cost"]
+        ))
 
-        # Chỉ insert nếu có dữ liệu hợp lệ (Tránh rác)
-        try:
-            cur.execute("""
-                INSERT INTO level_analytics
-                (app_id, session_id, user_id, level_name, status, duration, start_time, total_cost, created_at)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,NOW())
-            """, (
-                s["app_id"],
-                f"{s['user_id']}_{s['level_id']}",
-                s["user_id"],
-                f"Level {s['level_id']}", # Format tên Level đẹp hơn
-                s["status"],
-                duration,
-                start_time,
-                s["total_cost"]
-            ))
-        except Exception as insert_err:
-            print(f"Insert Analytics Error: {insert_err}")
-
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        execute_values(cur, UPSERT_LEVEL_SESSIONS_SQL, rows,
+                       template="(%s, %s, %s, %s, %s, %s, %s, %s, NOW())", page_size=1000)
+        conn.commit()
+    except Exception as insert_err:
+        conn.rollback()
+        print(f"Insert Analytics Error: {insert_err}")
+    finally:
+        cur.close()
+        conn.close()
+
+def update_level_rollup(app_id, cells=None, rows=None):
+    """
+    Tính lại rollup level_daily_stats cho các ô (ngày VN, level) vừa có dữ liệu mới.
+    cells: set (ngày, level) đã gom sẵn lúc ingest;
+    rows: các dòng vừa ghi (dòng 8 cột chưa có level -> dò theo khoảng created_at trong DB).
+    """
+    conn = get_db()
+    if not conn: return 0
+    try:
+        if cells is None:
+            cells = set()
+            if rows:
+                cells = touched_cells(rows)
+                short_rows = [r for r in rows if len(r) <= 8 and r[4] is not None]
+                if short_rows:
+                    cur = conn.cursor()
+                    cells |= range_touched_cells(cur, app_id, min(r[4] for r in short_rows), max(r[4] for r in short_rows))
+                    cur.close()
+        n = refresh_level_daily_stats(conn, app_id, cells)
+        conn.commit()
+        return n
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️ Rollup Error: {e}")
+        return 0
+    finally: conn.close()
+
+def transform_events_to_level_analytics(app_id, events):
+    """
+    [UPDATED] Transform missionStart / missionComplete / missionFail
+    Dùng flatten_event (api/event_json.py) để xử lý lỗi lồng JSON.
+    """
+    if not events:
+        return
+    save_level_sessions(collect_level_sessions(app_id, events))
 
 def execute_job_logic(job_id, app_id, retry_count, run_type, retry_job_id):
     """
@@ -586,30 +509,30 @@ def execute_job_logic(job_id, app_id, retry_count, run_type, retry_job_id):
                     log(f"✅ Downloaded {count} events. Saving...")
                     log(f"🕵️‍♂️ [DEBUG] AppMetrica gửi về: {count} events (Raw).")
                     
-                    conn_ins = get_db(); cur_ins = conn_ins.cursor()
+                    conn_ins = get_db()
                     vals = []
                     for e in events:
                         evt_json = json.dumps(e)
                         try: ts = datetime.fromtimestamp(int(e.get('event_timestamp')))
                         except: ts = datetime.now()
-                        vals.append((app_id, e.get('event_name'), evt_json, 1, ts, hist_id))
+                        # Không có uuid/raw_timestamp -> bulk loader giữ nguyên kiểu INSERT thường (không gộp trùng)
+                        vals.append((app_id, e.get('event_name'), evt_json, 1, ts, hist_id, None, None))
                     
                     if vals:
-                        cur_ins.executemany("""
-                        INSERT INTO event_logs (app_id, event_name, event_json, count, created_at, job_id) 
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, vals)
+                        bulk_upsert_events(conn_ins, vals)
                     conn_ins.commit(); conn_ins.close()
                     
                     log("🔄 Processing Analytics...")
                     try: transform_events_to_level_analytics(app_id, events)
                     except Exception as te: log(f"⚠️ Transform: {te}")
+                    update_level_rollup(app_id, rows=vals)
 
                     log(f"🎉 SUCCESS. Imported {count} events.")
                     update_job_status(job_id, 'completed', f"OK. {count} events.")
                     
                     conn_fin = get_db(); cur_fin = conn_fin.cursor()
                     cur_fin.execute("UPDATE job_history SET end_time=NOW(), status='Success', total_events=%s WHERE id=%s", (count, hist_id))
+                    bump_app_data_version(app_id, cur_fin)
                     conn_fin.commit(); conn_fin.close()
                     break 
                 
@@ -797,30 +720,30 @@ def execute_manual_job_logic(hist_id, app_id, retry_count=0):
                     log(f"✅ Downloaded {count} events. Saving...")
                     log(f"🕵️‍♂️ [DEBUG] AppMetrica gửi về: {count} events (Raw).")
                     
-                    conn_ins = get_db(); cur_ins = conn_ins.cursor()
+                    conn_ins = get_db()
                     vals = []
                     for e in events:
                         evt_json = json.dumps(e)
                         try: ts = datetime.fromtimestamp(int(e.get('event_timestamp')))
                         except: ts = datetime.now()
-                        vals.append((app_id, e.get('event_name'), evt_json, 1, ts, hist_id))
+                        # Không có uuid/raw_timestamp -> bulk loader giữ nguyên kiểu INSERT thường (không gộp trùng)
+                        vals.append((app_id, e.get('event_name'), evt_json, 1, ts, hist_id, None, None))
                     
                     if vals:
-                        cur_ins.executemany("""
-                        INSERT INTO event_logs (app_id, event_name, event_json, count, created_at, job_id) 
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, vals)
+                        bulk_upsert_events(conn_ins, vals)
                     conn_ins.commit(); conn_ins.close()
                     
                     log("🔄 Processing Analytics...")
                     try: transform_events_to_level_analytics(app_id, events)
                     except Exception as te: log(f"⚠️ Transform: {te}")
+                    update_level_rollup(app_id, rows=vals)
 
                     log(f"🎉 SUCCESS. Imported {count} events.")
                     #update_job_status(job_id, 'completed', f"OK. {count} events.")
                     
                     conn_fin = get_db(); cur_fin = conn_fin.cursor()
                     cur_fin.execute("UPDATE job_history SET end_time=NOW(), status='Success', total_events=%s WHERE id=%s", (count, hist_id))
+                    bump_app_data_version(app_id, cur_fin)
                     conn_fin.commit(); conn_fin.close()
                     break 
                 
@@ -888,62 +811,104 @@ def execute_manual_job_logic(hist_id, app_id, retry_count=0):
         print(f"🔓 App {app_id} Free.")
         unlock_app(app_id)
 
-def worker_process_jobs():
+def event_time(event):
+    """
+    Giờ UTC (naive) của event: event_timestamp, thiếu / hỏng thì event_receive_timestamp (giây hoặc mili giây).
+    None nếu không có mốc nào dùng được. Luôn suy ra từ chính event -> import lại cùng event ra cùng created_at.
+    """
+    for key in ('event_timestamp', 'event_receive_timestamp'):
+        try:
+            ts_val = float(event.get(key))
+            # Milliseconds detection
+            if ts_val > 99999999999: ts_val = ts_val / 1000.0
+            return datetime.fromtimestamp(ts_val, timezone.utc).replace(tzinfo=None)
+        except (TypeError, ValueError, OverflowError, OSError):
+            continue
+    return None
+
+def build_event_row(app_id, event, hist_id):
+    """
+    Chuẩn hóa 1 event thô của AppMetrica thành tuple để ghi vào event_logs:
+    (app_id, event_name, event_json, count, created_at, job_id, uuid, raw_timestamp,
+     level_num, user_uid, app_version_name, country_iso_code, coin_cost, timeplay, booster_counts)
+    None nếu event không có mốc thời gian nào: created_at nằm trong key chống trùng của bảng phân vùng,
+    lấy giờ hiện tại thì mỗi lần import lại sẽ nhân bản event.
+    """
+    evt_name = event.get('event_name', 'unknown')
+    final_json_str = "{}"
+    final_flat = {}
+    
+    # 1. Xử lý JSON (Giữ nguyên)
+    try:
+        final_flat = flatten_event(event, INGEST_POLICY)
+        final_json_str = dumps_json(final_flat)
+    except:
+        final_flat = event if isinstance(event, dict) else {}
+        try: final_json_str = json.dumps(event, ensure_ascii=False)
+        except: final_json_str = "{}"
+
+    # 2. Xử lý UUID & Timestamp Key (String)
+    # [NÂNG CẤP]: Nếu uuid rỗng, thử lấy installation_id lấp vào
+    uuid_val = str(event.get('uuid') or '')
+    if not uuid_val or uuid_val == 'None':
+         uuid_val = str(event.get('installation_id') or '')
+         
+    raw_ts_val = str(event.get('event_timestamp') or '')
+
+    # 3. Xử lý Thời gian (FINAL: UTC CHUẨN - KHÔNG CỘNG TRỪ)
+    # [CHỐT HẠ] Lấy giờ UTC gốc và lưu thẳng vào DB.
+    # Ví dụ: Sự kiện lúc 00:00 VN -> UTC là 17:00.
+    # Lưu 17:00 vào DB.
+    # Frontend lấy 17:00 + 7 = 00:00 (Chuẩn đét!)
+    # TUYỆT ĐỐI KHÔNG dùng dòng này: ts = ts - timedelta(hours=7)
+    # TUYỆT ĐỐI KHÔNG dùng dòng này: ts = ts + timedelta(hours=7)
+    ts = event_time(event)
+    if ts is None: return None
+
+    # 4. Trích xuất cột kiểu (level, user, version, geo, coin, boosters) ngay lúc ghi
+    typed = extract_event_fields(evt_name, final_flat, final_json_str)
+
+    return (app_id, evt_name, final_json_str, 1, ts, hist_id, uuid_val, raw_ts_val) + typed
+
+def worker_process_jobs(slots):
+    """
+    Nhận & chạy 1 job. Trả về False nếu không có job nào để chạy (hoặc đã hết slot).
+    slots: JobSlots của worker gọi (giới hạn số job chạy cùng lúc qua advisory lock, xem api/job_queue.py)
+    """
     # Kiểm tra xem có Worker nào đang chạy không
-    if is_system_busy(): return
+    if is_system_busy(): return False
 
     conn = get_db()
-    if not conn: return
+    if not conn: return False
     
     # -------------------------------------------------------------
-    # [NEW] LOGIC CHỌN JOB THÔNG MINH (HỖ TRỢ HẸN GIỜ)
-    # Thay vì chỉ lấy 'pending', ta lấy thêm điều kiện scheduled_at
+    # NHẬN JOB NGUYÊN TỬ (HỖ TRỢ HẸN GIỜ)
+    # Lấy job pending MÀ (không hẹn giờ HOẶC đã đến giờ hẹn) và đánh dấu Processing trong CÙNG 1 transaction
+    # (FOR UPDATE SKIP LOCKED) -> nhiều worker / nhiều máy chạy song song không lấy trùng.
+    # Chỉ nhận khi còn slot toàn hệ thống & app của job chưa đủ số job đang chạy.
     # -------------------------------------------------------------
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # Ưu tiên 1: Kiểm tra bảng chung job_history (Nơi chứa Manual Job & Scheduled Job)
-    # Lấy job pending MÀ (không hẹn giờ HOẶC đã đến giờ hẹn)
-    cur.execute("""
-        SELECT * FROM job_history 
-        WHERE status = 'pending' 
-          AND (scheduled_at IS NULL OR scheduled_at <= (NOW() AT TIME ZONE 'UTC'))
-        ORDER BY created_at ASC LIMIT 1
-    """)
-    job_history_row = cur.fetchone()
-    
-    # Ưu tiên 2: Nếu job_history rỗng, kiểm tra bảng cũ etl_jobs (Legacy Auto Job)
-    # Để đảm bảo không mất chức năng cũ của Auto Scheduler
-    job_legacy = None
-    if not job_history_row:
-        cur.execute("""
-            SELECT * FROM etl_jobs 
-            WHERE status IN ('pending', 'processing') 
-            ORDER BY created_at ASC LIMIT 1
-        """)
-        job_legacy = cur.fetchone()
-    
-    cur.close() 
-    conn.close()
-
-    # --- HỢP NHẤT DỮ LIỆU JOB (ADAPTER) ---
-    # Mục tiêu: Dù lấy từ bảng nào thì cũng map về một cấu trúc 'job' chuẩn
-    job = None
-    source_table = 'none'
-
-    if job_history_row:
-        job = job_history_row
-        source_table = 'history'
-    elif job_legacy:
-        job = job_legacy
-        source_table = 'legacy'
-    else:
-        return # Không có việc gì làm
+    try:
+        job, source_table = claim_next_job(conn, slots)
+    finally:
+        conn.close()
+
+    if not job:
+        return False # Không có việc gì làm (hoặc đã đủ job đang chạy)
+
+    try:
+        return run_claimed_job(job, source_table)
+    finally:
+        slots.release()
+
+def run_claimed_job(job, source_table):
+    """Chạy 1 job đã nhận (đang giữ slot)"""
 
     job_id = job['id']
     app_id = job['app_id']
 
     # --- [RETRY LOGIC V2 - FIX DATA RANGE] ---
     # Mục tiêu: Job cũ quét từ A đến B -> Job Retry cũng phải quét từ A đến B (y hệt)
+    retry_status = None # Trạng thái job cũ: chỉ job Failed mới được nhận lại spool
     if job.get('run_type') == 'retry' and job.get('retry_job_id'):
         print(f"🕵️‍♂️ Retry Detect: Đang khôi phục cấu hình từ Job #{job['retry_job_id']}...")
         try:
@@ -954,7 +919,7 @@ def worker_process_jobs():
             # 2. Lấy chính xác khoảng thời gian (Window) của Job cũ
             # date_since / date_until là khoảng dữ liệu (VD: 16:58 - 18:03)
             cur_fix.execute("""
-                SELECT date_since, date_until, app_id 
+                SELECT date_since, date_until, app_id, status
                 FROM job_history 
                 WHERE id = %s
             """, (job['retry_job_id'],))
@@ -975,6 +940,8 @@ def worker_process_jobs():
                 if old_job_data.get('app_id'):
                     job['app_id'] = old_job_data['app_id']
 
+                retry_status = old_job_data.get('status')
+
                 print(f"✅ RETRY FIXED: Đã khôi phục Data Range chuẩn: {job['date_since']} -> {job['date_until']}")
             else:
                 print(f"⚠️ RETRY WARNING: Không tìm thấy Job cũ #{job['retry_job_id']} trong DB. Sẽ chạy theo tham số hiện tại.")
@@ -983,15 +950,6 @@ def worker_process_jobs():
             print(f"❌ RETRY ERROR: Lỗi khi khôi phục Job cũ: {e}")
             # Nếu lỗi, code sẽ chạy tiếp với tham số mặc định
 
-    # [NEW] CẬP NHẬT TRẠNG THÁI (PROCESSING)
-    # Nếu là job từ bảng history (Manual/Scheduled), ta update ngay trạng thái để tránh worker khác lấy trùng
-    if source_table == 'history':
-        try:
-            conn_upd = get_db(); cur_upd = conn_upd.cursor()
-            cur_upd.execute("UPDATE job_history SET status='Processing', start_time=NOW() WHERE id=%s", (job_id,))
-            conn_upd.commit(); conn_upd.close()
-        except: pass
-
     # 2. KHỞI TẠO HISTORY (LOGIC CŨ)
     # Nếu job lấy từ 'history' (Manual), thì hist_id chính là nó luôn.
     # Nếu job lấy từ 'etl_jobs' (Legacy), thì phải tạo dòng mới trong job_history.
@@ -1020,7 +978,18 @@ def worker_process_jobs():
         set_system_busy(False)
         return
 
-    stop_event = threading.Event()
+    # Job con của backfill: job cha chuyển Processing khi cửa sổ đầu tiên chạy
+    parent_job_id = job.get('parent_job_id') if source_table == 'history' else None
+    if parent_job_id:
+        try:
+            conn = get_db(); cur = conn.cursor()
+            mark_parent_started(cur, parent_job_id)
+            conn.commit(); conn.close()
+        except Exception as e:
+            print(f"⚠️ Backfill Parent Error: {e}")
+
+    # Cờ STOP: bật khi /etl/stop gọi trong cùng process HOẶC khi job bị đánh dấu Cancelled trên DB
+    stop_event = JobStopSignal(hist_id)
     if hist_id:
         JOB_STOP_EVENTS[hist_id] = stop_event
 
@@ -1029,6 +998,74 @@ def worker_process_jobs():
         print(msg)
         if hist_id: append_log_to_db(hist_id, msg)
 
+    def mark_failed(cur):
+        """Đánh dấu Failed (chưa commit). Job đã kịp commit lô nào thì dữ liệu app đã đổi -> cache / ETag cũ hết hiệu lực"""
+        if not hist_id: return
+        cur.execute("UPDATE job_history SET end_time=NOW(), status='Failed' WHERE id=%s RETURNING COALESCE(spool_committed, 0)", (hist_id,))
+        row = cur.fetchone()
+        if row and row[0] > 0: bump_app_data_version(app_id, cur)
+
+    def fail_exception(e):
+        log(f"❌ Worker Exception: {str(e)}")
+        if source_table == 'legacy':
+            update_job_status(job_id, 'failed', str(e))
+
+        conn = get_db(); cur = conn.cursor()
+        mark_failed(cur)
+        conn.commit(); conn.close()
+
+    def finish_job():
+        set_system_busy(False)
+        flush_job_logs() # Job xong -> đẩy nốt log đang đệm để màn Monitor thấy ngay
+        if hist_id and hist_id in JOB_STOP_EVENTS:
+            del JOB_STOP_EVENTS[hist_id]
+        if parent_job_id:
+            # Gom kết quả cửa sổ này vào job cha (cửa sổ cuối cùng chốt trạng thái job cha)
+            try:
+                conn = get_db(); cur = conn.cursor()
+                final = rollup_parent(cur, parent_job_id)
+                conn.commit(); conn.close()
+                if final: print(f"🧩 Backfill Job #{parent_job_id}: {final}")
+            except Exception as e:
+                print(f"⚠️ Backfill Rollup Error: {e}")
+
+    def park_export(attempt):
+        """Giao export đang 202 cho ExportPoller; từ đây poller gọi tiếp handle_response / fail_timeout / finish_job"""
+        def poll():
+            log(f"  📡 Kết nối AppMetrica (Attempt {export.attempt}/{max_polling_attempts})...")
+            return probe()
+
+        def on_response(response, attempt):
+            try: handle_response(response, attempt)
+            except Exception as e: fail_exception(e)
+
+        def on_cancel():
+            # Trạng thái Cancelled đã do /etl/stop ghi
+            log("🛑 Đã nhận tín hiệu STOP! Hủy chờ dữ liệu AppMetrica.")
+            if source_table == 'legacy':
+                update_job_status(job_id, 'cancelled', "Stopped while waiting data.")
+
+        # Worker đã nhả slot khi gửi sang poller -> mỗi lượt hỏi lại phải lấy lại slot (connection advisory lock riêng của export)
+        export_slots = JobSlots()
+
+        def on_finish():
+            try: finish_job()
+            finally:
+                export_slots.release()
+                export_slots.close()
+
+        export = ParkedExport(
+            key=hist_id, probe=poll, on_response=on_response,
+            on_error=lambda e, attempt: log(f"⚠️ Request Error: {e}"),
+            on_timeout=fail_timeout, on_cancel=on_cancel, on_finish=on_finish,
+            is_cancelled=stop_event.is_set,
+            attempt=attempt, max_attempts=max_polling_attempts, interval=polling_interval,
+            acquire_slots=lambda: export_slots.acquire_job(app_id, clean_token, backfill_child=bool(parent_job_id)),
+            release_slots=export_slots.release,
+        )
+        get_export_poller().park(export)
+
+    parked = False
     try:
         # 3. FIX TIMEZONE & LẤY APP INFO (GIỮ NGUYÊN 100%)
         try:
@@ -1070,211 +1107,263 @@ def worker_process_jobs():
         }
         headers = {"Authorization": f"OAuth {clean_token}"}
 
-        db_retry_count = job.get('retry_count') or 0
         # --- LOGIC RETRY (GIỮ NGUYÊN 100%) ---
-        max_polling_attempts = 18   
-        polling_interval = 180      
-        
-        for attempt in range(1, max_polling_attempts + 1):
-            total_attempts = db_retry_count + attempt
-            log(f"  📡 Kết nối AppMetrica (Attempt {attempt}/{max_polling_attempts})...")
-            
+        max_polling_attempts = EXPORT_POLL_MAX_ATTEMPTS
+        polling_interval = EXPORT_POLL_INTERVAL
+
+        def ingest_events(events, committed=0, close=None):
+            """Ghi DB theo lô từ 1 nguồn event (stream HTTP hoặc file spool); committed = số event đầu đã ghi từ lần trước"""
+            # --- STREAMING + BATCH INSERT & UPSERT ---
+            # Không gọi response.json() nữa: đọc từng event trong mảng 'data' ngay khi tải về,
+            # flatten & ghi DB theo lô INGEST_BATCH_SIZE => RAM phẳng dù file export hàng trăm MB.
+            # Mỗi lô: COPY vào bảng staging rồi MERGE 1 lệnh (giữ chiến thuật AUDIT event_json_old/job_id_old),
+            # xem api/bulk_loader.py
+            event_count = 0
+            rejected = 0 # Event không có mốc thời gian (build_event_row trả None) -> không ghi
+            sessions = {} # Gom session level dần theo từng lô (không giữ list event)
+            rollup_cells = set() # Các ô (ngày VN, level) job này chạm vào -> cập nhật level_daily_stats
+            
+            cancelled = False
+            conn_ins = get_db()
             try:
-                response = requests.get(url, params=params, headers=headers, stream=True, timeout=600)
-                
-                # TRƯỜNG HỢP 1: CÓ HÀNG (200 OK)
-                if response.status_code == 200:
-                    log("  ✅ Data Ready (200 OK). Downloading & Processing...")
-                    
-                    data = response.json()
-                    events = data.get('data', [])
-                    event_count = len(events)
-                    
-                    # --- BATCH INSERT & UPSERT (ĐÃ FIX THEO YÊU CẦU CỦA SẾP) ---
-                    conn_ins = get_db(); cur_ins = conn_ins.cursor()
-                    vals = []
-                    
-                    for event in events:
-                        evt_name = event.get('event_name', 'unknown')
-                        final_json_str = "{}"
-                        
-                        # 1. Xử lý JSON (Giữ nguyên)
-                        try:
-                            clean_s1 = recursive_json_unpack(event) 
-                            final_flat = strict_flatten_event(clean_s1) 
-                            final_json_str = json.dumps(final_flat, ensure_ascii=False)
-                        except:
-                            try: final_json_str = json.dumps(event, ensure_ascii=False)
-                            except: final_json_str = "{}"
-
-                        # 2. Xử lý UUID & Timestamp Key (String)
-                        # [NÂNG CẤP]: Nếu uuid rỗng, thử lấy installation_id lấp vào
-                        uuid_val = str(event.get('uuid') or '')
-                        if not uuid_val or uuid_val == 'None':
-                             uuid_val = str(event.get('installation_id') or '')
-                             
-                        raw_ts_val = str(event.get('event_timestamp') or '')
-
-                        # 3. Xử lý Thời gian (FINAL: UTC CHUẨN - KHÔNG CỘNG TRỪ)
-                        try: 
-                            raw_ts = event.get('event_timestamp', 0)
-                            ts_val = float(raw_ts)
-                            
-                            # Milliseconds detection
-                            if ts_val > 99999999999: ts_val = ts_val / 1000.0
-                            
-                            # [CHỐT HẠ] Lấy giờ UTC gốc và lưu thẳng vào DB.
-                            # Ví dụ: Sự kiện lúc 00:00 VN -> UTC là 17:00.
-                            # Lưu 17:00 vào DB.
-                            # Frontend lấy 17:00 + 7 = 00:00 (Chuẩn đét!)
-                            
-                            ts = datetime.fromtimestamp(ts_val, timezone.utc).replace(tzinfo=None)
-                            
-                            # TUYỆT ĐỐI KHÔNG dùng dòng này: ts = ts - timedelta(hours=7)
-                            # TUYỆT ĐỐI KHÔNG dùng dòng này: ts = ts + timedelta(hours=7)
-                            
-                        except: 
-                            ts = datetime.utcnow()
-
-                        # 4. Append
-                        vals.append((app_id, evt_name, final_json_str, 1, ts, hist_id, uuid_val, raw_ts_val))
-                    
-                    if vals:
-                        # [CHIẾN THUẬT AUDIT TOÀN DIỆN]
-                        # 1. Key duy nhất vẫn là 4 trường cũ (để phát hiện trùng).
-                        # 2. Khi trùng:
-                        #    - Cất Job ID cũ vào job_id_old.
-                        #    - Cất JSON cũ vào event_json_old.
-                        #    - Ghi Job ID mới và JSON mới vào cột chính.
-                        
-                        query = """
-                            INSERT INTO event_logs (app_id, event_name, event_json, count, created_at, job_id, uuid, raw_timestamp) 
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (app_id, event_name, raw_timestamp, uuid) 
-                            DO UPDATE SET 
-                                -- [BACKUP DỮ LIỆU CŨ]
-                                event_json_old = event_logs.event_json,   -- Lưu vết nội dung
-                                job_id_old = event_logs.job_id,           -- Lưu vết Job cũ (Theo ý sếp)
-                                
-                                -- [GHI DỮ LIỆU MỚI]
-                                event_json = EXCLUDED.event_json,
-                                job_id = EXCLUDED.job_id,
-                                created_at = EXCLUDED.created_at,
-                                count = event_logs.count
-                        """
-                        cur_ins.executemany(query, vals)
-                        conn_ins.commit(); conn_ins.close()
-                        
-                        print(f"  💾 Saved {len(vals)} events (Upsert Mode with Full Audit).")
+                for batch in iter_batches(events, INGEST_BATCH_SIZE):
+                    if stop_event.is_set():
+                        cancelled = True
+                        break
+                    rows = [build_event_row(app_id, event, hist_id) for event in batch]
+                    vals = [row for row in rows if row is not None]
+                    # Resume: các event trước mốc checkpoint đã nằm trong DB -> chỉ gom session / ô rollup, không ghi lại
+                    # (mốc checkpoint tính theo vị trí event trong nguồn, kể cả event bị loại)
+                    skip = min(len(rows), max(0, committed - event_count))
+                    if skip < len(rows):
+                        fresh = [row for row in rows[skip:] if row is not None]
+                        rejected += len(rows) - skip - len(fresh)
+                        if fresh: bulk_upsert_events(conn_ins, fresh)
+                        cur_ck = conn_ins.cursor()
+                        cur_ck.execute("UPDATE job_history SET spool_committed = %s WHERE id = %s", (event_count + len(rows), hist_id))
+                        cur_ck.close()
+                        conn_ins.commit()
+                    event_count += len(rows)
+                    rollup_cells |= touched_cells(vals)
+                    print(f"  💾 Saved {event_count} events (Upsert Mode with Full Audit).")
                     
-                    # Transform (GIỮ NGUYÊN)
-                    try: transform_events_to_level_analytics(app_id, events)
+                    try: collect_level_sessions(app_id, batch, sessions)
                     except: pass
+            finally:
+                conn_ins.close()
+                if close: close()
+            
+            if rejected:
+                log(f"  ⚠️ Bỏ qua {rejected} events không có event_timestamp / event_receive_timestamp hợp lệ.")
 
-                    # Success Finish
-                    conn = get_db(); cur = conn.cursor()
-                    cur.execute("UPDATE job_history SET end_time=NOW(), status='Success', total_events=%s, success_count=%s WHERE id=%s", (event_count, event_count, hist_id))
-                    conn.commit(); conn.close()
-                    
-                    if source_table == 'legacy':
-                        update_job_status(job_id, 'completed', f"Done. {event_count} events.")
-                        
-                    log(f"  🎉 Job Completed. Imported: {event_count} events.")
-                    return 
+            # Transform (GIỮ NGUYÊN)
+            try: save_level_sessions(sessions)
+            except: pass
+
+            # Rollup Data Check: chỉ tính lại đúng các ô (ngày, level) vừa ghi
+            if update_level_rollup(app_id, cells=rollup_cells):
+                log(f"  📊 Rollup updated: {len(rollup_cells)} cells (day x level).")
+
+            if cancelled:
+                # Trạng thái Cancelled đã do /etl/stop ghi; các lô đã lưu vẫn giữ nguyên
+                log(f"🛑 Đã nhận tín hiệu STOP! Dừng import sau {event_count} events.")
+                if event_count: bump_app_data_version(app_id)
+                if source_table == 'legacy':
+                    update_job_status(job_id, 'cancelled', f"Stopped. {event_count} events.")
+                return 'done'
+
+            # Success Finish
+            conn = get_db(); cur = conn.cursor()
+            cur.execute("UPDATE job_history SET end_time=NOW(), status='Success', total_events=%s, success_count=%s WHERE id=%s", (event_count, event_count, hist_id))
+            bump_app_data_version(app_id, cur) # Cache dashboard của app hết hiệu lực cùng lúc job Success
+            conn.commit(); conn.close()
+            remove_spool(hist_id) # Đã ghi hết -> Retry sau này phải xin dữ liệu mới từ AppMetrica, không đọc lại file cũ
+            
+            if source_table == 'legacy':
+                update_job_status(job_id, 'completed', f"Done. {event_count} events.")
                 
-                # TRƯỜNG HỢP 2: CHƯA CÓ HÀNG (202 ACCEPTED)
-                elif response.status_code == 202:
-                    log(f"  ⏳ HTTP 202: Data preparing... Waiting {polling_interval}s...")
-                    
+            log(f"  🎉 Job Completed. Imported: {event_count} events.")
+            return 'done'
+
+        def handle_response(response, attempt):
+            """Xử lý 1 response export. 'wait' nếu AppMetrica còn đang chuẩn bị (202), 'done' nếu job đã kết thúc"""
+            # TRƯỜNG HỢP 1: CÓ HÀNG (200 OK)
+            if response.status_code == 200:
+                log("  ✅ Data Ready (200 OK). Downloading & Processing...")
+                try:
+                    c_ok = get_db(); cr_ok = c_ok.cursor()
+                    record_token_success(cr_ok, clean_token) # Token chạy ổn -> nới dần trần export song song
+                    c_ok.commit(); c_ok.close()
+                except: pass
+                
+                if not EXPORT_SPOOL_ENABLED:
+                    return ingest_events(iter_export_events(response), close=response.close)
+
+                # Tải hết về file spool trước (api/export_spool.py) -> DB lỗi giữa chừng thì Retry đọc lại file, không tải lại
+                try: spooled = write_spool(hist_id, iter_export_events(response), stop_event)
+                finally: response.close()
+                if spooled is None:
+                    log("🛑 Đã nhận tín hiệu STOP! Dừng tải dữ liệu AppMetrica.")
                     if source_table == 'legacy':
-                        update_job_status(job_id, 'processing', f"Waiting Data (Try {attempt}/{max_polling_attempts})...")
-                    
-                    # [UPDATED] Update cả retry_count cho bảng history
-                    try:
-                        c_re = get_db(); cr_re = c_re.cursor()
-                        cr_re.execute("UPDATE job_history SET retry_count = %s WHERE id = %s", (attempt, hist_id))
-                        c_re.commit(); c_re.close()
-                    except: pass
-
-                    if stop_event.wait(polling_interval):
-                        log("🛑 Đã nhận tín hiệu STOP! Rút ống thở Worker ngay lập tức!")
-                        break # Phá vỡ vòng lặp 18 lần
-                        
-                    continue 
+                        update_job_status(job_id, 'cancelled', "Stopped while downloading.")
+                    return 'done'
+                log(f"  💽 Spooled {spooled} events -> {spool_path(hist_id)}")
+                spool_state['ready'] = True
+                return ingest_events(iter_spool(hist_id))
+            
+            # TRƯỜNG HỢP 2: CHƯA CÓ HÀNG (202 ACCEPTED)
+            elif response.status_code == 202:
+                log(f"  ⏳ HTTP 202: Data preparing... Waiting {polling_interval:g}s...")
+                
+                if source_table == 'legacy':
+                    update_job_status(job_id, 'processing', f"Waiting Data (Try {attempt}/{max_polling_attempts})...")
+                
+                # [UPDATED] Update cả retry_count cho bảng history
+                try:
+                    c_re = get_db(); cr_re = c_re.cursor()
+                    cr_re.execute("UPDATE job_history SET retry_count = %s WHERE id = %s", (attempt, hist_id))
+                    c_re.commit(); c_re.close()
+                except: pass
+                return 'wait'
 
-                elif response.status_code == 429 or "enqueued" in response.text.lower():
-                    log(f"  ❌ Lỗi 429: Hàng đợi AppMetrica đang đầy. Đánh dấu FAILED, vui lòng dùng nút Retry sau!")
-                    
-                    if source_table == 'legacy':
-                        update_job_status(job_id, 'failed', f"Rate Limit 429")
-                    
-                    # Cập nhật DB thành Failed và kết thúc thời gian chạy
-                    try:
-                        conn_fin = get_db(); cur_fin = conn_fin.cursor()
-                        cur_fin.execute("UPDATE job_history SET end_time=NOW(), status='Failed' WHERE id=%s", (hist_id,))
+            elif response.status_code == 429 or "enqueued" in response.text.lower():
+                # Ghi nhận 429 cho token (mọi job của token cùng lùi) rồi tự hẹn chạy lại job này (api/token_budget.py)
+                try:
+                    conn_fin = get_db(); cur_fin = conn_fin.cursor()
+                    delay, blocked_until = record_rate_limit(cur_fin, clean_token)
+                    hits = (job.get('rate_limit_hits') or 0) + 1
+                    if source_table == 'history' and hits <= RATE_LIMIT_MAX_RESCHEDULES:
+                        cur_fin.execute("""
+                            UPDATE job_history SET status='pending', scheduled_at=%s, rate_limit_hits=%s
+                            WHERE id=%s AND status='Processing'
+                        """, (blocked_until, hits, hist_id))
                         conn_fin.commit(); conn_fin.close()
-                    except: pass
+                        vn_retry = blocked_until + timedelta(hours=7)
+                        log(f"  ⏳ Lỗi 429: Hàng đợi AppMetrica đang đầy. Token lùi {int(delay)}s, tự chạy lại lúc {vn_retry.strftime('%H:%M:%S')} (lần {hits}/{RATE_LIMIT_MAX_RESCHEDULES}).")
+                        return 'done'
+                    conn_fin.commit(); conn_fin.close()
+                except Exception as e:
+                    print(f"⚠️ Rate Limit Error: {e}")
+
+                log(f"  ❌ Lỗi 429: Hàng đợi AppMetrica đang đầy. Đánh dấu FAILED, vui lòng dùng nút Retry sau!")
+                
+                if source_table == 'legacy':
+                    update_job_status(job_id, 'failed', f"Rate Limit 429")
+                
+                # Cập nhật DB thành Failed và kết thúc thời gian chạy
+                try:
+                    conn_fin = get_db(); cur_fin = conn_fin.cursor()
+                    mark_failed(cur_fin)
+                    conn_fin.commit(); conn_fin.close()
+                except: pass
+
+                return 'done'
 
+            # TRƯỜNG HỢP 3: LỖI
+            else:
+                err_text = response.text.strip()[:200]
+                log(f"❌ FATAL ERROR {response.status_code}: {err_text}")
+                if source_table == 'legacy':
+                    update_job_status(job_id, 'failed', f"API Error {response.status_code}")
+                
+                conn = get_db(); cur = conn.cursor()
+                mark_failed(cur)
+                conn.commit(); conn.close()
+                return 'done'
+
+        def fail_timeout():
+            log("❌ TIMEOUT: AppMetrica did not return data after max retries.")
+            if source_table == 'legacy':
+                update_job_status(job_id, 'failed', 'Timeout (202 Loop)')
+            
+            conn = get_db(); cur = conn.cursor()
+            mark_failed(cur)
+            conn.commit(); conn.close()
+
+        def probe():
+            return requests.get(url, params=params, headers=headers, stream=True, timeout=600)
+
+        def resume_from_spool(source_id):
+            """Đọc lại spool (của job này hoặc job cũ source_id), bỏ qua các event đã commit (không gọi lại AppMetrica)"""
+            conn = get_db(); cur = conn.cursor()
+            cur.execute("SELECT COALESCE(spool_committed, 0) FROM job_history WHERE id = %s", (source_id,))
+            row = cur.fetchone()
+            committed = row[0] if row else 0
+            if source_id != hist_id:
+                cur.execute("UPDATE job_history SET spool_committed = %s WHERE id = %s", (committed, hist_id))
+            conn.commit(); conn.close()
+            log(f"  💽 Đọc lại spool của Job #{source_id}: {committed} events đã ghi từ trước, chạy tiếp phần còn lại.")
+            return ingest_events(iter_spool(hist_id), committed=committed)
+
+        # Retry của job Failed đã tải xong về spool: nhận file của job cũ và chạy tiếp từ mốc đã commit
+        spool_state = {'ready': False}
+        retry_of = job.get('retry_job_id') if job.get('run_type') == 'retry' and retry_status == 'Failed' else None
+        if EXPORT_SPOOL_ENABLED and retry_of and has_spool(retry_of) and adopt_spool(retry_of, hist_id):
+            resume_from_spool(retry_of)
+            return
+        # Cửa sổ backfill Failed được Retry tại chỗ (retry_children): spool lần chạy trước vẫn mang đúng id này
+        if EXPORT_SPOOL_ENABLED and parent_job_id and has_spool(hist_id):
+            resume_from_spool(hist_id)
+            return
+
+        for attempt in range(1, max_polling_attempts + 1):
+            try:
+                if spool_state['ready']:
+                    # Lần trước đã tải xong về spool nhưng ghi DB lỗi -> đọc lại file thay vì xin lại AppMetrica
+                    resume_from_spool(hist_id)
                     return
 
-                    if stop_event.wait(180):
-                        log("🛑 Đã nhận tín hiệu STOP!")
-                        break
-                    continue
+                log(f"  📡 Kết nối AppMetrica (Attempt {attempt}/{max_polling_attempts})...")
+                response = probe()
+                if handle_response(response, attempt) == 'done':
+                    return
 
-                # TRƯỜNG HỢP 3: LỖI
-                else:
-                    err_text = response.text.strip()[:200]
-                    log(f"❌ FATAL ERROR {response.status_code}: {err_text}")
-                    if source_table == 'legacy':
-                        update_job_status(job_id, 'failed', f"API Error {response.status_code}")
+                if EXPORT_POLLER_ENABLED:
+                    # Không giữ worker thread trong lúc AppMetrica chuẩn bị: gửi job sang ExportPoller (api/export_poller.py),
+                    # worker nhả slot đi nhận job khác; export có hàng thì poller lấy lại slot rồi pool tải & parse xử lý tiếp
+                    response.close()
+                    park_export(attempt)
+                    parked = True
+                    return
+
+                if stop_event.wait(polling_interval):
+                    log("🛑 Đã nhận tín hiệu STOP! Rút ống thở Worker ngay lập tức!")
+                    break # Phá vỡ vòng lặp 18 lần
                     
-                    conn = get_db(); cur = conn.cursor()
-                    cur.execute("UPDATE job_history SET end_time=NOW(), status='Failed' WHERE id=%s", (hist_id,))
-                    conn.commit(); conn.close()
-                    return 
+                continue 
 
             except Exception as e_req:
                 log(f"⚠️ Request Error: {e_req}")
                 time.sleep(60)
         
         # TIMEOUT SAU 18 LẦN
-        log("❌ TIMEOUT: AppMetrica did not return data after max retries.")
-        if source_table == 'legacy':
-            update_job_status(job_id, 'failed', 'Timeout (202 Loop)')
-        
-        conn = get_db(); cur = conn.cursor()
-        cur.execute("UPDATE job_history SET end_time=NOW(), status='Failed' WHERE id=%s", (hist_id,))
-        conn.commit(); conn.close()
+        fail_timeout()
 
     except Exception as e:
-        log(f"❌ Worker Exception: {str(e)}")
-        if source_table == 'legacy':
-            update_job_status(job_id, 'failed', str(e))
-        
-        conn = get_db(); cur = conn.cursor()
-        if hist_id: cur.execute("UPDATE job_history SET end_time=NOW(), status='Failed' WHERE id=%s", (hist_id,))
-        conn.commit(); conn.close()
+        fail_exception(e)
     
     finally:
-        set_system_busy(False)
-        if hist_id and hist_id in JOB_STOP_EVENTS:
-            del JOB_STOP_EVENTS[hist_id]
+        if not parked:
+            finish_job()
 
 def run_worker_loop(worker_id):
-    # Lệch nhịp khởi động: Bác sĩ 1 vào làm ngay, Bác sĩ 2 uống cà phê 5s rồi mới vào
-    # Tránh việc 2 bác sĩ cùng lao vào giật 1 tờ phiếu khám trong Database
-    time.sleep(worker_id * 5) 
+    # Không cần lệch nhịp khởi động nữa: claim_next_job dùng SKIP LOCKED nên các bác sĩ không giật trùng phiếu
     print(f"🚀 Worker Thread [{worker_id}] Started...")
+    listener = JobListener()
+    listener.start()
+    slots = JobSlots()
     
     while True:
         try:
-            worker_process_jobs()
+            worked = worker_process_jobs(slots)
         except Exception as e:
             print(f"❌ Worker [{worker_id}] Loop Error: {e}")
+            worked = False
         
-        # Làm xong 1 việc thì nghỉ 30s rồi tìm việc tiếp
-        time.sleep(30)
+        # Vừa làm xong 1 việc -> tìm việc tiếp ngay.
+        # Rảnh / hết slot -> chờ NOTIFY (job mới hoặc slot vừa trống), tối đa WORKER_IDLE_SECONDS để còn quét job hẹn giờ
+        if worked is False:
+            listener.wait(WORKER_IDLE_SECONDS)
 
 def run_scheduler_loop():
     print("🚀 Auto Scheduler V2.1 (Timezone Fixed) Started...")
@@ -1496,15 +1585,16 @@ def perform_manual_etl(app_id, run_type='manual', is_demo=False, retry_job_id=No
                 total_events = len(data)
                 log(f"✅ Success! Received {total_events} events. Importing...")
                 
-                conn_insert = get_db(); cur_insert = conn_insert.cursor()
+                conn_insert = get_db()
                 values = []
                 for d in data:
                     try: ts = datetime.fromtimestamp(int(d.get('event_timestamp')))
                     except: ts = datetime.now()
-                    values.append((app_id, d.get('event_name', 'unknown'), json.dumps(d), 1, ts))
+                    values.append((app_id, d.get('event_name', 'unknown'), json.dumps(d), 1, ts, None, None, None))
                 
-                cur_insert.executemany("INSERT INTO event_logs (app_id, event_name, event_json, count, created_at) VALUES (%s,%s,%s,%s,%s)", values)
+                bulk_upsert_events(conn_insert, values)
                 conn_insert.commit(); conn_insert.close()
+                update_level_rollup(app_id, rows=values)
                 
                 status = "Success"; log(f"🎉 Done. Imported {total_events} events."); break
             
@@ -1517,6 +1607,7 @@ def perform_manual_etl(app_id, run_type='manual', is_demo=False, retry_job_id=No
         # Cập nhật kết quả cuối cùng
         conn_end = get_db(); cur_end = conn_end.cursor()
         cur_end.execute("UPDATE job_history SET end_time=NOW(), status=%s, total_events=%s WHERE id=%s", (status, total_events, hist_id))
+        if status == "Success": bump_app_data_version(app_id, cur_end)
         conn_end.commit(); conn_end.close()
     
     except Exception as e:
@@ -1533,8 +1624,17 @@ def get_history():
         limit = int(request.args.get('limit', 30)) 
     except:
         page = 1; limit = 30
+    # Số dòng log mới nhất trả về cho mỗi job (log đầy đủ nằm ở bảng job_log_lines)
+    try: log_lines = max(1, int(request.args.get('log_lines', 200)))
+    except: log_lines = 200
+    # Phân trang keyset (next_cursor / prev_cursor của lần trước); không gửi = dùng page như cũ
+    page_cursor = request.args.get('cursor')
+    try:
+        ks_where, ks_params, order_by, is_prev = keyset_query_parts(page_cursor, "h.created_at", "h.id")
+    except CursorError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
         
-    offset = (page - 1) * limit
+    offset = 0 if page_cursor else (page - 1) * limit
     conn = get_db()
     
     # Return cấu trúc chuẩn ngay cả khi không có DB
@@ -1548,16 +1648,22 @@ def get_history():
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # 1. Xây dựng mệnh đề WHERE
-        where_clause = ""
-        params_count = []
+        # Job con của backfill chỉ hiện khi xem chi tiết 1 job cha (?parent_id=)
+        parent_id = request.args.get('parent_id')
+        conditions = ["h.parent_job_id = %s" if parent_id else "h.parent_job_id IS NULL"]
+        params_count = [parent_id] if parent_id else []
         if app_id: 
-            where_clause = "WHERE h.app_id = %s"
+            conditions.append("h.app_id = %s")
             params_count.append(app_id)
+        where_clause = "WHERE " + " AND ".join(conditions)
 
-        # 2. Đếm tổng số records
-        cur.execute(f"SELECT COUNT(*) as total FROM job_history h {where_clause}", tuple(params_count))
-        total_records = cur.fetchone()['total']
-        total_pages = (total_records + limit - 1) // limit
+        # 2. Đếm tổng số records (chế độ cursor không đếm lại mỗi trang)
+        total_records = total_pages = None
+        if not page_cursor:
+            cur.execute(f"SELECT COUNT(*) as total FROM job_history h {where_clause}", tuple(params_count))
+            total_records = cur.fetchone()['total']
+            total_pages = (total_records + limit - 1) // limit
+        data_where = "WHERE " + " AND ".join(conditions + ks_where)
 
         # 3. Lấy dữ liệu 
         query = f"""
@@ -1569,18 +1675,36 @@ def get_history():
                 to_char(h.scheduled_at, 'YYYY-MM-DD HH24:MI:SS') as scheduled_at,
                 to_char(h.date_since + interval '7 hours', 'YYYY-MM-DD HH24:MI:SS') as date_since,
                 to_char(h.date_until + interval '7 hours', 'YYYY-MM-DD HH24:MI:SS') as date_until,
+                h.created_at AS _cursor_ts,
+                h.parent_job_id, h.window_index, h.window_total,
+                w.windows_done, w.windows_failed,
                 
                 a.name as app_name 
             FROM job_history h 
             JOIN apps a ON h.app_id = a.id 
-            {where_clause}
-            ORDER BY h.created_at DESC 
+            LEFT JOIN LATERAL (
+                SELECT COUNT(*) FILTER (WHERE c.status IN ('Success', 'Failed', 'Cancelled')) AS windows_done,
+                       COUNT(*) FILTER (WHERE c.status IN ('Failed', 'Cancelled')) AS windows_failed
+                FROM job_history c
+                WHERE h.window_total IS NOT NULL AND c.parent_job_id = h.id
+            ) w ON TRUE
+            {data_where}
+            ORDER BY {order_by}
             LIMIT %s OFFSET %s
         """
         
-        params_data = params_count + [limit, offset]
+        params_data = params_count + ks_params + [limit + 1, offset]
         cur.execute(query, tuple(params_data))
-        res = cur.fetchall()
+        res, next_cursor, prev_cursor = keyset_page(cur.fetchall(), limit, is_prev, bool(page_cursor) or page > 1)
+
+        # Ghép log: phần đầu lưu sẵn trong job_history.logs (job cũ / dòng khởi tạo) + các dòng mới nhất từ job_log_lines
+        cur_logs = conn.cursor()
+        job_logs = fetch_job_logs(cur_logs, [row['id'] for row in res], log_lines)
+        cur_logs.close()
+        for row in res:
+            tail = job_logs.get(row['id'])
+            if tail:
+                row['logs'] = f"{row['logs']}\n{tail}" if row['logs'] else tail
 
         # --- [FIX LỖI DURATION & DATA CHECK] ---
         for row in res:
@@ -1600,13 +1724,17 @@ def get_history():
             except: pass
             
             row['duration'] = duration_str
+            # Job cha backfill: % số cửa sổ đã xong
+            row['progress_pct'] = progress_pct(row['windows_done'], row['window_total'])
 
         return jsonify({
             "data": res,
             "pagination": {
-                "current_page": page,
+                "current_page": None if page_cursor else page,
                 "total_pages": total_pages,
-                "total_records": total_records
+                "total_records": total_records,
+                "next_cursor": next_cursor,
+                "prev_cursor": prev_cursor
             }
         })
 
@@ -1623,13 +1751,21 @@ def get_history():
         })    
     finally: conn.close()
 
+@app.route("/monitor/db-pool", methods=['GET'])
+def get_db_pool_stats():
+    """Thống kê sử dụng DB pool của process API (in_use, idle, waits, timeouts...)"""
+    return jsonify({"success": True, "pool": pool_stats(), "export_poller": export_poller_stats()})
+
 @app.route("/monitor/purge", methods=['DELETE'])
 def purge_history():
     conn = get_db()
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM job_history")
+        cur.execute("DELETE FROM job_log_lines")
+        cur.execute("DELETE FROM job_history RETURNING id")
+        deleted = [row[0] for row in cur.fetchall()]
         conn.commit()
+        for job_id in deleted: remove_spool(job_id)
         return jsonify({"msg": "History Cleared"})
     finally: conn.close()
 
@@ -1661,11 +1797,20 @@ def update_app(id):
             conn.commit()
             return jsonify({"msg": "Updated"})
         elif request.method == 'DELETE':
+            # Bảng đã phân vùng: DROP phân vùng của app thay vì DELETE từng dòng
+            drop_app_partition(cur, id)
             cur.execute("DELETE FROM event_logs WHERE app_id=%s", (id,))
-            cur.execute("DELETE FROM job_history WHERE app_id=%s", (id,))
+            cur.execute("DELETE FROM level_daily_stats WHERE app_id=%s", (id,))
+            cur.execute("DELETE FROM user_dictionary WHERE app_id=%s", (id,))
+            cur.execute("DELETE FROM etl_watermarks WHERE app_id=%s", (id,))
+            bump_app_data_version(id, cur)
+            cur.execute("DELETE FROM job_log_lines WHERE job_id IN (SELECT id FROM job_history WHERE app_id=%s)", (id,))
+            cur.execute("DELETE FROM job_history WHERE app_id=%s RETURNING id", (id,))
+            deleted = [row[0] for row in cur.fetchall()]
             cur.execute("DELETE FROM etl_jobs WHERE app_id=%s", (id,))
             cur.execute("DELETE FROM apps WHERE id=%s", (id,))
             conn.commit()
+            for job_id in deleted: remove_spool(job_id)
             return jsonify({"msg": "Deleted"})
     finally: conn.close()
 
@@ -1681,11 +1826,66 @@ def run_etl_api(app_id):
     if is_system_busy():
          return jsonify({"status": "error", "message": "System is busy processing another job. Please skip this cycle."}), 409
 
+    if run_type == 'retry' and retry_job_id:
+        # Retry đi qua hàng đợi worker (cùng khoảng thời gian job cũ) -> job cũ Failed đã tải xong thì dùng lại spool
+        new_job_id = enqueue_retry_job(retry_job_id)
+        if new_job_id is False:
+            return jsonify({"status": "error", "message": "Backfill job has no finished window to retry."}), 409
+        if new_job_id:
+            return jsonify({"status": "started", "mode": run_type, "job_id": new_job_id})
+
     # Truyền thêm retry_job_id vào hàm xử lý
     threading.Thread(target=perform_manual_etl, args=(app_id, run_type, is_demo, retry_job_id)).start()
     return jsonify({"status": "started", "mode": run_type})
 
+def enqueue_retry_job(retry_job_id):
+    """
+    Tạo job retry 'pending' cho worker từ 1 job có date_since/date_until. None nếu không tạo được.
+    Job backfill (api/backfill.py) chạy lại ngay tại chỗ: job cha -> các cửa sổ Failed / Cancelled, job con -> đúng cửa sổ đó;
+    trả về id job cha / job con, hoặc False nếu không có cửa sổ nào chạy lại được.
+    """
+    conn = get_db()
+    if not conn: return None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT parent_job_id, window_total FROM job_history WHERE id = %s", (retry_job_id,))
+        row = cur.fetchone()
+        if row and (row[0] or row[1]):
+            parent_id = row[0] or retry_job_id
+            reset = retry_children(cur, parent_id, child_id=retry_job_id if row[0] else None)
+            if not reset:
+                conn.rollback()
+                return False
+            notify_job_created(cur, retry_job_id)
+            conn.commit()
+            # Cửa sổ Failed giữ spool để chạy tiếp từ mốc đã commit; cửa sổ khác tải lại dữ liệu mới
+            for child_id, old_status in reset:
+                if old_status != 'Failed': remove_spool(child_id)
+            return retry_job_id
+
+        cur.execute("""
+            INSERT INTO job_history (app_id, date_since, date_until, status, retry_count, created_at, logs, run_type, retry_job_id)
+            SELECT app_id, date_since, date_until, 'pending', 0, NOW(), %s, 'retry', id
+            FROM job_history
+            WHERE id = %s AND date_since IS NOT NULL AND date_until IS NOT NULL AND window_total IS NULL
+            RETURNING id
+        """, (f"Retry of Job #{retry_job_id}", retry_job_id))
+        row = cur.fetchone()
+        if not row:
+            conn.rollback()
+            return None
+        notify_job_created(cur, row[0])
+        conn.commit()
+        return row[0]
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️ Retry Enqueue Error: {e}")
+        return None
+    finally:
+        conn.close()
+
 @app.route("/dashboard/<int:app_id>", methods=['GET'])
+@cached_response()
 def get_dashboard(app_id):
     conn = get_db()
     if not conn: return jsonify({"success": False}), 500
@@ -1745,9 +1945,6 @@ def get_dashboard(app_id):
         if start_date: where += " AND created_at >= %s"; params.append(start_date + " 00:00:00")
         if end_date: where += " AND created_at <= %s"; params.append(end_date + " 23:59:59")
 
-        cur.execute(f"SELECT event_name, event_json FROM event_logs {where}", tuple(params))
-        rows = cur.fetchall()
-
         import re
         def clean_money(val):
             if not val: return 0.0
@@ -1761,70 +1958,64 @@ def get_dashboard(app_id):
         overview = { "real_revenue": 0.0, "virtual_sink": 0, "total_plays": 0, "fail_count": 0, "total_time": 0.0 }
         event_dist = {}
         booster_map = {}
-        level_stats = {} 
-        
-        for r in rows:
-            evt = r['event_name']
-            data = universal_flatten(r['event_json'])
-            
-            event_dist[evt] = event_dist.get(evt, 0) + 1
-            if evt in start_events: overview['total_plays'] += 1
-            if evt in fail_events: overview['fail_count'] += 1
-
-            t_play = data.get('timeplay') or data.get('timePlay') or data.get('duration')
-            if t_play:
-                try: overview['total_time'] += float(t_play)
-                except: pass
-
-            if evt in iap_events:
-                val = data.get('price') or data.get('revenue') or data.get('amount')
-                overview['real_revenue'] += clean_money(val)
-            
-            coin_added = 0
-            raw_coin = (data.get('coin_spent') or data.get('cost') or data.get('priceSpendLevel') or data.get('coinCost'))
-            if not raw_coin and evt.lower() == 'pricespendlevel':
-                 for v in data.values():
-                     v_c = clean_money(v)
-                     if v_c > 0 and v_c < 100000: raw_coin = v_c; break
-            if raw_coin: coin_added = int(clean_money(raw_coin))
-            
-            if coin_added == 0:
-                for k, v in data.items():
-                    if ('booster' in k or 'revive' in k) and str(v).isdigit() and int(v) > 0:
-                        clean_key = k.replace('booster_', '').replace('revive_', '').lower()
-                        if clean_key in BOOSTER_PRICES:
-                            coin_added += (int(v) * BOOSTER_PRICES[clean_key])
-
-            overview['virtual_sink'] += coin_added
-
-            for k, v in data.items():
-                if ('booster' in k or 'revive' in k) and str(v).isdigit() and int(v) > 0:
-                    clean = k.replace('booster_', '').replace('revive_', '').lower()
-                    if clean in BOOSTER_PRICES:
-                        booster_map[clean] = booster_map.get(clean, 0) + int(v)
-
-            candidates = []
-            for k in ['levelID', 'level_display', 'missionID', 'dayChallenge']:
-                val = data.get(k)
-                if val and str(val).isdigit(): candidates.append(int(val))
-            if not candidates:
-                match = re.search(r'(?:levelID|level_display|missionID)[^0-9]{1,10}(\d+)', r['event_json'])
-                if match: candidates.append(int(match.group(1)))
-            
-            if candidates:
-                lvl_num = max(candidates)
-                if 0 < lvl_num < 5000:
-                    lvl_key = str(lvl_num)
-                    if lvl_key not in level_stats:
-                        level_stats[lvl_key] = { "start": 0, "fail": 0, "revenue": 0.0 }
-                    
-                    ls = level_stats[lvl_key]
-                    if evt in start_events: ls['start'] += 1
-                    if evt in fail_events: ls['fail'] += 1
-                    if evt in iap_events:
-                        ls['revenue'] += clean_money(data.get('price') or data.get('revenue'))
-                    if coin_added > 0:
-                        ls['revenue'] += (coin_added / 1000.0)
+        level_stats = {}
+
+        def level_bucket(lvl_num):
+            if lvl_num is None or not (0 < lvl_num < 5000): return None
+            lvl_key = str(lvl_num)
+            if lvl_key not in level_stats:
+                level_stats[lvl_key] = { "start": 0, "fail": 0, "revenue": 0.0 }
+            return level_stats[lvl_key]
+
+        # [TYPED COLUMNS] Gom nhóm ngay trong SQL theo (event, level) -> không parse JSON từng dòng
+        # Các kết quả đọc qua server-side cursor (tuple) và cộng dồn ngay khi từng lô về tới
+        for evt, lvl_num, cnt, time_sum, coin_sum, coin_pos in stream_rows(conn, f"""
+            SELECT event_name, level_num, COUNT(*) AS cnt,
+                   COALESCE(SUM(timeplay), 0) AS time_sum,
+                   COALESCE(SUM(coin_cost), 0) AS coin_sum,
+                   COALESCE(SUM(coin_cost) FILTER (WHERE coin_cost > 0), 0) AS coin_pos
+            FROM event_logs {where}
+            GROUP BY event_name, level_num
+        """, tuple(params), name="dash_grouped"):
+            event_dist[evt] = event_dist.get(evt, 0) + cnt
+            if evt in start_events: overview['total_plays'] += cnt
+            if evt in fail_events: overview['fail_count'] += cnt
+
+            overview['total_time'] += float(time_sum)
+            overview['virtual_sink'] += int(coin_sum)
+
+            ls = level_bucket(lvl_num)
+            if ls is not None:
+                if evt in start_events: ls['start'] += cnt
+                if evt in fail_events: ls['fail'] += cnt
+                ls['revenue'] += (int(coin_pos) / 1000.0)
+
+        # Booster: cộng dồn theo key gốc; dòng không có coin thì quy booster ra tiền (no_coin)
+        for lvl_num, no_coin, key, qty in stream_rows(conn, f"""
+            SELECT level_num, (COALESCE(coin_cost, 0) = 0) AS no_coin, b.key, SUM(b.value::bigint) AS qty
+            FROM event_logs CROSS JOIN LATERAL jsonb_each_text(booster_counts) b
+            {where} AND booster_counts IS NOT NULL AND b.value::bigint > 0
+            GROUP BY level_num, no_coin, b.key
+        """, tuple(params), name="dash_boosters"):
+            clean = key.replace('booster_', '').replace('revive_', '').lower()
+            if clean not in BOOSTER_PRICES: continue
+            qty = int(qty)
+            booster_map[clean] = booster_map.get(clean, 0) + qty
+
+            if no_coin:
+                coin_added = qty * BOOSTER_PRICES[clean]
+                overview['virtual_sink'] += coin_added
+                ls = level_bucket(lvl_num)
+                if ls is not None: ls['revenue'] += (coin_added / 1000.0)
+
+        # IAP: chỉ parse JSON của nhóm event nạp tiền (rất ít dòng)
+        for lvl_num, event_json in stream_rows(conn, f"SELECT level_num, event_json FROM event_logs {where} AND event_name = ANY(%s)",
+                                               tuple(params + [list(iap_events)]), name="dash_iap"):
+            data = flatten_event(event_json)
+            overview['real_revenue'] += clean_money(data.get('price') or data.get('revenue') or data.get('amount'))
+            ls = level_bucket(lvl_num)
+            if ls is not None:
+                ls['revenue'] += clean_money(data.get('price') or data.get('revenue'))
 
         # 4. OUTPUT
         balance_chart = []
@@ -1878,47 +2069,21 @@ def get_dashboard(app_id):
     finally: conn.close()
 
 @app.route("/api/levels/<int:app_id>", methods=['GET'])
+@cached_response()
 def get_levels(app_id):
     conn = get_db()
     if not conn: return jsonify([])
     try:
         cur = conn.cursor()
-        # Chỉ lấy cột JSON để tối ưu
-        cur.execute("SELECT event_json FROM event_logs WHERE app_id = %s", (app_id,))
-        rows = cur.fetchall()
-        
-        levels = set()
-        import re
+        # [TYPED COLUMNS] level_num đã được trích xuất lúc ingest (giới hạn 5000 để lọc rác)
+        cur.execute("""
+            SELECT DISTINCT level_num FROM event_logs
+            WHERE app_id = %s AND level_num BETWEEN 0 AND 5000
+            ORDER BY level_num
+        """, (app_id,))
 
-        for r in rows:
-            json_str = r[0]
-            data = universal_flatten(json_str)
-            
-            # [LOGIC V116: TÌM ỨNG VIÊN LỚN NHẤT]
-            candidates = []
-            
-            # 1. Quét qua các key tiềm năng
-            keys_to_check = ['levelID', 'level_display', 'missionID', 'dayChallenge']
-            for k in keys_to_check:
-                val = data.get(k)
-                if val and str(val).isdigit():
-                    candidates.append(int(val))
-            
-            # 2. Regex Fallback
-            if not candidates:
-                match = re.search(r'(?:levelID|level_display|missionID)[^0-9]{1,10}(\d+)', json_str)
-                if match:
-                    candidates.append(int(match.group(1)))
-            
-            # 3. Chọn Level chuẩn
-            if candidates:
-                max_lvl = max(candidates)
-                if 0 <= max_lvl <= 5000: # Giới hạn 5000 để lọc rác
-                    levels.add(max_lvl)
-        
         # Sort số -> string
-        sorted_levels = sorted(list(levels))
-        return jsonify([str(l) for l in sorted_levels])
+        return jsonify([str(r[0]) for r in cur.fetchall()])
 
     except Exception as e:
         print(f"Error get_levels: {e}")
@@ -1976,13 +2141,13 @@ def get_level_detail(app_id):
                         BOOSTER_PRICES[k] = int(b.get('price', 100))
         except: pass
 
-        # 2. QUERY
+        # 2. QUERY (Lọc level ngay trong SQL bằng cột level_num)
+        target_lvl_int = int(level_id) if level_id and level_id.isdigit() else None
+
         where = "WHERE app_id = %s"; params = [app_id]
         if start_date: where += " AND created_at >= %s"; params.append(start_date + " 00:00:00")
         if end_date: where += " AND created_at <= %s"; params.append(end_date + " 23:59:59")
-        
-        cur.execute(f"SELECT created_at, event_name, event_json FROM event_logs {where} ORDER BY created_at ASC", tuple(params))
-        all_rows = cur.fetchall()
+        if target_lvl_int is not None: where += " AND level_num = %s"; params.append(target_lvl_int)
 
         # 3. PROCESS
         metrics = {"start":0, "win":0, "fail":0, "spend":0, "rev":0}
@@ -2006,51 +2171,24 @@ def get_level_detail(app_id):
             s = re.sub(r'[^\d]', '', str(val))
             return int(s) if s else 0
 
-        target_lvl_int = int(level_id) if level_id and level_id.isdigit() else None
-        processing_list = []
+        # 4. PROCESS (Dữ liệu đã sort theo user + thời gian từ SQL, đọc từng lô qua server-side cursor)
+        total_rec = 0
+        for evt, uid, coin_cost, boosters in stream_rows(conn, f"""
+            SELECT event_name, COALESCE(user_uid, 'unknown') AS uid, coin_cost, booster_counts
+            FROM event_logs {where}
+            ORDER BY uid, created_at ASC
+        """, tuple(params), name="level_detail"):
+            total_rec += 1
+            boosters = boosters or {}
 
-        # 4. FILTER
-        for r in all_rows:
-            json_str = r['event_json']
-            data = universal_flatten(json_str)
-            
-            if target_lvl_int is not None:
-                candidates = []
-                for k in ['levelID', 'level_display', 'missionID', 'dayChallenge']:
-                    val = data.get(k)
-                    if val and str(val).isdigit(): candidates.append(int(val))
-                if not candidates:
-                    match = re.search(r'(?:levelID|level_display|missionID)[^0-9]{1,10}(\d+)', json_str)
-                    if match: candidates.append(int(match.group(1)))
-                if not candidates or max(candidates) != target_lvl_int: continue
-
-            uid = data.get('userID') or data.get('uuid') or data.get('user_id') or "unknown"
-            r['parsed'] = data
-            r['temp_uid'] = uid 
-            processing_list.append(r)
-
-        # 5. SORT
-        processing_list.sort(key=lambda x: (x['temp_uid'], x['created_at']))
-
-        for r in processing_list:
-            data = r['parsed']
-            evt = r['event_name']
-            uid = r['temp_uid']
-            
-            cost = 0
-            raw_money = (data.get('coin_spent') or data.get('cost') or data.get('priceSpendLevel') or data.get('coinCost'))
-            if not raw_money and evt.lower() == 'pricespendlevel':
-                 for v in data.values():
-                     v_c = clean_money(v)
-                     if v_c > 0 and v_c < 100000: raw_money = v_c; break
-            cost = clean_money(raw_money)
+            cost = coin_cost or 0
 
             if cost == 0:
-                for k, v in data.items():
-                    if ('booster' in k or 'revive' in k) and str(v).isdigit() and int(v) > 0:
+                for k, v in boosters.items():
+                    if v > 0:
                         clean_key = k.replace('booster_', '').replace('revive_', '').lower()
                         if clean_key in BOOSTER_PRICES:
-                            cost += (int(v) * BOOSTER_PRICES[clean_key])
+                            cost += (v * BOOSTER_PRICES[clean_key])
 
             if cost > 0:
                 metrics['spend'] += 1
@@ -2071,13 +2209,13 @@ def get_level_detail(app_id):
                     fail_costs.append(user_sessions[uid])
                     del user_sessions[uid]
 
-            for k, v in data.items():
-                if ('booster' in k or 'revive' in k) and str(v).isdigit() and int(v) > 0:
+            for k, v in boosters.items():
+                if v > 0:
                     clean = k.replace('booster_', '').replace('revive_', '').lower()
                     if clean in BOOSTER_PRICES:
-                        booster_counts[clean] += int(v)
+                        booster_counts[clean] += v
 
-        # 6. OUTPUT
+        # 5. OUTPUT
         avg_win_cost = sum(win_costs) / len(win_costs) if win_costs else 0
         avg_fail_cost = sum(fail_costs) / len(fail_costs) if fail_costs else 0
         cost_arr = []
@@ -2114,13 +2252,17 @@ def get_level_detail(app_id):
         b_list = list(merged_boosters.values())
         b_list.sort(key=lambda x: x['usage_count'], reverse=True)
 
-        processing_list.sort(key=lambda x: x['created_at'], reverse=True)
-        total_rec = len(processing_list)
-        paged_data = processing_list[offset : offset + limit]
+        # Chỉ parse JSON cho đúng trang log đang xem
+        cur.execute(f"""
+            SELECT created_at, event_name, COALESCE(user_uid, 'unknown') AS uid, event_json
+            FROM event_logs {where}
+            ORDER BY created_at DESC LIMIT %s OFFSET %s
+        """, tuple(params + [limit, offset]))
+        paged_data = cur.fetchall()
         proc_logs = []
-        
+
         for r in paged_data:
-            d = r['parsed']
+            d = flatten_event(r['event_json'])
             details = []
             c_spent = d.get('coin_spent') or d.get('cost') or d.get('priceSpendLevel')
             if c_spent: details.append(f"💸 -{c_spent}")
@@ -2136,7 +2278,7 @@ def get_level_detail(app_id):
 
             proc_logs.append({
                 "time": r['created_at'].strftime('%H:%M:%S %d/%m'),
-                "user_id": str(r['temp_uid'])[:8]+"..",
+                "user_id": str(r['uid'])[:8]+"..",
                 "event_name": r['event_name'],
                 "coin_spent": int(clean_money(c_spent) or 0),
                 "item_name": " | ".join(details) if details else "-"
@@ -2168,6 +2310,7 @@ def get_level_detail(app_id):
     finally: conn.close()
 
 @app.route("/dashboard/<int:app_id>/strategic", methods=['GET'])
+@cached_response()
 def get_strategic_overview(app_id):
     conn = get_db()
     if not conn: return jsonify({"success": False, "error": "DB error"}), 500
@@ -2184,33 +2327,25 @@ def get_strategic_overview(app_id):
         if start_date: where += " AND created_at >= %s"; params.append(start_date + " 00:00:00")
         if end_date: where += " AND created_at <= %s"; params.append(end_date + " 23:59:59")
         
-        cur.execute(f"SELECT event_name, event_json FROM event_logs {where}", tuple(params))
+        # [TYPED COLUMNS] Gom nhóm theo level_num trong SQL
+        cur.execute(f"""
+            SELECT level_num, event_name, COUNT(*) AS cnt, COALESCE(SUM(coin_cost), 0) AS coin_sum
+            FROM event_logs {where} AND level_num BETWEEN 0 AND 2000
+            GROUP BY level_num, event_name
+        """, tuple(params))
         rows = cur.fetchall()
-        
-        stats = {} 
+
+        stats = {}
 
         for r in rows:
-            data = universal_flatten(r['event_json'])
-            
-            # Tìm Level
-            lvl_raw = data.get('levelID') or data.get('level_display') or data.get('missionID')
-            if not lvl_raw: continue
-            
-            # Lấy số level
-            digits = ''.join(filter(str.isdigit, str(lvl_raw)))
-            if not digits: continue
-            lvl_num = int(digits)
-            if lvl_num > 2000: continue
-            
+            lvl_num = r['level_num']
             if lvl_num not in stats: stats[lvl_num] = {"plays": 0, "fails": 0, "rev": 0}
-            
+
             evt = r['event_name']
-            if evt in start_set: stats[lvl_num]['plays'] += 1
-            elif evt in fail_set: stats[lvl_num]['fails'] += 1
-            
-            money = data.get('coin_spent') or data.get('coin_cost') or 0
-            try: stats[lvl_num]['rev'] += float(money)
-            except: pass
+            if evt in start_set: stats[lvl_num]['plays'] += r['cnt']
+            elif evt in fail_set: stats[lvl_num]['fails'] += r['cnt']
+
+            stats[lvl_num]['rev'] += float(r['coin_sum'])
 
         chart = []
         for lvl, val in stats.items():
@@ -2237,8 +2372,11 @@ def delete_single_history(id):
     conn = get_db()
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM job_history WHERE id = %s", (id,))
+        cur.execute("DELETE FROM job_log_lines WHERE job_id IN (SELECT id FROM job_history WHERE id = %s OR parent_job_id = %s)", (id, id))
+        cur.execute("DELETE FROM job_history WHERE id = %s OR parent_job_id = %s RETURNING id", (id, id)) # Job cha backfill: xóa luôn các job con
+        deleted = [row[0] for row in cur.fetchall()]
         conn.commit()
+        for job_id in deleted: remove_spool(job_id)
         return jsonify({"success": True, "msg": f"Deleted history #{id}"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -2256,11 +2394,24 @@ def stop_etl_process(hist_id):
             JOB_STOP_EVENTS[hist_id].set() # Đánh thức Worker ngay lập tức
         cur = conn.cursor()
         # Cập nhật DB
+        # Job còn 'pending' cũng dừng được: job đang chờ lượt, job bị 429 hẹn chạy lại (scheduled_at tương lai),
+        # job cha backfill có cửa sổ chưa chạy. Worker chỉ claim dòng 'pending' nên dòng Cancelled không bị chạy lại.
         cur.execute("""
             UPDATE job_history 
-            SET status = 'Cancelled', end_time = NOW(), logs = logs || E'\n[USER MANUAL STOP]'
-            WHERE id = %s AND status IN ('Running', 'Processing')
+            SET status = 'Cancelled', end_time = NOW()
+            WHERE id = %s AND status IN ('Running', 'Processing', 'pending')
+            RETURNING window_total, parent_job_id
         """, (hist_id,))
+        row = cur.fetchone()
+        if row:
+            cur.execute("INSERT INTO job_log_lines (job_id, line) VALUES (%s, '[USER MANUAL STOP]')", (hist_id,))
+            if row[0]:
+                for child_id in cancel_children(cur, hist_id):
+                    if child_id in JOB_STOP_EVENTS: JOB_STOP_EVENTS[child_id].set()
+                rollup_parent(cur, hist_id)
+            elif row[1]:
+                # Dừng riêng 1 cửa sổ backfill -> chốt lại job cha nếu đó là cửa sổ cuối
+                rollup_parent(cur, row[1])
         conn.commit()
 
         # 3. Reset hệ thống nếu cần
@@ -2324,11 +2475,41 @@ def handle_analytics_config(app_id):
 # --- API CHẠY ETL (TỔNG HỢP DỮ LIỆU) ---
 @app.route("/api/run-etl/<int:app_id>", methods=['POST'])
 def trigger_etl_process(app_id):
+    # Mặc định chỉ tổng hợp phần log mới (watermark); ?mode=full để dựng lại toàn bộ
+    full = request.args.get('mode', 'incremental').lower() == 'full'
     # Chạy trong thread riêng để không block server
-    threading.Thread(target=run_etl_pipeline, args=(app_id,)).start()
-    return jsonify({"status": "started", "message": "ETL process started in background"})
+    threading.Thread(target=run_etl_pipeline, args=(app_id, full)).start()
+    return jsonify({"status": "started", "mode": "full" if full else "incremental", "message": "ETL process started in background"})
 
 # --- API MỚI: TRA CỨU DỮ LIỆU THÔ (DATA EXPLORER) - FIXED TIMEZONE & PARAMS ---
+SEARCH_LEVEL_KEYS = ('levelID', 'level_display', 'missionID', 'dayChallenge')
+# Đếm chính xác tối đa bấy nhiêu dòng; nhiều hơn thì dùng ước lượng của planner (Data Explorer không phải chờ COUNT cả bảng)
+SEARCH_COUNT_CAP = int(os.getenv("SEARCH_COUNT_CAP", "10000"))
+
+def level_json_probes(level):
+    """Các mẫu JSON cho phép chứa (@>) tương ứng 1 level; game ghi số lúc dạng số, lúc dạng chuỗi"""
+    values = [level]
+    if level.isdigit(): values.append(int(level))
+    return [dumps_json({key: val}) for key in SEARCH_LEVEL_KEYS for val in values]
+
+def count_search_rows(conn, full_where, params, cap=SEARCH_COUNT_CAP):
+    """
+    (tổng số dòng, có phải ước lượng không).
+    Đếm thật nhưng dừng ở cap + 1 dòng; vượt cap thì lấy số dòng planner ước lượng (không nhỏ hơn cap + 1).
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM event_logs {full_where} LIMIT %s) t", tuple(params) + (cap + 1,))
+        total = cur.fetchone()[0]
+        if total <= cap:
+            return total, False
+        cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM event_logs {full_where}", tuple(params))
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str): plan = json.loads(plan)
+        return max(int(plan[0]['Plan']['Plan Rows']), cap + 1), True
+    finally:
+        cur.close()
+
 @app.route("/events/search", methods=['GET'])
 def search_events():
     try:
@@ -2344,9 +2525,15 @@ def search_events():
         event_name = request.args.get('event_name')
         keyword = request.args.get('keyword') 
         level_filter = request.args.get('level')
+        # Phân trang keyset: FE gửi lại next_cursor / prev_cursor của lần trước (không gửi = dùng page như cũ)
+        page_cursor = request.args.get('cursor')
 
         if not app_id:
             return jsonify({"success": False, "error": "Missing app_id"}), 400
+        try:
+            ks_where, ks_params, order_by, is_prev = keyset_query_parts(page_cursor, "event_logs.created_at", "event_logs.id")
+        except CursorError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
 
         conn = get_db()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -2355,75 +2542,65 @@ def search_events():
         where_clauses = ["app_id = %s"]
         params = [app_id]
 
-        if start_date:
-            # [FIX TIMEZONE] Ép DB convert sang giờ VN trước khi so sánh
-            where_clauses.append("(created_at + interval '7 hours') >= %s")
-            params.append(start_date + " 00:00:00")
-        if end_date:
-            # [FIX TIMEZONE] Ép DB convert sang giờ VN trước khi so sánh
-            where_clauses.append("(created_at + interval '7 hours') <= %s")
-            params.append(end_date + " 23:59:59")
+        # [FIX TIMEZONE] Ngày VN -> khoảng UTC tính sẵn, so sánh thẳng created_at (ăn index & phân vùng)
+        date_clauses, date_params = created_at_filter(start_date, end_date)
+        where_clauses += date_clauses
+        params += date_params
 
         if event_name and event_name.strip():
             where_clauses.append("event_name = %s")
             params.append(event_name)
 
+        # Keyword: ILIKE trên event_json::text -> ăn trigram index idx_event_logs_json_trgm (api/schema.py)
         if keyword and keyword.strip():
             where_clauses.append("event_json::text ILIKE %s")
             params.append(f"%{keyword}%")
 
-        # Logic lọc Level (Regex)
+        # Lọc Level: số -> cột level_num trích sẵn lúc ingest (index app_id, level_num);
+        # giá trị không phải số -> event_json @> {"levelID": "..."} (GIN index)
         if level_filter and level_filter.strip():
-            regex_pat = f'(levelID|level_display|missionID|dayChallenge)[^0-9a-zA-Z]+{level_filter}(\\D|$)'
-            where_clauses.append("event_json::text ~* %s")
-            params.append(regex_pat)
+            level_filter = level_filter.strip()
+            if level_filter.isdigit():
+                where_clauses.append("level_num = %s")
+                params.append(int(level_filter))
+            else:
+                probes = level_json_probes(level_filter)
+                where_clauses.append("(" + " OR ".join(["event_json @> %s::jsonb"] * len(probes)) + ")")
+                params += probes
 
         full_where = " WHERE " + " AND ".join(where_clauses)
 
-        # 2. Đếm tổng số dòng
-        count_query = f"SELECT COUNT(*) as total FROM event_logs {full_where}"
-        cursor.execute(count_query, tuple(params))
-        total_records = cursor.fetchone()['total']
-        total_pages = (total_records + limit - 1) // limit
+        # 2. Đếm tổng số dòng (có trần, quá trần thì ước lượng). Chế độ cursor không đếm lại mỗi trang
+        total_records = total_pages = total_estimated = None
+        if not page_cursor:
+            total_records, total_estimated = count_search_rows(conn, full_where, params)
+            total_pages = (total_records + limit - 1) // limit
 
         # 3. Lấy dữ liệu phân trang (CÓ FIX TIMEZONE)
-        offset = (page - 1) * limit
+        # Có cursor: lấy các dòng sau mốc (created_at, id), không OFFSET. Lấy dư 1 dòng để biết còn trang sau không
+        offset = 0 if page_cursor else (page - 1) * limit
+        data_where = " WHERE " + " AND ".join(where_clauses + ks_where)
         time_column = "to_char(created_at, 'DD/MM/YYYY HH24:MI:SS') || ' (VN: ' || to_char(created_at + interval '7 hours', 'DD/MM/YYYY HH24:MI:SS') || ')'"
         data_query = f"""
-            SELECT id, event_name, {time_column} as created_at, event_json
+            SELECT id, event_name, {time_column} as created_at, created_at AS _cursor_ts, event_json
             FROM event_logs 
-            {full_where}
-            ORDER BY created_at DESC
+            {data_where}
+            ORDER BY {order_by}
             LIMIT %s OFFSET %s
         """
         
         # [AN TOÀN]: Tạo list mới cho query này thay vì extend list cũ để tránh lỗi "Sốc thuốc"
-        final_params = params + [limit, offset]
+        final_params = params + ks_params + [limit + 1, offset]
         
         cursor.execute(data_query, tuple(final_params))
-        rows = cursor.fetchall()
+        rows, next_cursor, prev_cursor = keyset_page(cursor.fetchall(), limit, is_prev, bool(page_cursor) or page > 1)
 
         # 4. Xử lý hiển thị (Key Info)
         import json
         for row in rows:
             try:
                 # Parse JSON đa năng
-                raw = row['event_json']
-                parsed = {}
-
-                if isinstance(raw, str):
-                    try: parsed = json.loads(raw)
-                    except: parsed = {}
-                elif isinstance(raw, dict):
-                    parsed = raw 
-                
-                # Flatten double-encoded json
-                if isinstance(parsed, dict) and 'event_json' in parsed and isinstance(parsed['event_json'], str):
-                    try:
-                        inner = json.loads(parsed['event_json'])
-                        parsed.update(inner)
-                    except: pass
-                
+                parsed = flatten_event(row['event_json'])
                 row['event_json'] = parsed
                 data = parsed 
                 
@@ -2481,10 +2658,13 @@ def search_events():
             "success": True,
             "data": rows,
             "pagination": {
-                "current_page": page,
+                "current_page": None if page_cursor else page,
                 "total_pages": total_pages,
                 "total_records": total_records,
-                "limit": limit
+                "total_estimated": total_estimated,
+                "limit": limit,
+                "next_cursor": next_cursor,
+                "prev_cursor": prev_cursor
             }
         })
 
@@ -2495,7 +2675,103 @@ def search_events():
         conn.close()
 
 # --- API DATA CHECK (PHIÊN BẢN HỒI SỨC: DEEP UNPACK + PYTHON FILTER) ---
+DATA_CHECK_IGNORED_BOOSTERS = ['carpaint'] # Chỉ vứt rác thật sự
+# SỔ THÔNG DỊCH: Map tên cũ (key) sang tên mới (value)
+DATA_CHECK_BOOSTER_MAP = {
+    'ufo': 'changehole',
+    'shuffle': 'balloon'
+}
+
+def load_data_check_stats(cur, app_id, start_date=None, end_date=None, filter_ver=None, filter_geo=None, max_level=None):
+    """
+    Gom số liệu Data Check theo level (dùng chung cho API + Export Excel).
+    - Số liệu cộng dồn (plays, timeplay, booster) đọc từ rollup level_daily_stats.
+    - Số user start/win và next_drop tính từ bitmap user của rollup (gộp được qua nhiều ngày).
+    Trả về (stats, all_boosters_found). Các query đọc qua server-side cursor trên connection của cur.
+    """
+    conn = cur.connection
+    # 1. ROLLUP (ngày trong rollup đã là ngày giờ VN)
+    roll_where = ["app_id = %s"]; roll_params = [app_id]
+    if start_date: roll_where.append("stat_date >= %s"); roll_params.append(start_date)
+    if end_date: roll_where.append("stat_date <= %s"); roll_params.append(end_date)
+    if filter_ver and filter_ver != 'all': roll_where.append("app_version_name = %s"); roll_params.append(str(filter_ver))
+    if filter_geo and filter_geo != 'all': roll_where.append("country_iso_code = %s"); roll_params.append(str(filter_geo))
+    if max_level is not None: roll_where.append("level_num <= %s"); roll_params.append(max_level)
+    roll_where = " AND ".join(roll_where)
+
+    stats = {}
+    for lvl, total_plays, timeplay_sum, timeplay_count in stream_rows(conn, f"""
+        SELECT level_num, SUM(total_plays) AS total_plays,
+               SUM(timeplay_sum) AS timeplay_sum, SUM(timeplay_count) AS timeplay_count
+        FROM level_daily_stats
+        WHERE {roll_where}
+        GROUP BY level_num
+    """, tuple(roll_params), name="data_check_levels"):
+        stats[lvl] = {
+            "user_start": 0, "user_win": 0, "next_drop": 0, "total_plays": int(total_plays),
+            "boosters": {}, # Không hardcode bubble/shuffle nữa
+            "timeplay_sum": float(timeplay_sum), "timeplay_count": int(timeplay_count), "total_revive": 0
+        }
+
+    # DÒ TỰ ĐỘNG + BỘ LỌC RÁC + ĐỒNG BỘ TÊN (ALIAS MAPPING)
+    all_boosters_found = set() # Rổ hứng mọi loại Booster trên đời
+    for lvl, key, qty in stream_rows(conn, f"""
+        SELECT level_num, b.key, SUM(b.value::bigint) AS qty
+        FROM level_daily_stats CROSS JOIN LATERAL jsonb_each_text(booster_totals) b
+        WHERE {roll_where} AND b.key LIKE 'booster\\_%%'
+        GROUP BY level_num, b.key
+    """, tuple(roll_params), name="data_check_boosters"):
+        s = stats.get(lvl)
+        if s is None: continue
+        clean_k = key.replace('booster_', '').lower()
+        if clean_k in DATA_CHECK_IGNORED_BOOSTERS: continue
+        clean_k = DATA_CHECK_BOOSTER_MAP.get(clean_k, clean_k)
+
+        all_boosters_found.add(clean_k)
+        qty = int(qty)
+        if qty > 0:
+            s['boosters'][clean_k] = s['boosters'].get(clean_k, 0) + qty
+
+    # 2. USER START / WIN: gộp bitmap user theo level (OR qua các ngày / version / geo)
+    # Duyệt level tăng dần, chỉ giữ bitmap win của level liền trước -> bộ nhớ không phụ thuộc độ dài khoảng ngày
+    bitmap_rows = stream_rows(conn, f"""
+        SELECT level_num, start_users, win_users
+        FROM level_daily_stats
+        WHERE {roll_where} AND (start_users IS NOT NULL OR win_users IS NOT NULL)
+        ORDER BY level_num
+    """, tuple(roll_params), name="data_check_bitmaps")
+
+    def merged_levels():
+        lvl, starts, wins = None, 0, 0
+        for level_num, start_users, win_users in bitmap_rows:
+            if level_num != lvl:
+                if lvl is not None: yield lvl, starts, wins
+                lvl, starts, wins = level_num, 0, 0
+            starts |= decode_bitmap(start_users)
+            wins |= decode_bitmap(win_users)
+        if lvl is not None: yield lvl, starts, wins
+
+    merged = merged_levels()
+    pending = next(merged, None)
+    win_prev = 0
+    for lvl in sorted(stats.keys()):
+        starts = wins = 0
+        if pending and pending[0] == lvl:
+            _, starts, wins = pending
+            pending = next(merged, None)
+
+        s = stats[lvl]
+        s['user_start'] = bitmap_count(starts)
+        s['user_win'] = bitmap_count(wins)
+        # Người thắng level trước nhưng không bắt đầu level này
+        n_prev = bitmap_count(win_prev)
+        s['next_drop'] = round((bitmap_count(win_prev & ~starts) / n_prev) * 100, 2) if n_prev > 0 else 0
+        win_prev = wins
+
+    return stats, all_boosters_found
+
 @app.route("/api/data-check/<int:app_id>", methods=['GET'])
+@cached_response()
 def get_data_check(app_id):
     conn = get_db()
     if not conn: return jsonify({"success": False}), 500
@@ -2514,125 +2790,9 @@ def get_data_check(app_id):
 
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # 3. Query DB (Chỉ lọc theo Ngày + App ID để tối ưu index)
-        where_clauses = ["app_id = %s"]
-        params = [app_id]
-
-        if start_date:
-            # [FIX TIMEZONE] Ép DB convert sang giờ VN trước khi so sánh
-            where_clauses.append("(created_at + interval '7 hours') >= %s")
-            params.append(start_date + " 00:00:00")
-        if end_date:
-            # [FIX TIMEZONE] Ép DB convert sang giờ VN trước khi so sánh
-            where_clauses.append("(created_at + interval '7 hours') <= %s")
-            params.append(end_date + " 23:59:59")
-        
-        full_where = " AND ".join(where_clauses)
-        
-        cur.execute(f"""
-            SELECT event_name, event_json 
-            FROM event_logs 
-            WHERE {full_where}
-        """, tuple(params))
-        
-        rows = cur.fetchall()
-
-        # 4. Xử lý dữ liệu (Aggregation & Deep Parse)
-        stats = {}
-        all_boosters_found = set() # CHÌA KHÓA MỚI: Rổ hứng mọi loại Booster trên đời
-        start_events = {"level_start", "missionStart", "missionStart_Daily", "level_first_start"}
-        win_events = {"level_win", "missionComplete", "missionComplete_Daily", "level_first_end"}
-        end_events = win_events.union({"level_lose", "missionFail", "missionFail_Daily"})
-        
-        import json
-
-        for r in rows:
-            evt_name = r['event_name']
-            raw_json = r['event_json']
-            
-            data = {}
-            if isinstance(raw_json, str):
-                try: data = json.loads(raw_json)
-                except: continue
-            else: data = raw_json if raw_json else {}
-
-            if 'event_json' in data and isinstance(data['event_json'], str):
-                try:
-                    inner = json.loads(data['event_json'])
-                    if isinstance(inner, dict): data.update(inner) 
-                except: pass
-
-            if filter_ver and filter_ver != 'all' and str(data.get('app_version_name', '')) != str(filter_ver): continue
-            if filter_geo and filter_geo != 'all' and str(data.get('country_iso_code', '')) != str(filter_geo): continue
-
-            lvl = None
-            for k in ['level_display', 'levelID', 'missionID', 'level']:
-                if k in data and str(data[k]).isdigit():
-                    lvl = int(data[k])
-                    break
-            
-            if lvl is None: continue 
-            
-            # Khởi tạo struct (Booster rỗng để hứng tự động)
-            if lvl not in stats:
-                stats[lvl] = {
-                    "user_start_set": set(), "user_win_set": set(), "total_plays": 0,
-                    "boosters": {}, # Không hardcode bubble/shuffle nữa
-                    "timeplay_sum": 0, "timeplay_count": 0, "total_revive": 0
-                }
-            
-            s = stats[lvl]
-            uid = data.get('uuid') or data.get('userID') or data.get('device_id') or "unknown"
-
-            if evt_name in start_events:
-                s['user_start_set'].add(uid) 
-                if evt_name != "level_first_start": s['total_plays'] += 1
-            
-            elif evt_name in win_events:
-                s['user_win_set'].add(uid)
-                if evt_name != "level_first_end":
-                    tm = data.get('timeplay') or data.get('duration') or data.get('timePlay')
-                    if tm:
-                        try: 
-                            val = float(tm)
-                            if 0 < val < 7200: 
-                                s['timeplay_sum'] += val
-                                s['timeplay_count'] += 1
-                        except: pass
-
-            if evt_name in end_events:
-                # Dò Tự Động Mọi Loại Booster + BỘ LỌC RÁC
-                IGNORED_BOOSTERS = ['carpaint'] # Danh sách đen các booster không dùng nữa
-                BOOSTER_MAP = {
-                'ufo': 'changehole',
-                'shuffle': 'balloon'
-                }
-            # DÒ TỰ ĐỘNG + BỘ LỌC RÁC + ĐỒNG BỘ TÊN (ALIAS MAPPING)
-            IGNORED_BOOSTERS = ['carpaint'] # Chỉ vứt rác thật sự
-            
-            # SỔ THÔNG DỊCH: Map tên cũ (key) sang tên mới (value)
-            BOOSTER_MAP = {
-                'ufo': 'changehole',
-                'shuffle': 'balloon'
-            }
 
-            for k, v in data.items():
-                if k.startswith('booster_') and str(v).lstrip('-').isdigit():
-                    clean_k = k.replace('booster_', '').lower()
-                    
-                    # 1. Quét radar xem có phải rác không
-                    if clean_k in IGNORED_BOOSTERS:
-                        continue
-                        
-                    # 2. [MA THUẬT Ở ĐÂY]: Phiên dịch tên cũ sang tên mới
-                    if clean_k in BOOSTER_MAP:
-                        clean_k = BOOSTER_MAP[clean_k]
-                        
-                    # 3. Bỏ vào rổ và đếm số
-                    all_boosters_found.add(clean_k)
-                    if int(v) > 0:
-                        s['boosters'][clean_k] = s['boosters'].get(clean_k, 0) + int(v)
+        # 3 + 4. Query & Aggregation (lọc ngày/version/geo bằng cột kiểu ngay trong SQL)
+        stats, all_boosters_found = load_data_check_stats(cur, app_id, start_date, end_date, filter_ver, filter_geo)
 
         # 5. Tổng hợp báo cáo
         report = []
@@ -2640,21 +2800,14 @@ def get_data_check(app_id):
         
         for i, lvl in enumerate(sorted_levels):
             s = stats[lvl]
-            u_start = len(s['user_start_set'])
-            u_win = len(s['user_win_set'])
+            u_start = s['user_start']
+            u_win = s['user_win']
             if u_start < u_win: u_start = u_win 
             
             level_drop = round(((u_start - u_win) / u_start) * 100, 2) if u_start > 0 else 0
             play_count = round(s['total_plays'] / u_start, 2) if u_start > 0 else 0
 
-            next_drop = 0 
-            if i > 0:
-                prev_lvl = sorted_levels[i-1]
-                win_prev_set = stats[prev_lvl]['user_win_set']
-                start_current_set = s['user_start_set']
-                if len(win_prev_set) > 0:
-                    drop_users = win_prev_set - start_current_set
-                    next_drop = round((len(drop_users) / len(win_prev_set)) * 100, 2)
+            next_drop = s['next_drop'] # Đã tính sẵn từ bitmap (win level trước - start level này)
 
             total_b = sum(s.get('boosters', {}).values())
             total_r = s.get('total_revive', 0)
@@ -2712,76 +2865,44 @@ def get_dropped_users(app_id):
 
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        where_clauses = ["app_id = %s"]
-        params = [app_id]
+        # Đọc bitmap user start / win của level từ rollup (ngày trong rollup là giờ VN)
+        where_clauses = ["app_id = %s", "level_num = %s"]
+        params = [app_id, target_level]
 
         if start_date:
-            where_clauses.append("(created_at + interval '7 hours') >= %s")
-            params.append(start_date + " 00:00:00")
+            where_clauses.append("stat_date >= %s"); params.append(start_date)
         if end_date:
-            where_clauses.append("(created_at + interval '7 hours') <= %s")
-            params.append(end_date + " 23:59:59")
+            where_clauses.append("stat_date <= %s"); params.append(end_date)
+        if filter_ver and filter_ver != 'all':
+            where_clauses.append("app_version_name = %s"); params.append(str(filter_ver))
 
         full_where = " AND ".join(where_clauses)
-        
-        # Tối ưu: Chỉ lôi nhóm Start và Win lên RAM để tính toán cho nhanh
         cur.execute(f"""
-            SELECT event_name, event_json 
-            FROM event_logs 
+            SELECT start_users, win_users
+            FROM level_daily_stats
             WHERE {full_where}
-              AND event_name IN ('level_start', 'missionStart', 'missionStart_Daily', 'level_first_start', 'level_win', 'missionComplete', 'missionComplete_Daily', 'level_first_end')
         """, tuple(params))
-        
-        rows = cur.fetchall()
-        start_set = set()
-        win_set = set()
-        
-        import json
-        for r in rows:
-            evt_name = r['event_name']
-            raw_json = r['event_json']
-            
-            data = {}
-            if isinstance(raw_json, str):
-                try: data = json.loads(raw_json)
-                except: continue
-            else: data = raw_json if raw_json else {}
-
-            # Giải nén sâu lấy UID thật (Mũi tiêm làm nên sự khác biệt)
-            if 'event_json' in data and isinstance(data['event_json'], str):
-                try:
-                    inner = json.loads(data['event_json'])
-                    if isinstance(inner, dict): data.update(inner)
-                except: pass
 
-            if filter_ver and filter_ver != 'all':
-                if str(data.get('app_version_name', '')) != str(filter_ver): continue
+        start_bits = 0
+        win_bits = 0
+        for r in cur.fetchall():
+            start_bits |= decode_bitmap(r['start_users'])
+            win_bits |= decode_bitmap(r['win_users'])
 
-            # Xác định Level
-            lvl = None
-            for k in ['level_display', 'levelID', 'missionID', 'level']:
-                if k in data and str(data[k]).isdigit():
-                    lvl = int(data[k])
-                    break
-            
-            if lvl != target_level: continue 
-            
-            # Khóa mục tiêu UID
-            uid = data.get('uuid') or data.get('userID') or data.get('device_id') or "unknown"
-            
-            if evt_name in {"level_start", "missionStart", "missionStart_Daily", "level_first_start"}:
-                start_set.add(uid)
-            elif evt_name in {"level_win", "missionComplete", "missionComplete_Daily", "level_first_end"}:
-                win_set.add(uid)
+        # Dịch số thứ tự user về UID thật
+        cur.execute("""
+            SELECT user_uid FROM user_dictionary
+            WHERE app_id = %s AND user_idx = ANY(%s)
+            ORDER BY user_idx
+        """, (app_id, list(iter_bitmap_indexes(start_bits & ~win_bits))))
+        dropped_uuids = [r['user_uid'] for r in cur.fetchall()]
 
-        # PHÉP THUẬT Ở ĐÂY: Lấy tập Start trừ tập Win
-        dropped_uuids = list(start_set - win_set)
-        
+        # PHÉP THUẬT Ở ĐÂY: Tập Start trừ tập Win (start_bits & ~win_bits ở trên)
         return jsonify({
             "success": True, 
             "level": target_level,
-            "total_start": len(start_set),
-            "total_win": len(win_set),
+            "total_start": bitmap_count(start_bits),
+            "total_win": bitmap_count(win_bits),
             "dropped_count": len(dropped_uuids),
             "dropped_uuids": dropped_uuids # Trả thẳng danh sách mã UID ra ngoài
         })
@@ -2865,102 +2986,9 @@ def export_datacheck_excel(app_id):
     
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # 3. Query DB
-        where_clauses = ["app_id = %s"]
-        params = [app_id]
-        if start_date:
-            # [FIX TIMEZONE] Ép DB convert sang giờ VN trước khi so sánh
-            where_clauses.append("(created_at + interval '7 hours') >= %s")
-            params.append(start_date + " 00:00:00")
-        if end_date:
-            # [FIX TIMEZONE] Ép DB convert sang giờ VN trước khi so sánh
-            where_clauses.append("(created_at + interval '7 hours') <= %s")
-            params.append(end_date + " 23:59:59")
-            
-        full_where = " AND ".join(where_clauses)
-        cur.execute(f"SELECT event_name, event_json FROM event_logs WHERE {full_where}", tuple(params))
-        rows = cur.fetchall()
-
-        # 4. Xử lý dữ liệu (Aggregation & Deep Parse)
-        stats = {}
-        all_boosters_found = set()
-        start_events = {"level_start", "missionStart", "missionStart_Daily", "level_first_start"}
-        win_events = {"level_win", "missionComplete", "missionComplete_Daily", "level_first_end"}
-
-        for r in rows:
-            evt_name = r['event_name']
-            raw_json = r['event_json']
-            
-            data = {}
-            if isinstance(raw_json, str):
-                try: data = json.loads(raw_json)
-                except: continue
-            else: data = raw_json if raw_json else {}
-
-            if 'event_json' in data and isinstance(data['event_json'], str):
-                try:
-                    inner = json.loads(data['event_json'])
-                    if isinstance(inner, dict): data.update(inner)
-                except: pass
 
-            if filter_ver and filter_ver != 'all' and str(data.get('app_version_name', '')) != str(filter_ver): continue
-            if filter_geo and filter_geo != 'all' and str(data.get('country_iso_code', '')) != str(filter_geo): continue
-
-            lvl = None
-            for k in ['level_display', 'levelID', 'missionID', 'level']:
-                if k in data and str(data[k]).isdigit():
-                    lvl = int(data[k])
-                    break
-            if lvl is None or lvl > 10000: continue 
-
-            if lvl not in stats:
-                stats[lvl] = {
-                    "user_start_set": set(), "user_win_set": set(), "total_plays": 0,
-                    "boosters": {}, 
-                    "total_revive": 0,
-                    "timeplay_sum": 0, "timeplay_count": 0
-                }
-            s = stats[lvl]
-            uid = data.get('uuid') or data.get('userID') or "unknown"
-
-            if evt_name in start_events:
-                s['user_start_set'].add(uid)
-                if evt_name != "level_first_start": s['total_plays'] += 1
-            elif evt_name in win_events:
-                s['user_win_set'].add(uid)
-                if evt_name != "level_first_end":
-                    tm = data.get('timeplay') or data.get('duration')
-                    if tm:
-                        try: 
-                            val = float(tm)
-                            if 0 < val < 7200: 
-                                s['timeplay_sum'] += val
-                                s['timeplay_count'] += 1
-                        except: pass
-
-            # Đếm Booster Động
-            IGNORED_BOOSTERS = ['carpaint'] # BỘ LỌC RÁC: Thêm các booster muốn loại bỏ vào đây
-            BOOSTER_MAP = {
-                'ufo': 'changehole',
-                'shuffle': 'balloon'
-            }
-            for k, v in data.items():
-                if k.startswith('booster_') and str(v).lstrip('-').isdigit():
-                    clean_k = k.replace('booster_', '').lower()
-                    
-                    # 1. Quét radar xem có phải rác không
-                    if clean_k in IGNORED_BOOSTERS:
-                        continue
-                        
-                    # 2. [MA THUẬT Ở ĐÂY]: Phiên dịch tên cũ sang tên mới
-                    if clean_k in BOOSTER_MAP:
-                        clean_k = BOOSTER_MAP[clean_k]
-                        
-                    # 3. Bỏ vào rổ và đếm số
-                    all_boosters_found.add(clean_k)
-                    if int(v) > 0:
-                        s['boosters'][clean_k] = s['boosters'].get(clean_k, 0) + int(v)
+        # 3 + 4. Query & Aggregation (dùng chung logic với Data Check, bỏ level rác > 10000)
+        stats, all_boosters_found = load_data_check_stats(cur, app_id, start_date, end_date, filter_ver, filter_geo, max_level=10000)
 
         # 5. TẠO FILE EXCEL
         wb = Workbook(); ws = wb.active; ws.title = "Data Check Report"
@@ -2995,21 +3023,14 @@ def export_datacheck_excel(app_id):
         sorted_levels = sorted(stats.keys())
         for i, lvl in enumerate(sorted_levels):
             s = stats[lvl]
-            u_start = len(s['user_start_set'])
-            u_win = len(s['user_win_set'])
+            u_start = s['user_start']
+            u_win = s['user_win']
             if u_start < u_win: u_start = u_win
             
             level_drop = round(((u_start - u_win) / u_start) * 100, 2) if u_start > 0 else 0
             play_count = round(s['total_plays'] / u_start, 2) if u_start > 0 else 0
             
-            next_drop = 0
-            if i > 0:
-                prev_lvl = sorted_levels[i-1]
-                win_prev_set = stats[prev_lvl]['user_win_set']
-                start_current_set = s['user_start_set']
-                if len(win_prev_set) > 0:
-                    drop_users = win_prev_set - start_current_set
-                    next_drop = round((len(drop_users) / len(win_prev_set)) * 100, 2)
+            next_drop = s['next_drop'] # Đã tính sẵn từ bitmap (win level trước - start level này)
 
             total_b = sum(s['boosters'].values())
             total_r = s['total_revive']
@@ -3121,11 +3142,7 @@ def export_job_raw_data(job_id):
         export_data = []
         for r in rows:
             # A. Xử lý phần lõi JSON (Game logic - level, gold...)
-            try:
-                core_data = json.loads(r['event_json']) if isinstance(r['event_json'], str) else r['event_json']
-                if not isinstance(core_data, dict): core_data = {} 
-            except:
-                core_data = {}
+            core_data = flatten_event(r['event_json'], RAW_POLICY)
             
             # B. Xử lý phần vỏ (Metadata: device, city, os, mcc, mnc...)
             # Chúng ta sẽ nhét tất cả các cột của DB vào trong biến 'data' luôn
@@ -3174,6 +3191,20 @@ def export_job_raw_data(job_id):
         if conn: conn.close()
 
 # --- [API TỐI ƯU] LẤY FILTER VERSION & GEO BẰNG SQL (FIX LỖI WARNING) ---
+# Các giá trị khác nhau của 1 key trong event_json: nhảy từng giá trị trên expression index
+# (app_id, event_json->>'key') -> số bước = số giá trị khác nhau, không quét toàn bộ event của app
+DISTINCT_JSON_KEY_SQL = """
+    WITH RECURSIVE vals AS (
+        SELECT MIN(event_json->>'{key}') AS val
+        FROM event_logs WHERE app_id = %(app_id)s AND event_json->>'{key}' IS NOT NULL
+        UNION ALL
+        SELECT (SELECT MIN(event_json->>'{key}') FROM event_logs
+                WHERE app_id = %(app_id)s AND event_json->>'{key}' > vals.val)
+        FROM vals WHERE vals.val IS NOT NULL
+    )
+    SELECT val FROM vals WHERE val IS NOT NULL
+"""
+
 @app.route("/api/filters/options/<int:app_id>", methods=['GET'])
 def get_filter_options(app_id):
     conn = get_db()
@@ -3183,28 +3214,12 @@ def get_filter_options(app_id):
         cur = conn.cursor()
         
         # --- CÁCH 1: LẤY VERSION ---
-        # [FIX]: Thêm chữ r trước dấu ngoặc kép ba (r""") để Python không báo lỗi \s
-        cur.execute(r"""
-            SELECT DISTINCT substring(event_json FROM '"app_version_name":\s*"([^"]+)"') as ver
-            FROM event_logs 
-            WHERE app_id = %s 
-              AND event_json LIKE '%%app_version_name%%'
-        """, (app_id,))
-        
-        raw_versions = cur.fetchall()
-        versions = sorted([r[0] for r in raw_versions if r[0]], reverse=True)
+        cur.execute(DISTINCT_JSON_KEY_SQL.format(key='app_version_name'), {"app_id": app_id})
+        versions = sorted([r[0] for r in cur.fetchall() if r[0]], reverse=True)
 
         # --- CÁCH 2: LẤY GEO ---
-        # [FIX]: Thêm chữ r ở đây nữa
-        cur.execute(r"""
-            SELECT DISTINCT substring(event_json FROM '"country_iso_code":\s*"([^"]+)"') as geo
-            FROM event_logs 
-            WHERE app_id = %s 
-              AND event_json LIKE '%%country_iso_code%%'
-        """, (app_id,))
-        
-        raw_geos = cur.fetchall()
-        geos = sorted([r[0] for r in raw_geos if r[0]])
+        cur.execute(DISTINCT_JSON_KEY_SQL.format(key='country_iso_code'), {"app_id": app_id})
+        geos = sorted([r[0] for r in cur.fetchall() if r[0]])
         
         return jsonify({
             "versions": ["All"] + versions,
@@ -3245,8 +3260,17 @@ def create_manual_job():
         if dt_end <= dt_start:
             return jsonify({"error": "Data End Time phải lớn hơn Start Time!"}), 400
 
-        # Chèn vào DB với run_type='manual'
         cur = conn.cursor()
+        windows = plan_windows(dt_start, dt_end)
+        if len(windows) > 1:
+            # Khoảng dài: 1 job cha + mỗi cửa sổ 1 job con, các worker chạy song song (api/backfill.py)
+            new_job_id, child_ids = create_backfill_jobs(cur, app_id, windows, dt_scheduled)
+            notify_job_created(cur, new_job_id)
+            conn.commit()
+            msg = f"Đã chia thành {len(child_ids)} cửa sổ" + (" và lên lịch (Scheduled)!" if dt_scheduled else ", chạy ngay!")
+            return jsonify({"message": msg, "job_id": new_job_id, "child_job_ids": child_ids})
+
+        # Chèn vào DB với run_type='manual'
         cur.execute("""
             INSERT INTO job_history 
             (app_id, date_since, date_until, status, retry_count, created_at, scheduled_at, logs, run_type)
@@ -3255,6 +3279,7 @@ def create_manual_job():
         """, (app_id, dt_start, dt_end, dt_scheduled))
         
         new_job_id = cur.fetchone()[0]
+        notify_job_created(cur, new_job_id) # Đánh thức worker đang rảnh (job hẹn giờ sẽ được quét lại khi đến hạn)
         conn.commit()
         
         msg = "Đã lên lịch (Scheduled)!" if dt_scheduled else "Đã tạo Job, chạy ngay!"
@@ -3269,13 +3294,21 @@ def create_manual_job():
         conn.close()
 
 if __name__ == '__main__':
+    # 0. Đảm bảo các bảng/cột bổ sung đã có (idempotent)
+    conn_schema = get_db()
+    if conn_schema:
+        try: ensure_schema(conn_schema)
+        except Exception as e: print(f"⚠️ Schema Warning: {e}")
+        finally: conn_schema.close()
+
     # 1. Kích hoạt Cô Y Tá (Scheduler)
     t_scheduler = threading.Thread(target=run_scheduler_loop)
     t_scheduler.daemon = True
     t_scheduler.start()
 
     # 2. [PHÉP THUẬT ĐA LUỒNG]: Tuyển thẳng 3 Bác Sĩ chạy song song
-    NUM_WORKERS = 3
+    # EMBEDDED_WORKERS=0 khi đã chạy worker riêng (python api/worker.py) -> API không phải gánh việc ingest
+    NUM_WORKERS = int(os.getenv("EMBEDDED_WORKERS", "3"))
     worker_threads = []
     
     for i in range(NUM_WORKERS):
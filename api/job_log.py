@@ -0,0 +1,147 @@
+import os
+import atexit
+import threading
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+from api.db_pool import get_pooled_connection
+
+load_dotenv()
+
+# ==========================================
+# LOG CỦA JOB: GHI ĐỆM + GHI THEO LÔ VÀO BẢNG CHỈ-THÊM job_log_lines
+# Trước đây mỗi dòng log = 1 UPDATE job_history SET logs = logs || ... (ghi lại cả khối TOAST ngày càng dài).
+# Giờ: dòng log vào bộ đệm trong RAM, luồng nền ghi 1 lệnh INSERT cho cả lô
+# khi đủ JOB_LOG_FLUSH_LINES dòng hoặc sau JOB_LOG_FLUSH_SECONDS giây.
+# /monitor/history ghép job_history.logs (phần đầu cũ) + N dòng mới nhất từ bảng này.
+# ==========================================
+
+JOB_LOG_FLUSH_SECONDS = float(os.getenv("JOB_LOG_FLUSH_SECONDS", "2"))
+JOB_LOG_FLUSH_LINES = int(os.getenv("JOB_LOG_FLUSH_LINES", "200"))
+
+# Bộ đệm tối đa khi DB lỗi liên tục (bỏ dòng cũ nhất để không phình RAM)
+JOB_LOG_MAX_BUFFER = 50000
+
+INSERT_LINES_SQL = "INSERT INTO job_log_lines (job_id, logged_at, line) VALUES %s"
+
+# N dòng mới nhất của từng job (dùng index (job_id, id))
+TAIL_LINES_SQL = """
+    SELECT j.job_id, t.logged_at, t.line
+    FROM unnest(%s::int[]) AS j (job_id)
+    CROSS JOIN LATERAL (
+        SELECT id, logged_at, line FROM job_log_lines
+        WHERE job_id = j.job_id
+        ORDER BY id DESC
+        LIMIT %s
+    ) t
+    ORDER BY j.job_id, t.id
+"""
+
+COUNT_LINES_SQL = """
+    SELECT job_id, COUNT(*) FROM job_log_lines
+    WHERE job_id = ANY(%s::int[])
+    GROUP BY job_id
+"""
+
+def format_log_line(logged_at, line):
+    return f"[{logged_at.strftime('%H:%M:%S')}] {line}"
+
+
+class JobLogWriter:
+    """Bộ đệm log dùng chung cho cả process (thread-safe), tự ghi xuống DB bằng 1 luồng nền"""
+
+    def __init__(self, flush_seconds=JOB_LOG_FLUSH_SECONDS, flush_lines=JOB_LOG_FLUSH_LINES):
+        self.flush_seconds = flush_seconds
+        self.flush_lines = flush_lines
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # Không cho 2 lần flush chen nhau (giữ đúng thứ tự dòng)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def append(self, job_id, line):
+        if not job_id: return
+        with self._lock:
+            self._buffer.append((job_id, datetime.now(), str(line)))
+            if len(self._buffer) > JOB_LOG_MAX_BUFFER:
+                del self._buffer[:len(self._buffer) - JOB_LOG_MAX_BUFFER]
+            full = len(self._buffer) >= self.flush_lines
+        self._ensure_thread()
+        if full: self._wakeup.set()
+
+    def flush(self):
+        """Ghi toàn bộ dòng đang đệm. Lỗi DB thì trả các dòng lại đầu bộ đệm để lần sau ghi tiếp."""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows: return 0
+            try:
+                conn = get_pooled_connection()
+                try:
+                    cur = conn.cursor()
+                    execute_values(cur, INSERT_LINES_SQL, rows, page_size=1000)
+                    conn.commit()
+                    cur.close()
+                finally:
+                    conn.close()
+                return len(rows)
+            except Exception as e:
+                print(f"❌ Error appending log: {e}")
+                with self._lock:
+                    self._buffer = rows + self._buffer
+                return 0
+
+    def _ensure_thread(self):
+        # Process fork / spawn ra thì luồng nền của process cha không đi theo -> dựng lại
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="job-log-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+
+_WRITER = JobLogWriter()
+atexit.register(_WRITER.flush)
+
+def append_job_log(job_id, line):
+    _WRITER.append(job_id, line)
+
+def flush_job_logs():
+    return _WRITER.flush()
+
+def fetch_job_logs(cur, job_ids, tail_lines):
+    """
+    Trả về {job_id: text} gồm tail_lines dòng mới nhất của mỗi job (cũ -> mới, mỗi dòng 1 hàng).
+    Job có nhiều dòng hơn thì thêm 1 dòng báo số dòng đã ẩn ở đầu.
+    cur: cursor thường (không phải RealDictCursor).
+    """
+    job_ids = [int(j) for j in job_ids if j]
+    if not job_ids: return {}
+
+    cur.execute(COUNT_LINES_SQL, (job_ids,))
+    totals = dict(cur.fetchall())
+
+    cur.execute(TAIL_LINES_SQL, (job_ids, tail_lines))
+    lines = {}
+    for job_id, logged_at, line in cur.fetchall():
+        lines.setdefault(job_id, []).append(format_log_line(logged_at, line))
+
+    result = {}
+    for job_id, job_lines in lines.items():
+        hidden = totals.get(job_id, 0) - len(job_lines)
+        if hidden > 0:
+            job_lines.insert(0, f"... ({hidden} dòng log cũ hơn đã ẩn)")
+        result[job_id] = "\n".join(job_lines)
+    return result
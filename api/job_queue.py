@@ -0,0 +1,324 @@
+import os
+import select
+import threading
+import time
+
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+from api.db_pool import connect_direct, get_pooled_connection
+from api.token_budget import token_can_start
+
+load_dotenv()
+
+# ==========================================
+# HÀNG ĐỢI JOB TRÊN POSTGRES
+# - Nhận job nguyên tử: UPDATE ... WHERE id = (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING *
+#   -> nhiều worker (nhiều thread / nhiều máy) không bao giờ giật trùng 1 job.
+# - Tạo job xong bắn NOTIFY -> worker đang rảnh thức dậy ngay, không phải ngủ đủ 30s.
+# - Giới hạn số job chạy cùng lúc (toàn hệ thống / từng app / từng token AppMetrica) bằng advisory lock của Postgres
+#   -> đúng cho mọi process, mọi máy; worker chết thì connection đứt, Postgres tự nhả slot.
+# - Lệnh STOP đi qua DB (job_history.status = 'Cancelled') -> dừng được job ở process khác.
+# ==========================================
+
+JOB_CHANNEL = "etl_job_created"
+
+# Worker rảnh chờ NOTIFY tối đa bao lâu rồi tự quét lại (job hẹn giờ scheduled_at không có NOTIFY lúc đến hạn)
+WORKER_IDLE_SECONDS = float(os.getenv("WORKER_IDLE_SECONDS", "30"))
+
+# Tổng số job chạy cùng lúc (mọi worker cộng lại) & số job cùng lúc của 1 app
+MAX_RUNNING_JOBS = int(os.getenv("MAX_RUNNING_JOBS", "3"))
+MAX_JOBS_PER_APP = int(os.getenv("MAX_JOBS_PER_APP", "1"))
+# Số request export cùng lúc trên 1 token AppMetrica (nhiều app có thể dùng chung 1 token).
+# Job con của backfill (api/backfill.py) không tính slot theo app, chỉ tính slot theo token -> các cửa sổ chạy song song.
+MAX_JOBS_PER_TOKEN = int(os.getenv("MAX_JOBS_PER_TOKEN", "3"))
+
+# Job đang chạy đọc lại trạng thái trên DB mỗi bao nhiêu giây để bắt lệnh STOP
+JOB_CANCEL_POLL_SECONDS = float(os.getenv("JOB_CANCEL_POLL_SECONDS", "5"))
+
+# Số job pending xem xét mỗi lần nhận (bỏ qua job của app đã đủ slot, lấy job kế tiếp)
+CLAIM_SCAN_LIMIT = 50
+
+GLOBAL_SLOT_KEY = "etl_global_slot"
+APP_SLOT_KEY = "etl_app_slot"
+TOKEN_SLOT_KEY = "etl_token_slot"
+
+# Token đang bị chặn vì 429 (api/token_budget.py) -> bỏ qua mọi job của các app dùng token đó
+BLOCKED_TOKEN_SQL = """
+    SELECT 1 FROM apps a JOIN token_rate_state t ON t.token_hash = md5(btrim(a.api_token))
+    WHERE a.id = {table}.app_id AND t.blocked_until > (NOW() AT TIME ZONE 'UTC')
+"""
+
+# Job cha của backfill (window_total) chỉ để gom trạng thái, không bao giờ được nhận
+PENDING_HISTORY_SQL = f"""
+    SELECT id, app_id, parent_job_id,
+           (SELECT api_token FROM apps WHERE apps.id = job_history.app_id) AS api_token
+    FROM job_history
+    WHERE status = 'pending' AND window_total IS NULL
+      AND (scheduled_at IS NULL OR scheduled_at <= (NOW() AT TIME ZONE 'UTC'))
+      AND NOT EXISTS ({BLOCKED_TOKEN_SQL.format(table='job_history')})
+    ORDER BY created_at ASC, id ASC
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+MARK_HISTORY_SQL = "UPDATE job_history SET status = 'Processing', start_time = NOW() WHERE id = %s RETURNING *"
+
+# Bảng cũ etl_jobs (Legacy Auto Job)
+PENDING_LEGACY_SQL = f"""
+    SELECT id, app_id, NULL AS parent_job_id,
+           (SELECT api_token FROM apps WHERE apps.id = etl_jobs.app_id) AS api_token
+    FROM etl_jobs
+    WHERE status = 'pending'
+      AND NOT EXISTS ({BLOCKED_TOKEN_SQL.format(table='etl_jobs')})
+    ORDER BY created_at ASC
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+MARK_LEGACY_SQL = "UPDATE etl_jobs SET status = 'processing', updated_at = NOW() WHERE id = %s RETURNING *"
+
+# Thứ tự ưu tiên: job_history (Manual Job & Scheduled Job) rồi mới tới etl_jobs
+CLAIM_SOURCES = [
+    ('history', PENDING_HISTORY_SQL, MARK_HISTORY_SQL),
+    ('legacy', PENDING_LEGACY_SQL, MARK_LEGACY_SQL),
+]
+
+
+class JobSlots:
+    """
+    Slot chạy job của 1 worker = advisory lock cấp session trên 1 connection riêng (không qua pool),
+    giữ suốt thời gian chạy job rồi release().
+    - Slot toàn hệ thống: (hashtext('etl_global_slot'), 0..MAX_RUNNING_JOBS-1)
+    - Slot theo app:      (hashtext('etl_app_slot:<n>'), app_id) với n = 0..MAX_JOBS_PER_APP-1
+    - Slot theo token:    (hashtext('etl_token_slot:<n>'), hashtext(token)) với n = 0..MAX_JOBS_PER_TOKEN-1
+    """
+    def __init__(self, max_running=MAX_RUNNING_JOBS, max_per_app=MAX_JOBS_PER_APP, max_per_token=MAX_JOBS_PER_TOKEN):
+        self.max_running = max_running
+        self.max_per_app = max_per_app
+        self.max_per_token = max_per_token
+        self.conn = None
+        self.held = []
+
+    def _cursor(self):
+        if self.conn is None or self.conn.closed:
+            self.held = [] # Connection cũ đứt thì lock cũ cũng đã mất
+            self.conn = connect_direct()
+            self.conn.autocommit = True
+        return self.conn.cursor()
+
+    @staticmethod
+    def _key_sql(key):
+        # Key dạng chuỗi (token) được băm bằng hashtext ngay trên Postgres
+        return "hashtext(%s)" if isinstance(key, str) else "%s"
+
+    def _try_lock(self, name, key):
+        cur = self._cursor()
+        try:
+            cur.execute(f"SELECT pg_try_advisory_lock(hashtext(%s), {self._key_sql(key)})", (name, key))
+            if cur.fetchone()[0]:
+                self.held.append((name, key))
+                return True
+            return False
+        finally:
+            cur.close()
+
+    def acquire_global(self):
+        for slot in range(self.max_running):
+            if self._try_lock(GLOBAL_SLOT_KEY, slot): return True
+        return False
+
+    def acquire_app(self, app_id):
+        for slot in range(self.max_per_app):
+            if self._try_lock(f"{APP_SLOT_KEY}:{slot}", app_id): return True
+        return False
+
+    def acquire_token(self, token):
+        if not token: return True # App chưa có token -> job sẽ tự lỗi, không cần giữ slot
+        for slot in range(self.max_per_token):
+            if self._try_lock(f"{TOKEN_SLOT_KEY}:{slot}", token.strip()): return True
+        return False
+
+    def acquire_job(self, app_id, token, backfill_child=False):
+        """
+        Lấy đủ slot cho 1 job đã nhận từ trước (export 202 trong ExportPoller có hàng, sắp tải & ghi DB):
+        toàn hệ thống + app (job con backfill bỏ qua, như claim_next_job) + token. Thiếu 1 slot thì nhả hết, trả về False.
+        """
+        if not self.acquire_global(): return False
+        if (backfill_child or self.acquire_app(app_id)) and self.acquire_token(token):
+            return True
+        self.release()
+        return False
+
+    def release_last(self):
+        """Nhả slot vừa lấy (đã có slot app nhưng token hết slot -> trả lại để xét job kế tiếp)"""
+        if not self.held: return
+        name, key = self.held.pop()
+        try:
+            cur = self._cursor()
+            cur.execute(f"SELECT pg_advisory_unlock(hashtext(%s), {self._key_sql(key)})", (name, key))
+            cur.close()
+        except Exception as e:
+            print(f"⚠️ Job Slot Release Error: {e}")
+            self.close()
+
+    def release(self):
+        """Nhả mọi slot đang giữ và báo các worker đang chờ quét lại (có thể vừa trống chỗ)"""
+        if not self.held: return
+        held, self.held = self.held, []
+        try:
+            cur = self._cursor()
+            for name, key in held:
+                cur.execute(f"SELECT pg_advisory_unlock(hashtext(%s), {self._key_sql(key)})", (name, key))
+            cur.execute("SELECT pg_notify(%s, %s)", (JOB_CHANNEL, 'slot'))
+            cur.close()
+        except Exception as e:
+            # Không nhả được thì đóng hẳn connection -> Postgres tự nhả lock
+            print(f"⚠️ Job Slot Release Error: {e}")
+            self.close()
+
+    def close(self):
+        if self.conn is not None:
+            try: self.conn.close()
+            except Exception: pass
+        self.conn = None
+        self.held = []
+
+
+def claim_next_job(conn, slots):
+    """
+    Nhận 1 job đang chờ (đã được đánh dấu Processing ngay trong cùng transaction),
+    chỉ khi còn slot toàn hệ thống, app của job còn slot (job con backfill bỏ qua slot app), token còn slot
+    và token không bị lùi sau 429 / chưa đủ export đang chạy (api/token_budget.py).
+    Trả về (job_dict, source_table) với source_table = 'history' | 'legacy',
+    hoặc (None, 'busy') nếu hết slot toàn hệ thống, (None, 'none') nếu không có job nào chạy được.
+    Nhận được job thì slots đang giữ lock -> gọi slots.release() khi chạy xong.
+    """
+    if not slots.acquire_global():
+        return None, 'busy'
+
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        for source_table, pending_sql, mark_sql in CLAIM_SOURCES:
+            cur.execute(pending_sql, (CLAIM_SCAN_LIMIT,))
+            for cand in cur.fetchall():
+                if cand['parent_job_id'] is None and not slots.acquire_app(cand['app_id']):
+                    continue # App này đủ job đang chạy -> nhường job kế tiếp
+                if not slots.acquire_token(cand['api_token']):
+                    if cand['parent_job_id'] is None: slots.release_last()
+                    continue # Token này đủ request export đang chạy
+                if not token_can_start(conn, cand['api_token']):
+                    slots.release_last()
+                    if cand['parent_job_id'] is None: slots.release_last()
+                    continue # Token đang lùi sau 429 / đủ export đang chờ AppMetrica
+                cur.execute(mark_sql, (cand['id'],))
+                job = cur.fetchone()
+                conn.commit()
+                return dict(job), source_table
+            conn.rollback()
+        slots.release()
+        return None, 'none'
+    except Exception:
+        conn.rollback()
+        slots.release()
+        raise
+    finally:
+        cur.close()
+
+def notify_job_created(cur, job_id):
+    """Gửi NOTIFY (chỉ thực sự phát đi khi transaction của cur được commit)"""
+    cur.execute("SELECT pg_notify(%s, %s)", (JOB_CHANNEL, str(job_id)))
+
+
+class JobListener:
+    """
+    Connection riêng LISTEN kênh JOB_CHANNEL cho 1 worker.
+    wait(timeout) trả về True nếu có NOTIFY, False nếu hết giờ; mất kết nối thì tự nối lại.
+    """
+    def __init__(self, channel=JOB_CHANNEL):
+        self.channel = channel
+        self.conn = None
+
+    def start(self):
+        """LISTEN trước khi quét job lần đầu -> không lỡ NOTIFY bắn ra trong lúc đang quét"""
+        try: self._connect()
+        except Exception as e: print(f"⚠️ Job Listener Error: {e}")
+
+    def _connect(self):
+        self.close()
+        self.conn = connect_direct()
+        self.conn.autocommit = True
+        cur = self.conn.cursor()
+        cur.execute(f"LISTEN {self.channel}")
+        cur.close()
+
+    def wait(self, timeout=WORKER_IDLE_SECONDS):
+        try:
+            if self.conn is None or self.conn.closed:
+                self._connect()
+            if not self.conn.notifies:
+                readable, _, _ = select.select([self.conn], [], [], timeout)
+                if readable:
+                    self.conn.poll()
+            else:
+                self.conn.poll()
+            got = bool(self.conn.notifies)
+            del self.conn.notifies[:]
+            return got
+        except Exception as e:
+            print(f"⚠️ Job Listener Error: {e}")
+            self.close()
+            time.sleep(min(timeout, 5))
+            return False
+
+    def close(self):
+        if self.conn is not None:
+            try: self.conn.close()
+            except Exception: pass
+        self.conn = None
+
+
+class JobStopSignal:
+    """
+    Thay threading.Event làm cờ STOP của 1 job (cùng API: set / is_set / wait).
+    Ngoài set() trong cùng process, cờ còn bật khi job_history.status trên DB chuyển sang 'Cancelled'
+    (API /etl/stop chạy ở process khác) - đọc lại DB tối đa mỗi JOB_CANCEL_POLL_SECONDS.
+    """
+    def __init__(self, hist_id, poll_seconds=JOB_CANCEL_POLL_SECONDS):
+        self.hist_id = hist_id
+        self.poll_seconds = poll_seconds
+        self._event = threading.Event()
+        self._checked_at = 0
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        if self._event.is_set(): return True
+        now = time.monotonic()
+        if self.hist_id and now - self._checked_at >= self.poll_seconds:
+            self._checked_at = now
+            if self._cancelled_in_db(): self._event.set()
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = self.poll_seconds if deadline is None else deadline - time.monotonic()
+            if remaining <= 0: return False
+            self._event.wait(min(remaining, self.poll_seconds))
+        return True
+
+    def _cancelled_in_db(self):
+        try:
+            conn = get_pooled_connection()
+        except Exception:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT status FROM job_history WHERE id = %s", (self.hist_id,))
+            row = cur.fetchone()
+            cur.close()
+            return bool(row) and row[0] == 'Cancelled'
+        except Exception:
+            return False
+        finally:
+            conn.close()
@@ -0,0 +1,69 @@
+import json
+import base64
+from datetime import datetime
+
+# ==========================================
+# PHÂN TRANG KEYSET (CURSOR) THEO (created_at DESC, id DESC)
+# LIMIT/OFFSET phải đọc rồi bỏ toàn bộ các dòng trước trang cần xem -> trang càng sâu càng chậm.
+# Keyset: nhớ (created_at, id) của dòng cuối / đầu trang, trang kế chỉ lấy các dòng "sau" mốc đó (ăn index).
+# Cursor gửi cho FE là chuỗi base64 mờ (FE chỉ việc gửi lại nguyên xi).
+# ==========================================
+
+class CursorError(ValueError):
+    """Cursor FE gửi lên không hợp lệ"""
+
+
+def encode_cursor(created_at, row_id, direction):
+    """direction: 'next' (trang cũ hơn) | 'prev' (trang mới hơn)"""
+    raw = json.dumps({"t": created_at.isoformat(), "id": row_id, "d": direction})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    """-> (created_at, id, direction)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        created_at = datetime.fromisoformat(data['t'])
+        direction = data.get('d', 'next')
+        if direction not in ('next', 'prev'): raise ValueError(direction)
+        return created_at, int(data['id']), direction
+    except Exception as e:
+        raise CursorError(f"Cursor không hợp lệ: {e}")
+
+def keyset_query_parts(cursor, ts_column, id_column):
+    """
+    (điều kiện WHERE thêm vào, params, ORDER BY, có phải trang 'prev' không) cho 1 cursor (None = trang đầu).
+    Trang 'prev' lấy theo thứ tự ngược rồi caller đảo lại (keyset_page làm việc này).
+    """
+    order_desc = f"{ts_column} DESC, {id_column} DESC"
+    if not cursor:
+        return [], [], order_desc, False
+    created_at, row_id, direction = decode_cursor(cursor)
+    if direction == 'next':
+        return [f"({ts_column}, {id_column}) < (%s, %s)"], [created_at, row_id], order_desc, False
+    return [f"({ts_column}, {id_column}) > (%s, %s)"], [created_at, row_id], f"{ts_column} ASC, {id_column} ASC", True
+
+def keyset_page(rows, limit, is_prev, had_cursor, ts_key='_cursor_ts', id_key='id'):
+    """
+    rows: kết quả query đã LIMIT limit + 1 (dòng thừa dùng để biết còn trang hay không).
+    Trả về (rows của trang theo thứ tự mới -> cũ, next_cursor, prev_cursor); bỏ cột ts_key khỏi từng dòng.
+    """
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if is_prev: rows.reverse()
+
+    def make(row, direction):
+        # Dòng thiếu created_at không làm mốc được (so sánh với NULL luôn sai)
+        return encode_cursor(row[ts_key], row[id_key], direction) if row[ts_key] is not None else None
+
+    next_cursor = prev_cursor = None
+    if rows:
+        # Trang 'next': luôn quay lại được (đã có cursor); còn trang cũ hơn nếu lấy dư được 1 dòng
+        # Trang 'prev': ngược lại
+        if has_more or is_prev:
+            next_cursor = make(rows[-1], 'next')
+        if (has_more and is_prev) or (had_cursor and not is_prev):
+            prev_cursor = make(rows[0], 'prev')
+    for row in rows:
+        row.pop(ts_key, None)
+    return rows, next_cursor, prev_cursor
@@ -0,0 +1,187 @@
+from psycopg2.extras import execute_values
+
+from api.user_bitmap import bitmap_from_indexes, encode_bitmap
+from api.vn_time import VN_OFFSET
+
+# ==========================================
+# BẢNG TỔNG HỢP level_daily_stats (ROLLUP THEO NGÀY VN x LEVEL x VERSION x GEO)
+# Worker chỉ tính lại đúng các ô (app, ngày, level) mà job vừa ghi vào,
+# Data Check / Export đọc bảng này thay vì quét toàn bộ event_logs.
+# Tập user start/win của mỗi ô lưu dạng bitmap theo user_dictionary (api/user_bitmap.py).
+# ==========================================
+
+START_EVENTS = {"level_start", "missionStart", "missionStart_Daily", "level_first_start"}
+WIN_EVENTS = {"level_win", "missionComplete", "missionComplete_Daily", "level_first_end"}
+
+# Xóa các ô cũ trước (version/geo không còn dữ liệu cũng phải biến mất)
+CLEAR_SQL = """
+    DELETE FROM level_daily_stats s
+    USING unnest(%(dates)s::date[], %(levels)s::int[]) AS c (d, lvl)
+    WHERE s.app_id = %(app_id)s AND s.stat_date = c.d AND s.level_num = c.lvl
+"""
+
+# Tính lại toàn bộ các ô (ngày, level) truyền vào từ event_logs.
+# booster_totals giữ key gốc (booster_xxx) -> báo cáo tự lọc rác / đổi tên lúc đọc;
+# key có giá trị 0 vẫn được giữ (Data Check cần biết để hiện cột 0).
+REFRESH_SQL = """
+    WITH cells AS (
+        SELECT DISTINCT d, lvl FROM unnest(%(dates)s::date[], %(levels)s::int[]) AS c (d, lvl)
+    ),
+    src AS (
+        SELECT e.app_id, c.d AS stat_date, e.level_num,
+               COALESCE(e.app_version_name, '') AS app_version_name,
+               COALESCE(e.country_iso_code, '') AS country_iso_code,
+               e.event_name, e.timeplay, e.booster_counts
+        FROM cells c
+        JOIN event_logs e
+          ON e.app_id = %(app_id)s
+         AND e.level_num = c.lvl
+         AND e.created_at >= (c.d - interval '7 hours')
+         AND e.created_at <  (c.d + interval '17 hours')
+    ),
+    base AS (
+        SELECT app_id, stat_date, level_num, app_version_name, country_iso_code,
+               COUNT(*) AS event_count,
+               COUNT(*) FILTER (WHERE event_name = ANY(%(start_events)s) AND event_name <> 'level_first_start') AS total_plays,
+               COALESCE(SUM(timeplay) FILTER (WHERE event_name = ANY(%(win_events)s) AND event_name <> 'level_first_end'
+                                                AND timeplay > 0 AND timeplay < 7200), 0) AS timeplay_sum,
+               COUNT(*) FILTER (WHERE event_name = ANY(%(win_events)s) AND event_name <> 'level_first_end'
+                                  AND timeplay > 0 AND timeplay < 7200) AS timeplay_count
+        FROM src
+        GROUP BY 1, 2, 3, 4, 5
+    ),
+    boost AS (
+        SELECT app_id, stat_date, level_num, app_version_name, country_iso_code,
+               jsonb_object_agg(key, qty) AS booster_totals
+        FROM (
+            SELECT s.app_id, s.stat_date, s.level_num, s.app_version_name, s.country_iso_code,
+                   b.key, SUM(GREATEST(b.value::bigint, 0)) AS qty
+            FROM src s CROSS JOIN LATERAL jsonb_each_text(s.booster_counts) b
+            GROUP BY 1, 2, 3, 4, 5, 6
+        ) x
+        GROUP BY 1, 2, 3, 4, 5
+    )
+    INSERT INTO level_daily_stats (app_id, stat_date, level_num, app_version_name, country_iso_code,
+                                   event_count, total_plays, timeplay_sum, timeplay_count, booster_totals, updated_at)
+    SELECT b.app_id, b.stat_date, b.level_num, b.app_version_name, b.country_iso_code,
+           b.event_count, b.total_plays, b.timeplay_sum, b.timeplay_count,
+           COALESCE(x.booster_totals, '{}'::jsonb), NOW()
+    FROM base b
+    LEFT JOIN boost x USING (app_id, stat_date, level_num, app_version_name, country_iso_code)
+"""
+
+# Cấp số thứ tự dày cho user mới xuất hiện trong các ô (khóa theo app để 2 worker không cấp trùng số)
+DICTIONARY_SQL = """
+    WITH cells AS (
+        SELECT DISTINCT d, lvl FROM unnest(%(dates)s::date[], %(levels)s::int[]) AS c (d, lvl)
+    ),
+    new_users AS (
+        SELECT DISTINCT COALESCE(e.user_uid, 'unknown') AS uid
+        FROM cells c
+        JOIN event_logs e
+          ON e.app_id = %(app_id)s
+         AND e.level_num = c.lvl
+         AND e.created_at >= (c.d - interval '7 hours')
+         AND e.created_at <  (c.d + interval '17 hours')
+         AND e.event_name = ANY(%(user_events)s)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_dictionary u
+            WHERE u.app_id = %(app_id)s AND u.user_uid = COALESCE(e.user_uid, 'unknown')
+        )
+    )
+    INSERT INTO user_dictionary (app_id, user_uid, user_idx)
+    SELECT %(app_id)s, n.uid, base.max_idx + ROW_NUMBER() OVER (ORDER BY n.uid)
+    FROM new_users n
+    CROSS JOIN (SELECT COALESCE(MAX(user_idx), -1) AS max_idx FROM user_dictionary WHERE app_id = %(app_id)s) base
+"""
+
+# (ô rollup, start/win, user_idx) không trùng lặp
+CELL_USERS_SQL = """
+    WITH cells AS (
+        SELECT DISTINCT d, lvl FROM unnest(%(dates)s::date[], %(levels)s::int[]) AS c (d, lvl)
+    )
+    SELECT DISTINCT c.d, e.level_num,
+           COALESCE(e.app_version_name, '') AS app_version_name,
+           COALESCE(e.country_iso_code, '') AS country_iso_code,
+           (e.event_name = ANY(%(start_events)s)) AS is_start, u.user_idx
+    FROM cells c
+    JOIN event_logs e
+      ON e.app_id = %(app_id)s
+     AND e.level_num = c.lvl
+     AND e.created_at >= (c.d - interval '7 hours')
+     AND e.created_at <  (c.d + interval '17 hours')
+     AND e.event_name = ANY(%(user_events)s)
+    JOIN user_dictionary u
+      ON u.app_id = %(app_id)s AND u.user_uid = COALESCE(e.user_uid, 'unknown')
+"""
+
+UPDATE_USERS_SQL = """
+    UPDATE level_daily_stats s SET start_users = v.start_users, win_users = v.win_users
+    FROM (VALUES %s) AS v (app_id, stat_date, level_num, app_version_name, country_iso_code, start_users, win_users)
+    WHERE s.app_id = v.app_id AND s.stat_date = v.stat_date AND s.level_num = v.level_num
+      AND s.app_version_name = v.app_version_name AND s.country_iso_code = v.country_iso_code
+"""
+
+def touched_cells(rows):
+    """
+    Lấy các ô (ngày VN, level) từ list tuple theo thứ tự bulk_loader.EVENT_COLUMNS
+    (created_at ở vị trí 4, level_num ở vị trí 8).
+    """
+    cells = set()
+    for row in rows:
+        if len(row) > 8 and row[8] is not None and row[4] is not None:
+            cells.add(((row[4] + VN_OFFSET).date(), row[8]))
+    return cells
+
+def range_touched_cells(cur, app_id, ts_from, ts_to):
+    """Các ô (ngày VN, level) có dữ liệu trong khoảng created_at [ts_from, ts_to] (UTC)"""
+    cur.execute("""
+        SELECT DISTINCT (created_at + interval '7 hours')::date, level_num
+        FROM event_logs
+        WHERE app_id = %s AND created_at BETWEEN %s AND %s AND level_num IS NOT NULL
+    """, (app_id, ts_from, ts_to))
+    return set((r[0], r[1]) for r in cur.fetchall())
+
+def refresh_level_daily_stats(conn, app_id, cells):
+    """
+    Tính lại level_daily_stats cho các ô (ngày VN, level) của 1 app.
+    Không tự commit. Trả về số dòng rollup được ghi.
+    """
+    cells = list(cells)
+    if not cells:
+        return 0
+    cur = conn.cursor()
+    try:
+        params = {
+            "app_id": app_id,
+            "dates": [c[0] for c in cells],
+            "levels": [c[1] for c in cells],
+            "start_events": list(START_EVENTS),
+            "win_events": list(WIN_EVENTS),
+            "user_events": list(START_EVENTS | WIN_EVENTS),
+        }
+        # Các cửa sổ backfill của cùng 1 app chạy song song có thể chạm cùng ô -> tính lại lần lượt theo app
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('level_daily_stats'), %s)", (app_id,))
+        cur.execute(CLEAR_SQL, params)
+        cur.execute(REFRESH_SQL, params)
+        written = cur.rowcount
+
+        # Bitmap user start / win cho từng ô
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('user_dictionary'), %s)", (app_id,))
+        cur.execute(DICTIONARY_SQL, params)
+        cur.execute(CELL_USERS_SQL, params)
+        users = {}
+        for d, lvl, ver, geo, is_start, idx in cur.fetchall():
+            users.setdefault((d, lvl, ver, geo), ([], []))[0 if is_start else 1].append(idx)
+
+        if users:
+            values = [
+                (app_id, key[0], key[1], key[2], key[3],
+                 encode_bitmap(bitmap_from_indexes(starts)), encode_bitmap(bitmap_from_indexes(wins)))
+                for key, (starts, wins) in users.items()
+            ]
+            execute_values(cur, UPDATE_USERS_SQL, values,
+                           template="(%s, %s::date, %s::int, %s, %s, %s::bytea, %s::bytea)", page_size=1000)
+        return written
+    finally:
+        cur.close()
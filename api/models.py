@@ -31,6 +31,7 @@ class EventLog(Base):
     app_id = Column(Integer, ForeignKey("apps.id"))
     event_name = Column(String, index=True)
     event_type = Column(String) # Booster / Normal
+    event_json = Column(JSONB, nullable=True)
     count = Column(Integer, default=1)
     created_at = Column(DateTime, default=datetime.utcnow)
 
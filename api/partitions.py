@@ -0,0 +1,162 @@
+import threading
+from datetime import date, datetime
+
+from api.db_pool import get_pooled_connection
+
+# ==========================================
+# PHÂN VÙNG (PARTITION) BẢNG event_logs
+#   event_logs                      PARTITION BY LIST (app_id)
+#   ├── event_logs_a<app>           PARTITION BY RANGE (created_at)
+#   │   ├── event_logs_a<app>_p<YYYYMM>   (1 tháng UTC)
+#   │   └── event_logs_a<app>_default     (created_at NULL / tháng chưa tạo)
+#   └── event_logs_default          (app chưa có phân vùng riêng)
+# - Báo cáo lọc app_id + khoảng created_at -> Postgres chỉ đọc đúng các tháng liên quan.
+# - Xóa dữ liệu cũ = DETACH / DROP 1 bảng tháng thay vì DELETE hàng triệu dòng.
+# - Worker tự tạo phân vùng còn thiếu trước khi ghi (ensure_event_partitions).
+# Chuyển bảng cũ sang dạng phân vùng / dọn dữ liệu cũ: api/scripts/manage_partitions.py
+# ==========================================
+
+PARENT_TABLE = "event_logs"
+TOP_DEFAULT = "event_logs_default"
+
+# Khóa chung khi tạo phân vùng (nhiều worker cùng lúc không tạo trùng)
+PARTITION_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('event_logs_partitions'))"
+
+# Phân vùng đã chắc chắn tồn tại trong process này (khỏi hỏi DB mỗi lô)
+_KNOWN = set()
+_KNOWN_LOCK = threading.Lock()
+
+def app_table(app_id):
+    return f"event_logs_a{int(app_id)}"
+
+def app_default_table(app_id):
+    return f"event_logs_a{int(app_id)}_default"
+
+def month_table(app_id, month):
+    return f"event_logs_a{int(app_id)}_p{month.strftime('%Y%m')}"
+
+def month_floor(value):
+    if isinstance(value, datetime): value = value.date()
+    return date(value.year, value.month, 1)
+
+def next_month(month):
+    return date(month.year + (month.month == 12), month.month % 12 + 1, 1)
+
+def iter_months(first, last):
+    month = month_floor(first)
+    while month <= month_floor(last):
+        yield month
+        month = next_month(month)
+
+def is_partitioned(cur, table=PARENT_TABLE):
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+        )
+    """, (table,))
+    return cur.fetchone()[0]
+
+def table_exists(cur, table):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cur.fetchone()[0]
+
+def _create_moving_default(cur, table, create_sql, default_table, where_sql, params):
+    """
+    Tạo 1 phân vùng mới. Nếu phân vùng default đang chứa dòng thuộc khoảng của nó
+    (Postgres sẽ từ chối tạo) thì nhấc các dòng đó ra bảng tạm, tạo phân vùng rồi ghi lại.
+    """
+    if table_exists(cur, table):
+        return False
+    moved = 0
+    if table_exists(cur, default_table):
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {default_table} WHERE {where_sql})", params)
+        if cur.fetchone()[0]:
+            cur.execute(f"CREATE TEMP TABLE _partition_move (LIKE {PARENT_TABLE}) ON COMMIT DROP")
+            cur.execute(f"WITH m AS (DELETE FROM {default_table} WHERE {where_sql} RETURNING *) "
+                        f"INSERT INTO _partition_move SELECT * FROM m", params)
+            moved = cur.rowcount
+    cur.execute(create_sql)
+    if moved:
+        cur.execute(f"INSERT INTO {PARENT_TABLE} SELECT * FROM _partition_move")
+        cur.execute("DROP TABLE _partition_move")
+    return True
+
+def ensure_app_partition(cur, app_id, parent=PARENT_TABLE):
+    """Phân vùng của 1 app (+ default của nó). Trả về True nếu vừa tạo mới."""
+    app_id = int(app_id)
+    created = _create_moving_default(
+        cur, app_table(app_id),
+        f"CREATE TABLE {app_table(app_id)} PARTITION OF {parent} FOR VALUES IN ({app_id}) PARTITION BY RANGE (created_at)",
+        TOP_DEFAULT, "app_id = %s", (app_id,)
+    )
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {app_default_table(app_id)} PARTITION OF {app_table(app_id)} DEFAULT")
+    return created
+
+def ensure_month_partition(cur, app_id, month):
+    """Phân vùng 1 tháng (UTC) của 1 app. Trả về True nếu vừa tạo mới."""
+    month = month_floor(month)
+    upper = next_month(month)
+    return _create_moving_default(
+        cur, month_table(app_id, month),
+        f"CREATE TABLE {month_table(app_id, month)} PARTITION OF {app_table(app_id)} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}')",
+        app_default_table(app_id), "created_at >= %s AND created_at < %s", (month, upper)
+    )
+
+def ensure_event_partitions(app_id, timestamps):
+    """
+    Đảm bảo đủ phân vùng tháng cho các created_at sắp ghi của 1 app (bảng chưa phân vùng thì bỏ qua).
+    Mượn connection riêng và commit ngay: DDL không kéo dài trong transaction ghi dữ liệu.
+    """
+    months = set(month_floor(t) for t in timestamps if t is not None)
+    with _KNOWN_LOCK:
+        missing = [m for m in months if (int(app_id), m) not in _KNOWN]
+    if not missing:
+        return 0
+
+    conn = get_pooled_connection()
+    cur = conn.cursor()
+    try:
+        if not is_partitioned(cur):
+            return 0
+        cur.execute(PARTITION_LOCK_SQL)
+        created = int(ensure_app_partition(cur, app_id))
+        for month in sorted(missing):
+            created += int(ensure_month_partition(cur, app_id, month))
+        conn.commit()
+        with _KNOWN_LOCK:
+            _KNOWN.update((int(app_id), m) for m in missing)
+        return created
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+def forget_known_partitions():
+    """Xóa cache (sau khi migrate / detach phân vùng trong cùng process)"""
+    with _KNOWN_LOCK: _KNOWN.clear()
+
+def list_month_partitions(cur, app_id):
+    """[(tháng, tên bảng)] các phân vùng tháng đang gắn vào app, theo thứ tự thời gian"""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (app_table(app_id),))
+    prefix = f"{app_table(app_id)}_p"
+    result = []
+    for (name,) in cur.fetchall():
+        if name.startswith(prefix) and len(name) == len(prefix) + 6:
+            result.append((date(int(name[-6:-2]), int(name[-2:]), 1), name))
+    return sorted(result)
+
+def drop_app_partition(cur, app_id):
+    """Xóa toàn bộ dữ liệu 1 app = DROP phân vùng của app. Trả về False nếu bảng chưa phân vùng."""
+    if not is_partitioned(cur):
+        return False
+    cur.execute(f"DROP TABLE IF EXISTS {app_table(app_id)}")
+    forget_known_partitions()
+    return True
@@ -0,0 +1,211 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import wraps
+
+from flask import request, make_response
+from dotenv import load_dotenv
+
+from api.db_pool import get_pooled_connection
+
+load_dotenv()
+
+# ==========================================
+# CACHE KẾT QUẢ CÁC API DASHBOARD
+# Dữ liệu 1 app chỉ đổi khi có job ghi xong -> mỗi app có 1 "phiên bản dữ liệu" trên DB (app_data_versions).
+# - Key cache = endpoint + app + toàn bộ query (ngày, filter) + phiên bản dữ liệu
+#   -> job xong gọi bump_app_data_version() là mọi process API (kể cả ở máy khác) tự bỏ cache cũ.
+# - Response có ETag / Last-Modified: FE gửi lại If-None-Match -> 304, không phải tính lại.
+# - Backend: 'memory' (LRU + TTL trong process) hoặc 'redis' (dùng chung giữa các process).
+# ==========================================
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()  # memory | redis | off
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+VN_TZ = timezone(timedelta(hours=7))
+
+BUMP_VERSION_SQL = """
+    INSERT INTO app_data_versions (app_id, version, updated_at)
+    VALUES (%s, 1, NOW() AT TIME ZONE 'UTC')
+    ON CONFLICT (app_id) DO UPDATE SET
+        version = app_data_versions.version + 1,
+        updated_at = NOW() AT TIME ZONE 'UTC'
+"""
+
+
+class MemoryLRUBackend:
+    """LRU trong RAM của process, mỗi entry hết hạn sau ttl giây"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+
+class RedisBackend:
+    """Cache dùng chung qua Redis (cần cài gói redis)"""
+
+    def __init__(self, url=RESPONSE_CACHE_REDIS_URL, namespace="resp_cache:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+
+    def get(self, key):
+        import pickle
+        raw = self.client.get(self.namespace + key)
+        return pickle.loads(raw) if raw else None
+
+    def set(self, key, value, ttl):
+        import pickle
+        self.client.set(self.namespace + key, pickle.dumps(value), ex=ttl)
+
+    def delete_prefix(self, prefix):
+        for key in self.client.scan_iter(match=self.namespace + prefix + "*"):
+            self.client.delete(key)
+
+
+def _make_backend():
+    if RESPONSE_CACHE_BACKEND == 'off':
+        return None
+    if RESPONSE_CACHE_BACKEND == 'redis':
+        try:
+            return RedisBackend()
+        except Exception as e:
+            print(f"⚠️ Response Cache: không dùng được Redis ({e}), chuyển sang cache RAM.")
+    return MemoryLRUBackend()
+
+_BACKEND = _make_backend()
+
+def get_app_data_version(app_id):
+    """(version, updated_at UTC) của dữ liệu 1 app; (0, None) nếu app chưa có job nào ghi xong"""
+    conn = get_pooled_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT version, updated_at FROM app_data_versions WHERE app_id = %s", (app_id,))
+        row = cur.fetchone()
+        cur.close()
+        return (row[0], row[1]) if row else (0, None)
+    finally:
+        conn.close()
+
+def bump_app_data_version(app_id, cur=None):
+    """
+    Đánh dấu dữ liệu của app vừa đổi (job ghi xong / xóa app) -> cache cũ của app hết hiệu lực.
+    Truyền cur để ghi chung transaction của caller (caller tự commit).
+    """
+    try:
+        if cur is not None:
+            # Savepoint: lỗi ở đây không làm hỏng transaction đang ghi trạng thái job của caller
+            cur.execute("SAVEPOINT bump_app_data_version")
+            try:
+                cur.execute(BUMP_VERSION_SQL, (app_id,))
+                cur.execute("RELEASE SAVEPOINT bump_app_data_version")
+            except Exception:
+                cur.execute("ROLLBACK TO SAVEPOINT bump_app_data_version")
+                raise
+        else:
+            conn = get_pooled_connection()
+            try:
+                c = conn.cursor()
+                c.execute(BUMP_VERSION_SQL, (app_id,))
+                conn.commit()
+                c.close()
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"⚠️ Response Cache: bump version lỗi ({e})")
+    if _BACKEND is not None:
+        _BACKEND.delete_prefix(f"{app_id}|")
+
+def _cache_key(app_id, version):
+    # Ngày VN hiện tại nằm trong key: API tự lấy "hôm nay" khi FE không gửi ngày
+    args = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    today = datetime.now(VN_TZ).strftime('%Y-%m-%d')
+    return f"{app_id}|{request.path}|{args}|{today}|v{version}"
+
+def _not_modified(etag, last_modified):
+    inm = request.headers.get('If-None-Match')
+    if inm:
+        return etag in [t.strip() for t in inm.split(',')] or inm.strip() == '*'
+    ims = request.headers.get('If-Modified-Since')
+    if ims and last_modified is not None:
+        try: return parsedate_to_datetime(ims) >= last_modified.replace(microsecond=0)
+        except Exception: return False
+    return False
+
+def _with_validators(resp, etag, last_modified):
+    resp.headers['ETag'] = etag
+    if last_modified is not None:
+        resp.headers['Last-Modified'] = format_datetime(last_modified, usegmt=True)
+    resp.headers['Cache-Control'] = 'no-cache' # Trình duyệt luôn hỏi lại server (rẻ nhờ 304)
+    return resp
+
+def cached_response(ttl=RESPONSE_CACHE_TTL):
+    """
+    Decorator cho route Flask có tham số app_id: trả cache / 304 khi dữ liệu app chưa đổi.
+    Chỉ cache response 200.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if _BACKEND is None:
+                return view(*args, **kwargs)
+            app_id = kwargs.get('app_id')
+            try:
+                version, updated_at = get_app_data_version(app_id)
+            except Exception as e:
+                print(f"⚠️ Response Cache: bỏ qua cache ({e})")
+                return view(*args, **kwargs)
+
+            key = _cache_key(app_id, version)
+            etag = '"' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:20] + '"'
+            last_modified = updated_at.replace(tzinfo=timezone.utc) if updated_at else None
+
+            if _not_modified(etag, last_modified):
+                return _with_validators(make_response('', 304), etag, last_modified)
+
+            cached = _BACKEND.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                resp = make_response(body, 200)
+                resp.mimetype = mimetype
+                resp.headers['X-Cache'] = 'HIT'
+                return _with_validators(resp, etag, last_modified)
+
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code == 200 and not resp.direct_passthrough:
+                _BACKEND.set(key, (resp.get_data(), resp.mimetype), ttl)
+                resp.headers['X-Cache'] = 'MISS'
+                return _with_validators(resp, etag, last_modified)
+            return resp
+        return wrapper
+    return decorator
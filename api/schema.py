@@ -0,0 +1,241 @@
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+from api.db_pool import get_pooled_connection
+
+load_dotenv()
+
+# ==========================================
+# DDL BỔ SUNG CHO HỆ THỐNG (IDEMPOTENT - CHẠY LẠI BAO NHIÊU LẦN CŨNG ĐƯỢC)
+# Chạy tay: python api/schema.py
+# Chỉ chứa DDL rẻ (chạy mỗi lần API / worker khởi động). Việc nặng trên event_logs (đổi event_json sang JSONB,
+# build index) nằm ở api/scripts/migrate_event_logs.py, chạy tay lúc ít tải bằng CREATE INDEX CONCURRENTLY.
+# ==========================================
+SCHEMA_STATEMENTS = [
+    # Bảng đệm cho COPY: UNLOGGED => không ghi WAL, mỗi lô được đánh dấu bằng batch_id
+    """
+    CREATE UNLOGGED TABLE IF NOT EXISTS event_logs_staging (
+        batch_id      TEXT NOT NULL,
+        seq           INTEGER NOT NULL,
+        app_id        INTEGER,
+        event_name    TEXT,
+        event_json    TEXT,
+        count         INTEGER,
+        created_at    TIMESTAMP,
+        job_id        INTEGER,
+        uuid          TEXT,
+        raw_timestamp TEXT
+    )
+    """,
+
+    # Cột kiểu trích xuất sẵn lúc ingest (api/event_fields.py) -> API lọc/gom nhóm bằng SQL
+    # Dữ liệu cũ: chạy api/scripts/backfill_event_columns.py
+    """
+    ALTER TABLE event_logs
+        ADD COLUMN IF NOT EXISTS level_num        INTEGER,
+        ADD COLUMN IF NOT EXISTS user_uid         TEXT,
+        ADD COLUMN IF NOT EXISTS app_version_name TEXT,
+        ADD COLUMN IF NOT EXISTS country_iso_code TEXT,
+        ADD COLUMN IF NOT EXISTS coin_cost        BIGINT,
+        ADD COLUMN IF NOT EXISTS timeplay         DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS booster_counts   JSONB
+    """,
+    """
+    ALTER TABLE event_logs_staging
+        ADD COLUMN IF NOT EXISTS level_num        INTEGER,
+        ADD COLUMN IF NOT EXISTS user_uid         TEXT,
+        ADD COLUMN IF NOT EXISTS app_version_name TEXT,
+        ADD COLUMN IF NOT EXISTS country_iso_code TEXT,
+        ADD COLUMN IF NOT EXISTS coin_cost        BIGINT,
+        ADD COLUMN IF NOT EXISTS timeplay         DOUBLE PRECISION,
+        ADD COLUMN IF NOT EXISTS booster_counts   JSONB
+    """,
+    # Dấu vân tay nội dung (api/bulk_loader.py): import lại event không đổi thì bỏ qua, không UPDATE
+    "ALTER TABLE event_logs ADD COLUMN IF NOT EXISTS event_fingerprint UUID",
+
+    # Rollup theo ngày (giờ VN) x level cho Data Check (api/level_rollup.py)
+    # Dữ liệu cũ: chạy api/scripts/rebuild_level_rollup.py
+    """
+    CREATE TABLE IF NOT EXISTS level_daily_stats (
+        app_id           INTEGER NOT NULL,
+        stat_date        DATE NOT NULL,
+        level_num        INTEGER NOT NULL,
+        app_version_name TEXT NOT NULL DEFAULT '',
+        country_iso_code TEXT NOT NULL DEFAULT '',
+        event_count      BIGINT NOT NULL DEFAULT 0,
+        total_plays      BIGINT NOT NULL DEFAULT 0,
+        timeplay_sum     DOUBLE PRECISION NOT NULL DEFAULT 0,
+        timeplay_count   BIGINT NOT NULL DEFAULT 0,
+        booster_totals   JSONB NOT NULL DEFAULT '{}'::jsonb,
+        updated_at       TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (app_id, stat_date, level_num, app_version_name, country_iso_code)
+    )
+    """,
+
+    # Từ điển user -> số thứ tự dày theo từng app (vị trí bit trong bitmap user của rollup)
+    """
+    CREATE TABLE IF NOT EXISTS user_dictionary (
+        app_id     INTEGER NOT NULL,
+        user_uid   TEXT NOT NULL,
+        user_idx   INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (app_id, user_uid),
+        UNIQUE (app_id, user_idx)
+    )
+    """,
+    # Bitmap (zlib) tập user start / win của từng ô rollup (api/user_bitmap.py)
+    """
+    ALTER TABLE level_daily_stats
+        ADD COLUMN IF NOT EXISTS start_users BYTEA,
+        ADD COLUMN IF NOT EXISTS win_users   BYTEA
+    """,
+
+    # Log của job: chỉ thêm dòng, ghi theo lô (api/job_log.py) thay cho nối chuỗi vào job_history.logs
+    """
+    CREATE TABLE IF NOT EXISTS job_log_lines (
+        id        BIGSERIAL PRIMARY KEY,
+        job_id    INTEGER NOT NULL,
+        logged_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        line      TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_job_log_lines_job ON job_log_lines (job_id, id)",
+    # Phân trang keyset của /monitor/history theo (created_at, id)
+    "CREATE INDEX IF NOT EXISTS idx_job_history_created_id ON job_history (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_job_history_app_created_id ON job_history (app_id, created_at, id)",
+    # Backfill chia cửa sổ (api/backfill.py): job cha có window_total, job con trỏ về cha qua parent_job_id
+    """
+    ALTER TABLE job_history
+        ADD COLUMN IF NOT EXISTS parent_job_id INTEGER,
+        ADD COLUMN IF NOT EXISTS window_index  INTEGER,
+        ADD COLUMN IF NOT EXISTS window_total  INTEGER
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_job_history_parent ON job_history (parent_job_id, status) WHERE parent_job_id IS NOT NULL",
+
+    # Trạng thái lùi khi AppMetrica trả 429 theo từng token (api/token_budget.py); khóa = md5 token
+    """
+    CREATE TABLE IF NOT EXISTS token_rate_state (
+        token_hash     TEXT PRIMARY KEY,
+        backoff_level  INTEGER NOT NULL DEFAULT 0,
+        inflight_limit INTEGER NOT NULL DEFAULT 1,
+        blocked_until  TIMESTAMP,
+        total_429      BIGINT NOT NULL DEFAULT 0,
+        last_429_at    TIMESTAMP,
+        updated_at     TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'UTC')
+    )
+    """,
+    "ALTER TABLE job_history ADD COLUMN IF NOT EXISTS rate_limit_hits INTEGER NOT NULL DEFAULT 0",
+    # Số event của file spool đã commit vào DB (api/export_spool.py) -> Retry chạy tiếp từ mốc này
+    "ALTER TABLE job_history ADD COLUMN IF NOT EXISTS spool_committed INTEGER NOT NULL DEFAULT 0",
+
+    # Khóa thật cho level_analytics: 1 session = 1 dòng (chạy lại ETL chỉ cập nhật, không nhân bản)
+    # Lần đầu: dọn các dòng trùng (giữ dòng mới nhất) rồi mới tạo unique index
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'uq_level_analytics_app_session') THEN
+            DELETE FROM level_analytics a
+            USING level_analytics b
+            WHERE a.app_id IS NOT DISTINCT FROM b.app_id AND a.session_id = b.session_id AND a.id < b.id;
+            CREATE UNIQUE INDEX uq_level_analytics_app_session ON level_analytics (app_id, session_id);
+        END IF;
+    END $$
+    """,
+
+    # Mốc đã xử lý của từng pipeline tổng hợp theo app (api/etl_processor.py chạy tăng dần)
+    """
+    CREATE TABLE IF NOT EXISTS etl_watermarks (
+        app_id     INTEGER NOT NULL,
+        pipeline   TEXT NOT NULL,
+        watermark  TIMESTAMP,
+        config_key TEXT,
+        updated_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (app_id, pipeline)
+    )
+    """,
+    # Event ghi vào có thời gian cũ hơn watermark (backfill, Retry...) -> lần ETL sau quét lại từ rescan_from.
+    # rescan_seq tăng mỗi lần đánh dấu: ETL chỉ xóa rescan_from nếu không có lần ghi nào xen vào lúc đang chạy.
+    "ALTER TABLE etl_watermarks ADD COLUMN IF NOT EXISTS rescan_from TIMESTAMP",
+    "ALTER TABLE etl_watermarks ADD COLUMN IF NOT EXISTS rescan_seq BIGINT NOT NULL DEFAULT 0",
+
+    # Phiên bản dữ liệu của từng app: tăng mỗi khi job ghi xong -> cache API dashboard hết hiệu lực (api/response_cache.py)
+    """
+    CREATE TABLE IF NOT EXISTS app_data_versions (
+        app_id     INTEGER PRIMARY KEY,
+        version    BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'UTC')
+    )
+    """,
+]
+
+# Index của event_logs: (tên, phần định nghĩa sau "ON <bảng>", extension cần có hoặc None).
+# Build bằng api/scripts/migrate_event_logs.py (CONCURRENTLY), bảng phân vùng tạo lại theo đúng danh sách này
+# (api/scripts/manage_partitions.py)
+EVENT_LOG_INDEXES = [
+    # Cột kiểu trích xuất lúc ingest (api/event_fields.py)
+    ("idx_event_logs_app_level", "(app_id, level_num, event_name)", None),
+    ("idx_event_logs_app_user", "(app_id, user_uid)", None),
+    ("idx_event_logs_app_version", "(app_id, app_version_name)", None),
+    ("idx_event_logs_app_country", "(app_id, country_iso_code)", None),
+    ("idx_event_logs_app_created", "(app_id, created_at)", None),
+    ("idx_event_logs_app_event_created", "(app_id, event_name, created_at)", None),
+    # GIN cho truy vấn chứa (@>) bất kỳ key nào; expression index cho các key hay bị dò trực tiếp
+    ("idx_event_logs_json_gin", "USING GIN (event_json jsonb_path_ops)", None),
+    ("idx_event_logs_json_version", "(app_id, (event_json->>'app_version_name'))", None),
+    ("idx_event_logs_json_country", "(app_id, (event_json->>'country_iso_code'))", None),
+    ("idx_event_logs_json_level_display", "(app_id, (event_json->>'level_display'))", None),
+    # Tìm keyword trong Data Explorer (event_json::text ILIKE '%kw%') bằng trigram index
+    # Máy DB không có pg_trgm / không đủ quyền CREATE EXTENSION -> bỏ qua, ILIKE vẫn chạy (chậm hơn)
+    ("idx_event_logs_json_trgm", "USING GIN ((event_json::text) gin_trgm_ops)", "pg_trgm"),
+]
+
+# Cột JSON phải là JSONB (lọc bằng ->> / @> ăn index thay vì ::text LIKE / regex / ::json)
+JSONB_COLUMNS = [("event_logs", "event_json"), ("event_logs", "event_json_old"), ("event_logs_staging", "event_json")]
+
+def pending_event_log_migrations(cur):
+    """Các bước của api/scripts/migrate_event_logs.py chưa chạy (cột chưa JSONB, index thiếu / dở dang)"""
+    pending = []
+    for table, column in JSONB_COLUMNS:
+        cur.execute("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = %s AND column_name = %s AND table_schema = current_schema()
+        """, (table, column))
+        row = cur.fetchone()
+        if row and row[0] != 'jsonb': pending.append(f"{table}.{column} ({row[0]})")
+    cur.execute("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = ANY(%s) AND i.indisvalid AND pg_table_is_visible(c.oid)
+    """, ([name for name, _, _ in EVENT_LOG_INDEXES],))
+    valid = {row[0] for row in cur.fetchall()}
+    cur.execute("SELECT name FROM pg_available_extensions")
+    available = {row[0] for row in cur.fetchall()}
+    pending += [name for name, _, ext in EVENT_LOG_INDEXES if name not in valid and (ext is None or ext in available)]
+    return pending
+
+def ensure_schema(conn):
+    """Áp dụng toàn bộ SCHEMA_STATEMENTS trên connection truyền vào; nhắc nếu event_logs chưa migrate"""
+    cur = conn.cursor()
+    try:
+        for stmt in SCHEMA_STATEMENTS:
+            cur.execute(stmt)
+        conn.commit()
+        pending = pending_event_log_migrations(cur)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    if pending:
+        print(f"⚠️ event_logs chưa migrate xong ({', '.join(pending)}) -> chạy: python api/scripts/migrate_event_logs.py")
+
+if __name__ == '__main__':
+    conn = get_pooled_connection()
+    try:
+        ensure_schema(conn)
+        print(f"✅ Schema OK ({len(SCHEMA_STATEMENTS)} statements).")
+    finally:
+        conn.close()
@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+from api.db_pool import get_pooled_connection
+from api.schema import ensure_schema
+from api.event_fields import TYPED_COLUMNS, extract_event_fields_from_json
+from api.bulk_loader import FINGERPRINT_SQL
+from api.response_cache import bump_app_data_version
+from api.etl_processor import mark_etl_rescan
+
+load_dotenv()
+
+# ==========================================
+# BACKFILL CỘT KIỂU + DẤU VÂN TAY NỘI DUNG (event_fingerprint) CHO DỮ LIỆU CŨ TRONG event_logs
+# Quét theo khoảng id (mỗi lô commit riêng) -> dừng giữa chừng thì chạy lại với --from-id
+# PHẢI chạy xong trước ETL level session (api/etl_processor.py ghép session theo cột user_uid, dòng chưa backfill
+# bị coi là Guest -> ETL tự dừng nếu còn dòng chưa backfill trong khoảng quét).
+# Đã backfill trước khi thêm key user uid / user (api/event_fields.py USER_KEYS) -> chạy lại với --only-missing.
+# Ví dụ: python api/scripts/backfill_event_columns.py --app-id 2 --batch-size 5000
+# ==========================================
+
+UPDATE_SQL = f"""
+    UPDATE event_logs e SET
+        {", ".join(f"{c} = v.{c}" for c in TYPED_COLUMNS)},
+        event_fingerprint = {FINGERPRINT_SQL.replace("event_json", "e.event_json")}
+    FROM (VALUES %s) AS v (id, {", ".join(TYPED_COLUMNS)})
+    WHERE e.id = v.id
+"""
+# Ép kiểu cho VALUES (NULL trong VALUES mặc định là TEXT)
+UPDATE_TEMPLATE = "(%s, %s::integer, %s, %s, %s, %s::bigint, %s::double precision, %s::jsonb)"
+
+def backfill(app_id=None, batch_size=5000, from_id=0, only_missing=False):
+    conn = get_pooled_connection()
+    touched = set() # App có dòng vừa được ghi lại cột kiểu -> bump version để cache cũ hết hiệu lực
+    try:
+        ensure_schema(conn)
+        cur = conn.cursor()
+
+        where = ["id > %s"]
+        params = []
+        if app_id:
+            where.append("app_id = %s"); params.append(app_id)
+        if only_missing:
+            # Dòng đã có cột kiểu từ trước nhưng chưa có event_fingerprint cũng cần chạy lại
+            # user_uid NULL: dòng backfill trước khi USER_KEYS có uid / user cũng chạy lại
+            where.append("(user_uid IS NULL OR (level_num IS NULL AND app_version_name IS NULL) OR event_fingerprint IS NULL)")
+
+        last_id = from_id
+        total = 0
+        t0 = time.time()
+        while True:
+            cur.execute(f"""
+                SELECT id, event_name, event_json, app_id, created_at FROM event_logs
+                WHERE {" AND ".join(where)}
+                ORDER BY id LIMIT %s
+            """, tuple([last_id] + params + [batch_size]))
+            rows = cur.fetchall()
+            if not rows: break
+
+            values = [(r[0],) + extract_event_fields_from_json(r[1], r[2]) for r in rows]
+            execute_values(cur, UPDATE_SQL, values, template=UPDATE_TEMPLATE, page_size=len(values))
+            # user_uid vừa đổi -> ETL level session tăng dần quét lại từ dòng sớm nhất của lô
+            for batch_app in {r[3] for r in rows}:
+                mark_etl_rescan(cur, batch_app, min((r[4] for r in rows if r[3] == batch_app and r[4] is not None), default=None))
+            conn.commit()
+            touched |= {r[3] for r in rows}
+
+            last_id = rows[-1][0]
+            total += len(rows)
+            print(f"   ⚡ Backfill: {total} dòng (id <= {last_id}) - {round(time.time() - t0, 1)}s", flush=True)
+
+        print(f"✅ Backfill xong {total} dòng.")
+        return total
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        for touched_app in sorted(touched): bump_app_data_version(touched_app)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Backfill level/user/version/geo/coin/booster + event_fingerprint cho event_logs cũ")
+    parser.add_argument('--app-id', type=int, default=None, help="Chỉ chạy cho 1 app (mặc định: tất cả)")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--from-id', type=int, default=0, help="Chạy tiếp từ id này (sau khi bị dừng giữa chừng)")
+    parser.add_argument('--only-missing', action='store_true', help="Bỏ qua dòng đã có cột kiểu và event_fingerprint")
+    args = parser.parse_args()
+
+    backfill(args.app_id, args.batch_size, args.from_id, args.only_missing)
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from api.event_json import flatten_event, dumps, set_json_backend, INGEST_POLICY, READ_POLICY
+
+# ==========================================
+# ĐO TỐC ĐỘ BỘ LÀM PHẲNG event_json (api/event_json.py)
+# Sinh event giả giống export AppMetrica (event_json dạng chuỗi, có lớp lồng, có dòng bị encode 2 lần)
+# rồi đo số event/giây của luồng ingest và luồng đọc, với từng backend JSON.
+# Ví dụ: python api/scripts/bench_event_json.py --events 50000
+# Không cần DB.
+# ==========================================
+
+def make_payloads(n, seed=42):
+    """(events thô như AppMetrica trả về, event_json đã lưu trong DB)"""
+    rnd = random.Random(seed)
+    events, stored = [], []
+    for i in range(n):
+        game = {
+            "levelID": rnd.randint(1, 300), "missionID": rnd.randint(1, 300),
+            "userID": f"u{rnd.randint(1, 5000)}", "timeplay": rnd.randint(5, 600),
+            "coin_spent": rnd.choice([0, 60, 120, 190]), "coin_balance": rnd.randint(0, 99999),
+            "booster_Hammer": rnd.randint(0, 3), "revive_boosterClear": rnd.randint(0, 1),
+            "note": "Màn chơi thử nghiệm",
+        }
+        kind = i % 3
+        if kind == 0:
+            event_json = json.dumps(game)
+        elif kind == 1:
+            # Tham số game nằm trong 'params' dạng chuỗi
+            event_json = json.dumps({"source": "sdk", "params": json.dumps(game)})
+        else:
+            # Bị encode 2 lần
+            event_json = json.dumps(json.dumps(game))
+        event = {
+            "event_name": rnd.choice(["missionStart", "missionComplete", "missionFail", "booster_use"]),
+            "event_json": event_json,
+            "event_timestamp": str(1760000000 + i),
+            "installation_id": f"inst-{rnd.randint(1, 5000)}",
+            "app_version_name": rnd.choice(["1.0.3", "1.0.4"]),
+            "country_iso_code": rnd.choice(["VN", "US", "TH"]),
+        }
+        events.append(event)
+        stored.append(event_json if kind else json.dumps(flatten_event(event, INGEST_POLICY), ensure_ascii=False))
+    return events, stored
+
+def bench(label, fn, items):
+    t0 = time.perf_counter()
+    for item in items: fn(item)
+    elapsed = time.perf_counter() - t0
+    print(f"   {label:<28} {len(items) / elapsed:>12,.0f} events/s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đo tốc độ làm phẳng event_json theo từng backend")
+    parser.add_argument('--events', type=int, default=20000, help="Số event giả")
+    parser.add_argument('--backend', action='append', choices=['json', 'orjson'], help="Mặc định: cả hai")
+    args = parser.parse_args()
+
+    events, stored = make_payloads(args.events)
+    for backend in args.backend or ['json', 'orjson']:
+        used = set_json_backend(backend)
+        if used != backend:
+            print(f"⚠️ Backend {backend} chưa cài, bỏ qua.")
+            continue
+        print(f"⏱️ Backend: {used} ({args.events} events)")
+        bench("ingest (flatten + dumps)", lambda e: dumps(flatten_event(e, INGEST_POLICY)), events)
+        bench("read (flatten)", lambda s: flatten_event(s, READ_POLICY), stored)
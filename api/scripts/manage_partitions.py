@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import argparse
+from datetime import date, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from dotenv import load_dotenv
+
+from api.db_pool import get_pooled_connection
+from api.schema import EVENT_LOG_INDEXES, ensure_schema
+from api.response_cache import bump_app_data_version
+from api.partitions import (
+    PARENT_TABLE, TOP_DEFAULT, PARTITION_LOCK_SQL, is_partitioned, table_exists,
+    ensure_app_partition, ensure_month_partition, list_month_partitions, iter_months, month_floor, next_month
+)
+
+load_dotenv()
+
+# ==========================================
+# QUẢN LÝ PHÂN VÙNG event_logs (api/partitions.py)
+#   migrate  : chuyển bảng event_logs thường -> bảng phân vùng (app x tháng). DỪNG WORKER TRƯỚC KHI CHẠY.
+#              Bảng cũ được giữ lại tên event_logs_legacy để đối chiếu (xóa bằng lệnh drop-legacy).
+#   create   : tạo trước phân vùng các tháng sắp tới cho mọi app (chạy định kỳ, VD mỗi ngày)
+#   archive  : tách (DETACH) các tháng cũ hơn N tháng sang schema event_logs_archive, hoặc --drop để xóa hẳn
+#   status   : liệt kê phân vùng & số dòng ước lượng
+# Ví dụ:
+#   python api/scripts/manage_partitions.py migrate --batch-size 200000
+#   python api/scripts/manage_partitions.py create --months-ahead 2
+#   python api/scripts/manage_partitions.py archive --older-than-months 6 --drop
+# ==========================================
+
+BUILD_TABLE = "event_logs_part"
+LEGACY_TABLE = "event_logs_legacy"
+ARCHIVE_SCHEMA = "event_logs_archive"
+
+# Index riêng của bảng phân vùng (ngoài EVENT_LOG_INDEXES của api/schema.py): (tên, 'UNIQUE'|'', định nghĩa, extension)
+PARTITIONED_INDEXES = [
+    ("uq_event_logs_event_key", "UNIQUE", "(app_id, event_name, raw_timestamp, uuid, created_at)", None), # Key chống trùng (bulk_loader)
+    ("idx_event_logs_id", "", "(id)", None),
+]
+
+def event_log_indexes(cur):
+    """
+    [(tên, 'UNIQUE'|'', định nghĩa)] cần có trên bảng phân vùng: EVENT_LOG_INDEXES + PARTITIONED_INDEXES.
+    Index cần extension chưa cài (pg_trgm) thì bỏ qua; index trên event_json chỉ build khi cột đã là JSONB.
+    """
+    cur.execute("SELECT extname FROM pg_extension")
+    installed = {row[0] for row in cur.fetchall()}
+    cur.execute("""
+        SELECT data_type = 'jsonb' FROM information_schema.columns
+        WHERE table_name = %s AND column_name = 'event_json' AND table_schema = current_schema()
+    """, (PARENT_TABLE,))
+    row = cur.fetchone()
+    jsonb = bool(row and row[0])
+    result = []
+    for name, unique, definition, extension in [(n, "", d, e) for n, d, e in EVENT_LOG_INDEXES] + PARTITIONED_INDEXES:
+        if extension and extension not in installed: continue
+        if 'event_json' in definition and not jsonb: continue
+        result.append((name, unique, definition))
+    return result
+
+def app_ids_with_data(cur, table):
+    cur.execute(f"SELECT DISTINCT app_id FROM {table} WHERE app_id IS NOT NULL ORDER BY 1")
+    return [r[0] for r in cur.fetchall()]
+
+def migrate(batch_size=100000, force=False):
+    conn = get_pooled_connection()
+    cur = conn.cursor()
+    try:
+        ensure_schema(conn) # Đủ cột kiểu trước khi sao chép cấu trúc
+        if is_partitioned(cur):
+            print("✅ event_logs đã là bảng phân vùng.")
+            return
+        if table_exists(cur, LEGACY_TABLE):
+            raise RuntimeError(f"Đã có bảng {LEGACY_TABLE} từ lần migrate trước - kiểm tra rồi drop-legacy trước.")
+
+        cur.execute("SELECT COUNT(*) FROM job_history WHERE status IN ('Running', 'Processing')")
+        running = cur.fetchone()[0]
+        if running and not force:
+            raise RuntimeError(f"Đang có {running} job chạy. Dừng worker (EMBEDDED_WORKERS=0, tắt api/worker.py) rồi chạy lại, hoặc --force.")
+
+        # 1. Bảng phân vùng mới (cùng cột, cùng DEFAULT - id vẫn lấy từ sequence cũ)
+        if not table_exists(cur, BUILD_TABLE):
+            cur.execute(f"CREATE TABLE {BUILD_TABLE} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS) PARTITION BY LIST (app_id)")
+            cur.execute(f"CREATE TABLE {TOP_DEFAULT} PARTITION OF {BUILD_TABLE} DEFAULT")
+        cur.execute(PARTITION_LOCK_SQL)
+        for app_id in app_ids_with_data(cur, PARENT_TABLE):
+            ensure_app_partition(cur, app_id, parent=BUILD_TABLE)
+            cur.execute(f"SELECT MIN(created_at), MAX(created_at) FROM {PARENT_TABLE} WHERE app_id = %s", (app_id,))
+            first, last = cur.fetchone()
+            if first is None: continue
+            for month in iter_months(first, last):
+                ensure_month_partition(cur, app_id, month)
+        conn.commit()
+        print("🧱 Đã tạo cấu trúc phân vùng.")
+
+        # 2. Chép dữ liệu theo khoảng id (mỗi khoảng 1 transaction; chạy lại được nhờ bỏ qua phần đã chép)
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {BUILD_TABLE}")
+        last_id = cur.fetchone()[0]
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) FROM {PARENT_TABLE}")
+        max_id = cur.fetchone()[0]
+        t0 = time.time()
+        while last_id < max_id:
+            upper = last_id + batch_size
+            cur.execute(f"INSERT INTO {BUILD_TABLE} SELECT * FROM {PARENT_TABLE} WHERE id > %s AND id <= %s", (last_id, upper))
+            conn.commit()
+            print(f"   📦 id {last_id + 1:,} -> {min(upper, max_id):,} ({round(time.time() - t0, 1)}s)", flush=True)
+            last_id = upper
+
+        # 3. Index trên bảng mới (tên tạm *_part, đổi tên lúc hoán đổi)
+        indexes = event_log_indexes(cur)
+        for name, unique, definition in indexes:
+            print(f"   🗂️ Index {name}...", flush=True)
+            cur.execute(f"CREATE {unique} INDEX IF NOT EXISTS {name}_part ON {BUILD_TABLE} {definition}")
+            conn.commit()
+
+        # 4. Hoán đổi: khóa ghi bảng cũ, chép nốt dòng mới phát sinh, đổi tên
+        cur.execute(f"LOCK TABLE {PARENT_TABLE} IN EXCLUSIVE MODE")
+        cur.execute(f"INSERT INTO {BUILD_TABLE} SELECT * FROM {PARENT_TABLE} WHERE id > %s", (max_id,))
+        print(f"   ➕ Dòng phát sinh trong lúc chép: {cur.rowcount}")
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (PARENT_TABLE,))
+        seq = cur.fetchone()[0]
+        if seq:
+            cur.execute(f"ALTER SEQUENCE {seq} OWNED BY NONE") # Drop bảng cũ sau này không kéo theo sequence
+
+        cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND schemaname = current_schema()", (PARENT_TABLE,))
+        legacy_indexes = [r[0] for r in cur.fetchall()]
+        for idx in legacy_indexes:
+            cur.execute(f"ALTER INDEX {idx} RENAME TO {idx[:54]}_legacy")
+        cur.execute(f"ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_TABLE}")
+        cur.execute(f"ALTER TABLE {BUILD_TABLE} RENAME TO {PARENT_TABLE}")
+        for name, _, _ in indexes:
+            cur.execute(f"ALTER INDEX {name}_part RENAME TO {name}")
+        if seq:
+            cur.execute(f"ALTER SEQUENCE {seq} OWNED BY {PARENT_TABLE}.id")
+        conn.commit()
+
+        known = set(n for n, _, _ in indexes)
+        extra = [i for i in legacy_indexes if i not in known]
+        print(f"✅ Migrate xong. Bảng cũ: {LEGACY_TABLE}.")
+        if extra:
+            print(f"⚠️ Index chỉ có trên bảng cũ (không tạo lại): {', '.join(extra)}")
+        print("👉 Khởi động lại API / worker để dùng key chống trùng mới.")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+def create_ahead(app_ids=None, months_ahead=2):
+    conn = get_pooled_connection()
+    cur = conn.cursor()
+    try:
+        if not is_partitioned(cur):
+            print("⏭️ event_logs chưa phân vùng (chạy migrate trước).")
+            return
+        if not app_ids:
+            cur.execute("SELECT id FROM apps ORDER BY id")
+            app_ids = [r[0] for r in cur.fetchall()]
+        this_month = month_floor(date.today())
+        last = this_month
+        for _ in range(months_ahead): last = next_month(last)
+
+        cur.execute(PARTITION_LOCK_SQL)
+        created = 0
+        for app_id in app_ids:
+            created += int(ensure_app_partition(cur, app_id))
+            for month in iter_months(this_month, last):
+                created += int(ensure_month_partition(cur, app_id, month))
+        conn.commit()
+        print(f"✅ Đã tạo {created} phân vùng mới ({len(app_ids)} app, tới tháng {last.strftime('%Y-%m')}).")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+def archive(older_than_months, app_ids=None, drop=False):
+    conn = get_pooled_connection()
+    cur = conn.cursor()
+    touched = set() # App vừa bị tách phân vùng -> bump version để cache cũ (còn chứa tháng cũ) hết hiệu lực
+    try:
+        if not is_partitioned(cur):
+            print("⏭️ event_logs chưa phân vùng (chạy migrate trước).")
+            return
+        if not app_ids:
+            cur.execute("SELECT id FROM apps ORDER BY id")
+            app_ids = [r[0] for r in cur.fetchall()]
+        # Giữ nguyên older_than_months tháng gần nhất (tính cả tháng hiện tại)
+        cutoff = month_floor(date.today())
+        for _ in range(older_than_months):
+            cutoff = month_floor(cutoff - timedelta(days=1))
+
+        if not drop:
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}")
+            conn.commit()
+        for app_id in app_ids:
+            for month, name in list_month_partitions(cur, app_id):
+                if next_month(month) > cutoff: continue
+                cur.execute(f"ALTER TABLE event_logs_a{int(app_id)} DETACH PARTITION {name}")
+                if drop:
+                    cur.execute(f"DROP TABLE {name}")
+                    print(f"   🗑️ App {app_id} | {month.strftime('%Y-%m')}: DROP {name}")
+                else:
+                    cur.execute(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}")
+                    print(f"   📦 App {app_id} | {month.strftime('%Y-%m')}: {name} -> {ARCHIVE_SCHEMA}.{name}")
+                conn.commit()
+                touched.add(app_id)
+        print(f"✅ Xong (giữ dữ liệu từ {cutoff.strftime('%Y-%m')}).")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+        for app_id in sorted(touched): bump_app_data_version(app_id)
+
+def drop_legacy():
+    conn = get_pooled_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f"DROP TABLE IF EXISTS {LEGACY_TABLE}")
+        conn.commit()
+        print(f"✅ Đã xóa {LEGACY_TABLE}.")
+    finally:
+        cur.close()
+        conn.close()
+
+def status():
+    conn = get_pooled_connection()
+    cur = conn.cursor()
+    try:
+        if not is_partitioned(cur):
+            print("ℹ️ event_logs chưa phân vùng.")
+            return
+        cur.execute("""
+            SELECT c.relname, p.relname, c.reltuples::bigint
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE c.relkind IN ('r', 'p') AND (p.relname = %s OR p.relname LIKE 'event_logs\\_a%%')
+            ORDER BY 2, 1
+        """, (PARENT_TABLE,))
+        for name, parent, rows in cur.fetchall():
+            print(f"   {parent:<24} {name:<36} ~{max(rows, 0):,} rows")
+    finally:
+        cur.close()
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Quản lý phân vùng bảng event_logs")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_migrate = sub.add_parser('migrate', help="Chuyển event_logs sang bảng phân vùng")
+    p_migrate.add_argument('--batch-size', type=int, default=100000, help="Số id mỗi lượt chép")
+    p_migrate.add_argument('--force', action='store_true', help="Chạy dù đang có job Running/Processing")
+
+    p_create = sub.add_parser('create', help="Tạo trước phân vùng các tháng sắp tới")
+    p_create.add_argument('--app-id', type=int, action='append', help="Có thể lặp lại; mặc định: tất cả app")
+    p_create.add_argument('--months-ahead', type=int, default=2)
+
+    p_archive = sub.add_parser('archive', help="Tách / xóa phân vùng tháng cũ")
+    p_archive.add_argument('--older-than-months', type=int, required=True, help="Giữ lại N tháng gần nhất")
+    p_archive.add_argument('--app-id', type=int, action='append', help="Có thể lặp lại; mặc định: tất cả app")
+    p_archive.add_argument('--drop', action='store_true', help="Xóa hẳn thay vì chuyển sang schema archive")
+
+    sub.add_parser('drop-legacy', help=f"Xóa bảng {LEGACY_TABLE} sau khi đã đối chiếu")
+    sub.add_parser('status', help="Liệt kê phân vùng")
+
+    args = parser.parse_args()
+    if args.command == 'migrate': migrate(args.batch_size, args.force)
+    elif args.command == 'create': create_ahead(args.app_id, args.months_ahead)
+    elif args.command == 'archive': archive(args.older_than_months, args.app_id, args.drop)
+    elif args.command == 'drop-legacy': drop_legacy()
+    elif args.command == 'status': status()
@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from dotenv import load_dotenv
+
+from api.db_pool import connect_direct
+from api.schema import EVENT_LOG_INDEXES, JSONB_COLUMNS, ensure_schema, pending_event_log_migrations
+from api.partitions import PARENT_TABLE, is_partitioned
+
+load_dotenv()
+
+# ==========================================
+# MIGRATE BẢNG event_logs (VIỆC NẶNG, KHÔNG CHẠY LÚC KHỞI ĐỘNG API / WORKER)
+# 1. Đổi event_json / event_json_old sang JSONB: VIẾT LẠI CẢ BẢNG, khóa ACCESS EXCLUSIVE suốt lúc chạy
+#    -> chạy lúc ít tải, tốt nhất dừng worker trước (bỏ qua bằng --skip-jsonb nếu chỉ cần build index).
+# 2. Build các index trong api/schema.py (EVENT_LOG_INDEXES) bằng CREATE INDEX CONCURRENTLY (không chặn ghi).
+#    Bảng phân vùng: tạo index ON ONLY ở bảng cha, build CONCURRENTLY từng phân vùng lá rồi ATTACH.
+#    Index dở dang (lần trước bị ngắt giữa chừng) được xóa và build lại.
+#    Index cần extension (pg_trgm): thử CREATE EXTENSION, máy DB không có / không đủ quyền thì bỏ qua.
+# Chạy lại bao nhiêu lần cũng được, bước đã xong thì bỏ qua.
+# Ví dụ:
+#   python api/scripts/migrate_event_logs.py
+#   python api/scripts/migrate_event_logs.py --skip-jsonb
+# ==========================================
+
+# Ép kiểu an toàn: dòng cũ không phải JSON hợp lệ được giữ nguyên dưới dạng chuỗi JSON (không mất dữ liệu)
+SAFE_JSONB_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION event_json_to_jsonb(raw TEXT) RETURNS JSONB
+    LANGUAGE plpgsql IMMUTABLE AS $$
+    BEGIN
+        RETURN raw::jsonb;
+    EXCEPTION WHEN others THEN
+        RETURN to_jsonb(raw);
+    END $$
+"""
+
+def column_type(cur, table, column):
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = %s AND column_name = %s AND table_schema = current_schema()
+    """, (table, column))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def migrate_jsonb(cur):
+    """Đổi các cột JSON còn là TEXT sang JSONB (bảng phân vùng: đổi ở bảng cha là đủ, Postgres viết lại mọi phân vùng)"""
+    cur.execute(SAFE_JSONB_FUNCTION_SQL)
+    for table, column in JSONB_COLUMNS:
+        current = column_type(cur, table, column)
+        if current is None or current == 'jsonb': continue
+        print(f"   🔁 {table}.{column}: {current} -> jsonb (viết lại bảng)...", flush=True)
+        t0 = time.time()
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE JSONB USING event_json_to_jsonb({column})")
+        print(f"   ✅ {table}.{column} xong ({round(time.time() - t0, 1)}s)", flush=True)
+
+def index_state(cur, name):
+    """None nếu chưa có index, ngược lại (valid, bảng của index)"""
+    cur.execute("""
+        SELECT i.indisvalid, t.relname
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid JOIN pg_class t ON t.oid = i.indrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+    """, (name,))
+    return cur.fetchone()
+
+def child_tables(cur, table):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s AND pg_table_is_visible(p.oid)
+        ORDER BY 1
+    """, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+def is_attached(cur, parent_index, child_index):
+    cur.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s AND c.relname = %s
+        )
+    """, (parent_index, child_index))
+    return cur.fetchone()[0]
+
+def ensure_extension(cur, extension):
+    """True nếu extension đã có (hoặc vừa tạo được)"""
+    cur.execute("SELECT installed_version IS NOT NULL FROM pg_available_extensions WHERE name = %s", (extension,))
+    row = cur.fetchone()
+    if row is None: return False # Máy DB không cài gói extension
+    if row[0]: return True
+    try:
+        cur.execute(f"CREATE EXTENSION IF NOT EXISTS {extension}")
+        return True
+    except Exception as e:
+        print(f"   ⚠️ Không tạo được {extension}: {str(e).splitlines()[0]}")
+        return False
+
+def build_index(cur, table, name, definition, suffix=None):
+    """
+    Build 1 index không chặn ghi (connection autocommit). Bảng phân vùng: đệ quy xuống từng phân vùng,
+    index của phân vùng tên <phân vùng>_<suffix> (suffix = tên index bỏ tiền tố idx_event_logs_)
+    """
+    suffix = suffix or name.replace('idx_event_logs_', '')
+    state = index_state(cur, name)
+    if state and state[0]: return False
+
+    if is_partitioned(cur, table):
+        # Index ON ONLY ở bảng cha nằm ở trạng thái invalid tới khi mọi phân vùng con được ATTACH
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} {definition}")
+        for child in child_tables(cur, table):
+            child_name = f"{child}_{suffix}"[:63]
+            build_index(cur, child, child_name, definition, suffix)
+            if not is_attached(cur, name, child_name):
+                cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {child_name}")
+        return True
+
+    if state and not state[0]:
+        print(f"   🧹 Xóa index dở dang {name}", flush=True)
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    print(f"   🗂️ {table}: {name}...", flush=True)
+    t0 = time.time()
+    cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+    print(f"   ✅ {name} ({round(time.time() - t0, 1)}s)", flush=True)
+    return True
+
+def migrate(skip_jsonb=False):
+    conn = connect_direct()
+    try:
+        ensure_schema(conn) # Bảng / cột bổ sung (DDL rẻ)
+        conn.autocommit = True # CREATE INDEX CONCURRENTLY không chạy được trong transaction
+        cur = conn.cursor()
+        if skip_jsonb:
+            print("⏭️ Bỏ qua bước đổi cột sang JSONB.")
+        else:
+            migrate_jsonb(cur)
+        if column_type(cur, PARENT_TABLE, 'event_json') != 'jsonb':
+            print("⚠️ event_logs.event_json chưa là JSONB -> bỏ qua các index trên event_json.")
+        built = 0
+        for name, definition, extension in EVENT_LOG_INDEXES:
+            if 'event_json' in definition and column_type(cur, PARENT_TABLE, 'event_json') != 'jsonb':
+                continue
+            if extension and not ensure_extension(cur, extension):
+                print(f"   ⏭️ Bỏ qua {name} (thiếu {extension})")
+                continue
+            built += int(build_index(cur, PARENT_TABLE, name, definition))
+        pending = pending_event_log_migrations(cur)
+        cur.close()
+        if pending:
+            print(f"⚠️ Còn thiếu: {', '.join(pending)}")
+        else:
+            print(f"✅ event_logs đã migrate xong ({built} index mới).")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Đổi event_logs.event_json sang JSONB & build index CONCURRENTLY")
+    parser.add_argument('--skip-jsonb', action='store_true', help="Chỉ build index, không đổi kiểu cột")
+    args = parser.parse_args()
+    migrate(args.skip_jsonb)
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from dotenv import load_dotenv
+
+from api.db_pool import get_pooled_connection
+from api.schema import ensure_schema
+from api.level_rollup import refresh_level_daily_stats
+from api.response_cache import bump_app_data_version
+
+load_dotenv()
+
+# ==========================================
+# DỰNG LẠI ROLLUP level_daily_stats TỪ event_logs (chạy 1 lần sau khi deploy, hoặc khi nghi lệch số)
+# Mỗi ngày (giờ VN) 1 transaction -> dừng giữa chừng thì chạy lại từ ngày đó.
+# Ví dụ: python api/scripts/rebuild_level_rollup.py --app-id 2 --since 2025-09-01 --until 2025-10-09
+# Yêu cầu: đã backfill cột kiểu (api/scripts/backfill_event_columns.py)
+# ==========================================
+
+def rebuild(app_ids=None, since=None, until=None):
+    conn = get_pooled_connection()
+    touched = set() # App đã ghi lại rollup (kể cả khi dừng giữa chừng) -> bump version để cache cũ hết hiệu lực
+    try:
+        ensure_schema(conn)
+        cur = conn.cursor()
+
+        if not app_ids:
+            cur.execute("SELECT id FROM apps ORDER BY id")
+            app_ids = [r[0] for r in cur.fetchall()]
+
+        for app_id in app_ids:
+            # Khoảng ngày có dữ liệu (giờ VN) nếu không truyền vào
+            cur.execute("""
+                SELECT MIN((created_at + interval '7 hours')::date), MAX((created_at + interval '7 hours')::date)
+                FROM event_logs WHERE app_id = %s
+            """, (app_id,))
+            d_min, d_max = cur.fetchone()
+            day = datetime.strptime(since, '%Y-%m-%d').date() if since else d_min
+            last = datetime.strptime(until, '%Y-%m-%d').date() if until else d_max
+            if day is None or last is None:
+                print(f"⏭️ App {app_id}: không có dữ liệu.")
+                continue
+
+            t0 = time.time()
+            while day <= last:
+                cur.execute("""
+                    SELECT DISTINCT level_num FROM event_logs
+                    WHERE app_id = %s AND level_num IS NOT NULL
+                      AND created_at >= %s::date - interval '7 hours' AND created_at < %s::date + interval '17 hours'
+                """, (app_id, day, day))
+                cells = [(day, r[0]) for r in cur.fetchall()]
+
+                cur.execute("DELETE FROM level_daily_stats WHERE app_id = %s AND stat_date = %s", (app_id, day))
+                n = refresh_level_daily_stats(conn, app_id, cells)
+                conn.commit()
+                touched.add(app_id)
+                print(f"   📊 App {app_id} | {day}: {len(cells)} levels -> {n} dòng rollup ({round(time.time() - t0, 1)}s)", flush=True)
+                day += timedelta(days=1)
+
+        print("✅ Rebuild rollup xong.")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        for app_id in sorted(touched): bump_app_data_version(app_id)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Dựng lại bảng level_daily_stats từ event_logs")
+    parser.add_argument('--app-id', type=int, action='append', help="Có thể lặp lại; mặc định: tất cả app")
+    parser.add_argument('--since', help="Ngày bắt đầu (YYYY-MM-DD, giờ VN)")
+    parser.add_argument('--until', help="Ngày kết thúc (YYYY-MM-DD, giờ VN)")
+    args = parser.parse_args()
+
+    rebuild(args.app_id, args.since, args.until)
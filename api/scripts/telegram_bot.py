@@ -4,8 +4,12 @@ from psycopg2.extras import RealDictCursor
 from datetime import datetime, timedelta
 import json
 import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from dotenv import load_dotenv # [NEW] Nhập thư viện đọc file .env
 
+from api.vn_time import vn_date_range_utc
+
 # [NEW] Ép kịch bản đọc file .env ở thư mục gốc
 load_dotenv() 
 
@@ -42,8 +46,8 @@ def run_daily_report():
     """Hàm móc Data từ Database và tổng hợp báo cáo"""
     # Lấy ngày hôm qua
     yesterday = datetime.now() - timedelta(days=1)
-    start_date = yesterday.strftime('%Y-%m-%d 00:00:00')
-    end_date = yesterday.strftime('%Y-%m-%d 23:59:59')
+    # Trọn ngày hôm qua giờ VN -> khoảng UTC [start, end) so thẳng với created_at (ăn index)
+    start_date, end_date = vn_date_range_utc(yesterday.date(), yesterday.date())
     display_date = yesterday.strftime('%d/%m/%Y')
 
     try:
@@ -55,21 +59,21 @@ def run_daily_report():
             SELECT COUNT(*) as total_events 
             FROM event_logs 
             WHERE app_id = %s 
-              AND (created_at + interval '7 hours') >= %s 
-              AND (created_at + interval '7 hours') <= %s
+              AND created_at >= %s 
+              AND created_at < %s
         """, (APP_ID, start_date, end_date))
         total_events = cur.fetchone()['total_events']
 
         # 2. TÌM KẺ MẤT TÍCH Ở LEVEL 0
         cur.execute("""
             WITH Level0_Logs AS (
-                SELECT event_name, (event_json::json)->>'uuid' as uid
+                SELECT event_name, event_json->>'uuid' as uid
                 FROM event_logs
                 WHERE app_id = %s
                   AND event_name IN ('level_start', 'level_first_start', 'level_win', 'level_first_end')
-                  AND (event_json::json)->>'level_display' = '0'
-                  AND (created_at + interval '7 hours') >= %s
-                  AND (created_at + interval '7 hours') <= %s
+                  AND event_json->>'level_display' = '0'
+                  AND created_at >= %s
+                  AND created_at < %s
             ),
             StartUsers AS (SELECT DISTINCT uid FROM Level0_Logs WHERE event_name LIKE '%%start%%'),
             WinUsers AS (SELECT DISTINCT uid FROM Level0_Logs WHERE event_name LIKE '%%win%%' OR event_name LIKE '%%end%%')
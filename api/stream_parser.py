@@ -0,0 +1,104 @@
+import codecs
+import json
+import re
+
+# Kích thước mỗi lần đọc từ socket (64KB là đủ, không giữ cả file export trong RAM)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = " \t\n\r"
+# Sau 1 phần tử trong mảng chỉ có thể là khoảng trắng, "," hoặc "]"
+_ITEM_END = _WHITESPACE + ",]"
+# Ký tự còn có thể nối dài 1 số JSON (vd "2." + "5", "1e" + "3")
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+
+class StreamParseError(ValueError):
+    """File export bị cắt ngang hoặc sai cấu trúc JSON"""
+
+
+def iter_json_array_items(chunks, array_key="data"):
+    """
+    Đọc mảng JSON `array_key` từng phần tử một từ luồng bytes/str.
+    Ví dụ AppMetrica trả về: {"data": [{...}, {...}, ...]}
+    -> yield lần lượt từng dict, không bao giờ parse cả file một lúc.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    key_pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(array_key))
+
+    buf = ""
+    pos = 0
+    in_array = False
+    finished = False
+    eof = False
+    it = iter(chunks)
+
+    while not finished:
+        # 1. Nạp thêm dữ liệu từ luồng
+        try:
+            chunk = next(it)
+            if isinstance(chunk, bytes):
+                chunk = utf8.decode(chunk)
+        except StopIteration:
+            chunk = utf8.decode(b"", final=True)
+            eof = True
+        if chunk:
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        # 2. Tìm điểm bắt đầu mảng "data": [
+        if not in_array:
+            match = key_pattern.search(buf)
+            if not match:
+                if eof:
+                    raise StreamParseError(f"Không tìm thấy mảng '{array_key}' trong response")
+                # Giữ lại đuôi buffer phòng trường hợp key bị cắt giữa 2 chunk
+                pos = max(0, len(buf) - 64)
+                continue
+            pos = match.end()
+            in_array = True
+
+        # 3. Cắt từng phần tử trong mảng
+        while True:
+            while pos < len(buf) and (buf[pos] in _WHITESPACE or buf[pos] == ","):
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == "]":
+                finished = True
+                break
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Phần tử chưa về đủ -> đọc thêm chunk rồi thử lại
+                break
+            if end >= len(buf) and not eof:
+                # Chưa chắc phần tử đã kết thúc (vd số bị cắt đôi) -> chờ thêm dữ liệu
+                break
+            if end < len(buf) and buf[end] not in _ITEM_END:
+                # raw_decode dừng giữa 1 số bị cắt ngang chunk ("2." chờ "5") -> chờ thêm, không yield giá trị cụt
+                if not eof and _NUMBER_TAIL.fullmatch(buf, end):
+                    break
+                raise StreamParseError(f"Sai cấu trúc JSON trong mảng '{array_key}' (gần {buf[end:end + 20]!r})")
+            pos = end
+            yield item
+
+        if eof and not finished:
+            raise StreamParseError(f"Response kết thúc giữa chừng (mảng '{array_key}' chưa đóng)")
+
+
+def iter_export_events(response, chunk_size=STREAM_CHUNK_SIZE):
+    """Đọc từng event từ response AppMetrica (requests.get(..., stream=True))"""
+    return iter_json_array_items(response.iter_content(chunk_size=chunk_size), "data")
+
+
+def iter_batches(items, batch_size):
+    """Gom iterator thành từng lô list có kích thước tối đa batch_size"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
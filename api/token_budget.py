@@ -0,0 +1,107 @@
+import os
+import random
+import hashlib
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==========================================
+# NGÂN SÁCH REQUEST THEO TOKEN APPMETRICA (TỰ LÙI KHI BỊ 429)
+# Trước đây 429 / "enqueued" -> job Failed, chờ người bấm Retry.
+# Giờ mỗi token có 1 dòng trong token_rate_state (khóa = md5 token, không lưu token gốc):
+# - 429: backoff_level + 1, chặn token tới blocked_until = now + backoff lũy thừa có jitter,
+#   trần export song song (inflight_limit) giảm một nửa. Job bị 429 quay lại 'pending' với scheduled_at = blocked_until.
+# - Export thành công: backoff_level - 1, inflight_limit + 1 (tối đa MAX_INFLIGHT_EXPORTS_PER_TOKEN).
+# - Worker chỉ nhận job của token chưa bị chặn và còn dưới inflight_limit export đang chạy
+#   (tính cả export đang chờ 202 trong ExportPoller, vì job đó vẫn 'Processing').
+# ==========================================
+
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", "60"))
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", "3600"))
+# Job bị 429 quá số lần này thì mới đánh dấu Failed như cũ
+RATE_LIMIT_MAX_RESCHEDULES = int(os.getenv("RATE_LIMIT_MAX_RESCHEDULES", "8"))
+MAX_INFLIGHT_EXPORTS_PER_TOKEN = int(os.getenv("MAX_INFLIGHT_EXPORTS_PER_TOKEN", "4"))
+
+# Job 'Processing' bắt đầu quá lâu (worker chết giữa chừng) không còn tính là đang chiếm token
+INFLIGHT_HORIZON = "6 hours"
+
+TOKEN_CLAIM_KEY = "etl_token_claim"
+
+RECORD_429_SQL = """
+    INSERT INTO token_rate_state (token_hash, backoff_level, inflight_limit, total_429, last_429_at, updated_at)
+    VALUES (%s, 1, GREATEST(1, %s / 2), 1, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC')
+    ON CONFLICT (token_hash) DO UPDATE SET
+        backoff_level  = token_rate_state.backoff_level + 1,
+        inflight_limit = GREATEST(1, token_rate_state.inflight_limit / 2),
+        total_429      = token_rate_state.total_429 + 1,
+        last_429_at    = NOW() AT TIME ZONE 'UTC',
+        updated_at     = NOW() AT TIME ZONE 'UTC'
+    RETURNING backoff_level
+"""
+
+RECORD_SUCCESS_SQL = """
+    UPDATE token_rate_state SET
+        backoff_level  = GREATEST(0, backoff_level - 1),
+        inflight_limit = LEAST(%s, inflight_limit + 1),
+        updated_at     = NOW() AT TIME ZONE 'UTC'
+    WHERE token_hash = %s AND (backoff_level > 0 OR inflight_limit < %s)
+"""
+
+# Số export đang chạy của 1 token (mọi app dùng chung token) + trạng thái lùi của token
+TOKEN_STATE_SQL = f"""
+    SELECT
+        (SELECT COUNT(*) FROM job_history h JOIN apps a ON a.id = h.app_id
+         WHERE h.status = 'Processing' AND h.window_total IS NULL
+           AND md5(btrim(a.api_token)) = %(token_hash)s
+           AND h.start_time > NOW() - interval '{INFLIGHT_HORIZON}') AS inflight,
+        t.inflight_limit,
+        t.blocked_until > (NOW() AT TIME ZONE 'UTC') AS blocked
+    FROM (SELECT 1) one
+    LEFT JOIN token_rate_state t ON t.token_hash = %(token_hash)s
+"""
+
+def token_hash(token):
+    return hashlib.md5(str(token).strip().encode('utf-8')).hexdigest()
+
+def backoff_seconds(level, base=RATE_LIMIT_BACKOFF_BASE, cap=RATE_LIMIT_BACKOFF_MAX):
+    """Lũy thừa 2 theo level, chặn trần, jitter trong [50%, 100%] -> các job không cùng lúc gõ lại"""
+    delay = min(cap, base * (2 ** max(0, level - 1)))
+    return random.uniform(delay / 2, delay)
+
+def record_rate_limit(cur, token):
+    """Ghi nhận 1 lần 429 của token (chưa commit). Trả về (số giây lùi, blocked_until UTC)"""
+    th = token_hash(token)
+    cur.execute(RECORD_429_SQL, (th, MAX_INFLIGHT_EXPORTS_PER_TOKEN))
+    level = cur.fetchone()[0]
+    delay = backoff_seconds(level)
+    blocked_until = datetime.utcnow().replace(microsecond=0) + timedelta(seconds=int(delay))
+    # Giữ mốc chặn xa hơn nếu job khác vừa đặt
+    cur.execute("""
+        UPDATE token_rate_state SET blocked_until = GREATEST(COALESCE(blocked_until, %s), %s)
+        WHERE token_hash = %s RETURNING blocked_until
+    """, (blocked_until, blocked_until, th))
+    return delay, cur.fetchone()[0]
+
+def record_token_success(cur, token):
+    """Export của token trả dữ liệu bình thường -> nới dần trần song song (chưa commit)"""
+    cur.execute(RECORD_SUCCESS_SQL, (MAX_INFLIGHT_EXPORTS_PER_TOKEN, token_hash(token), MAX_INFLIGHT_EXPORTS_PER_TOKEN))
+
+def token_can_start(conn, token):
+    """
+    Gọi trong transaction nhận job (conn): token chưa bị chặn và còn chỗ cho thêm 1 export.
+    Khóa advisory theo token tới hết transaction -> 2 worker không cùng lúc vượt trần; token đang bị worker khác xét -> bỏ qua.
+    """
+    if not token: return True
+    th = token_hash(token)
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s), hashtext(%s))", (TOKEN_CLAIM_KEY, th))
+        if not cur.fetchone()[0]: return False
+        cur.execute(TOKEN_STATE_SQL, {"token_hash": th})
+        inflight, limit, blocked = cur.fetchone()
+    finally:
+        cur.close()
+    if blocked: return False
+    return inflight < (limit if limit is not None else MAX_INFLIGHT_EXPORTS_PER_TOKEN)
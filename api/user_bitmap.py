@@ -0,0 +1,44 @@
+import zlib
+
+# ==========================================
+# TẬP USER DẠNG BITMAP (THAY CHO set() CHỨA UID)
+# Mỗi user của 1 app có 1 số thứ tự dày (user_dictionary.user_idx) -> bit thứ idx của 1 số nguyên Python.
+# - Gộp nhiều ngày: phép OR (|)
+# - Người thắng level trước mà không vào level sau: win_prev & ~start_cur
+# - Lưu DB: bytes little-endian nén zlib (vùng bit 0 liên tiếp nén rất tốt)
+# ==========================================
+
+def bitmap_from_indexes(indexes):
+    indexes = list(indexes)
+    if not indexes: return 0
+    # Dựng qua bytearray: tránh tạo lại số nguyên lớn sau mỗi lần bật 1 bit
+    buf = bytearray(max(indexes) // 8 + 1)
+    for idx in indexes:
+        buf[idx >> 3] |= 1 << (idx & 7)
+    return int.from_bytes(buf, 'little')
+
+def bitmap_count(n):
+    if not n: return 0
+    try: return n.bit_count()
+    except AttributeError: return bin(n).count('1') # Python < 3.10
+
+# Vị trí các bit đang bật của từng giá trị 1 byte (0..255)
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+def iter_bitmap_indexes(n):
+    """Liệt kê các idx đang bật (từ nhỏ đến lớn)"""
+    if not n: return
+    # Quét bytes 1 lượt (tuyến tính theo kích thước bitmap); n ^= bit thấp nhất sẽ tạo lại cả số lớn sau mỗi bit
+    for pos, byte in enumerate(n.to_bytes((n.bit_length() + 7) // 8, 'little')):
+        if byte:
+            base = pos << 3
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit
+
+def encode_bitmap(n):
+    if not n: return None
+    return zlib.compress(n.to_bytes((n.bit_length() + 7) // 8, 'little'))
+
+def decode_bitmap(data):
+    if not data: return 0
+    return int.from_bytes(zlib.decompress(bytes(data)), 'little')
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+# ==========================================
+# LỌC THEO NGÀY GIỜ VN TRÊN CỘT created_at (LƯU UTC)
+# Đổi mốc ngày VN -> UTC 1 lần trong Python rồi so sánh thẳng với created_at
+# -> dùng được index (app_id, created_at) / (app_id, event_name, created_at) và cắt tỉa phân vùng,
+# thay cho (created_at + interval '7 hours') >= %s (bắt DB cộng giờ cho từng dòng).
+# ==========================================
+
+VN_OFFSET = timedelta(hours=7)
+
+def vn_day_start_utc(day):
+    """00:00 giờ VN của ngày day ('YYYY-MM-DD' / date / datetime) -> datetime UTC (naive)"""
+    if isinstance(day, str):
+        day = datetime.strptime(day.strip()[:10], '%Y-%m-%d')
+    elif not isinstance(day, datetime):
+        day = datetime(day.year, day.month, day.day)
+    return datetime(day.year, day.month, day.day) - VN_OFFSET
+
+def vn_date_range_utc(start_date=None, end_date=None):
+    """
+    Khoảng [from, to) theo UTC ứng với các ngày VN start_date..end_date (tính trọn ngày end_date).
+    Thiếu mốc nào thì mốc đó là None.
+    """
+    utc_from = vn_day_start_utc(start_date) if start_date else None
+    utc_to = vn_day_start_utc(end_date) + timedelta(days=1) if end_date else None
+    return utc_from, utc_to
+
+def created_at_filter(start_date=None, end_date=None, column="created_at"):
+    """
+    Trả về (list điều kiện SQL, list tham số) để ghép vào WHERE, VD:
+        clauses, params = created_at_filter('2025-10-01', '2025-10-07')
+        -> ["created_at >= %s", "created_at < %s"], [2025-09-30 17:00, 2025-10-07 17:00]
+    """
+    utc_from, utc_to = vn_date_range_utc(start_date, end_date)
+    clauses, params = [], []
+    if utc_from is not None:
+        clauses.append(f"{column} >= %s"); params.append(utc_from)
+    if utc_to is not None:
+        clauses.append(f"{column} < %s"); params.append(utc_to)
+    return clauses, params
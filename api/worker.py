@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ==========================================
+# WORKER INGEST CHẠY RIÊNG (NHIỀU PROCESS, KHÔNG CHUNG GIL VỚI FLASK)
+# - Mỗi process chạy --threads vòng run_worker_loop (api/index.py); nhận job qua api/job_queue.py
+# - Giới hạn job chạy cùng lúc (MAX_RUNNING_JOBS / MAX_JOBS_PER_APP / MAX_JOBS_PER_TOKEN) nằm trên DB (advisory lock)
+#   -> chạy bao nhiêu process, bao nhiêu máy cũng không vượt giới hạn.
+# - Lệnh STOP từ API đi qua job_history.status = 'Cancelled'
+# Ví dụ: python api/worker.py --processes 4
+# Khi đã chạy file này, đặt EMBEDDED_WORKERS=0 cho process API.
+# ==========================================
+
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "2"))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "1"))
+
+def run_process(proc_no, threads):
+    # Import trong process con: mỗi process có pool DB / connection LISTEN riêng
+    from api.index import run_worker_loop
+    from api.schema import ensure_schema
+    from api.db_pool import get_pooled_connection
+
+    # Ctrl+C: để process cha điều phối dừng (terminate) các process con
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    if proc_no == 1:
+        conn = get_pooled_connection()
+        try: ensure_schema(conn)
+        except Exception as e: print(f"⚠️ Schema Warning: {e}")
+        finally: conn.close()
+
+    workers = []
+    for i in range(threads):
+        t = threading.Thread(target=run_worker_loop, args=(f"P{proc_no}-{i + 1}",))
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    while any(t.is_alive() for t in workers):
+        time.sleep(5)
+
+def main(processes, threads):
+    ctx = multiprocessing.get_context('spawn')
+    procs = {}
+    stopping = False
+
+    def shutdown(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"🚀 Worker Service: {processes} processes x {threads} threads")
+    try:
+        while not stopping:
+            # Process nào chết (crash / OOM) thì dựng lại; slot DB của nó đã tự nhả khi connection đứt
+            for no in range(1, processes + 1):
+                p = procs.get(no)
+                if p is None or not p.is_alive():
+                    if p is not None:
+                        print(f"⚠️ Worker Process [P{no}] exited (code {p.exitcode}). Restarting...")
+                    p = ctx.Process(target=run_process, args=(no, threads), name=f"etl-worker-{no}")
+                    p.daemon = False
+                    p.start()
+                    procs[no] = p
+            time.sleep(2)
+    finally:
+        print("🛑 Worker Service stopping...")
+        for p in procs.values():
+            if p.is_alive(): p.terminate()
+        for p in procs.values():
+            p.join(timeout=30)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chạy worker ingest AppMetrica tách khỏi API")
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES, help="Số process worker")
+    parser.add_argument('--threads', type=int, default=WORKER_THREADS, help="Số vòng worker mỗi process")
+    args = parser.parse_args()
+
+    main(max(1, args.processes), max(1, args.threads))